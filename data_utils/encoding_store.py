@@ -0,0 +1,113 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Packed binary storage for encoder outputs, written batch by batch.
+
+A store ``{dataset}_encoding.mmap`` is a directory holding:
+    header.json      dtype, hidden size and sample count
+    encoding.bin     the (tokens, hidden) rows of all samples, without padding
+    offsets.npy      int64 start rows of the samples in encoding.bin (n + 1 entries)
+    uids.json        the uid of every sample, in order
+"""
+import os
+import json
+import numpy as np
+
+HEADER_FILE = "header.json"
+ENCODING_FILE = "encoding.bin"
+OFFSETS_FILE = "offsets.npy"
+UIDS_FILE = "uids.json"
+
+
+def get_encoding_store_path(output_dir, dataset):
+    return os.path.join(output_dir, "{}_encoding.mmap".format(dataset))
+
+
+class EncodingWriter(object):
+    def __init__(self, path, dtype=np.float32):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.hidden_size = None
+        os.makedirs(path, exist_ok=True)
+        self._encoding_f = open(os.path.join(path, ENCODING_FILE), "wb")
+        self._offsets = [0]
+        self._uids = []
+
+    def add(self, uid, encoding):
+        """encoding: (tokens, hidden) array of the real tokens of a sample"""
+        encoding = np.asarray(encoding, dtype=self.dtype)
+        if self.hidden_size is None:
+            self.hidden_size = encoding.shape[1]
+        assert encoding.ndim == 2 and encoding.shape[1] == self.hidden_size
+        self._encoding_f.write(np.ascontiguousarray(encoding).tobytes())
+        self._offsets.append(self._offsets[-1] + encoding.shape[0])
+        self._uids.append(uid)
+
+    def close(self):
+        self._encoding_f.close()
+        np.save(
+            os.path.join(self.path, OFFSETS_FILE),
+            np.array(self._offsets, dtype=np.int64),
+        )
+        with open(os.path.join(self.path, UIDS_FILE), "w", encoding="utf-8") as writer:
+            json.dump(self._uids, writer)
+        header = {
+            "size": len(self._uids),
+            "dtype": self.dtype.name,
+            "hidden_size": self.hidden_size or 0,
+        }
+        header_path = os.path.join(self.path, HEADER_FILE)
+        with open(header_path, "w", encoding="utf-8") as writer:
+            json.dump(header, writer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EncodingStore(object):
+    """Read-only view on an encoding store, by index or by uid.
+
+    encoding.bin is memory-mapped on first access, a sample is read from disk only
+    when it is looked up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE), "r", encoding="utf-8") as reader:
+            self.header = json.load(reader)
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        with open(os.path.join(path, UIDS_FILE), "r", encoding="utf-8") as reader:
+            self.uids = json.load(reader)
+        self._index = {uid: idx for idx, uid in enumerate(self.uids)}
+        self._encodings = None
+
+    def _open(self):
+        path = os.path.join(self.path, ENCODING_FILE)
+        shape = (int(self.offsets[-1]), self.header["hidden_size"])
+        # np.memmap refuses to map empty files
+        if os.path.getsize(path) == 0:
+            self._encodings = np.zeros(shape, dtype=self.header["dtype"])
+        else:
+            self._encodings = np.memmap(
+                path, dtype=np.dtype(self.header["dtype"]), mode="r", shape=shape
+            )
+
+    def __len__(self):
+        return self.header["size"]
+
+    def __contains__(self, uid):
+        return uid in self._index
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        """(tokens, hidden) encoding of sample idx, a view on the mapping"""
+        if self._encodings is None:
+            self._open()
+        return self._encodings[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def get(self, uid):
+        return self[self._index[uid]]
@@ -0,0 +1,90 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Random access to preprocessed ``.json`` files (one sample per line).
+
+The byte offset of every line start is stored next to the data as
+``{task}_{split}.json.idx.npy`` and rebuilt whenever the data file changes.
+"""
+import os
+import json
+import numpy as np
+
+INDEX_SUFFIX = ".idx.npy"
+
+
+def get_index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_line_index(path, block_size=1 << 20):
+    """int64 offsets of the line starts, plus the file size as the last entry"""
+    starts = [np.zeros(1, dtype=np.int64)]
+    pos = 0
+    last = b"\n"
+    with open(path, "rb") as reader:
+        for block in iter(lambda: reader.read(block_size), b""):
+            newlines = np.frombuffer(block, dtype=np.uint8) == ord("\n")
+            starts.append(np.flatnonzero(newlines).astype(np.int64) + pos + 1)
+            pos += len(block)
+            last = block[-1:]
+    offsets = np.concatenate(starts)
+    if last != b"\n":
+        # no trailing newline, the last line ends at the end of the file
+        offsets = np.append(offsets, pos)
+    return offsets
+
+
+def load_line_index(path):
+    """Load the persisted index of ``path``, (re)building it if it is missing or stale"""
+    index_path = get_index_path(path)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(
+        path
+    ):
+        offsets = np.load(index_path)
+        if len(offsets) > 0 and offsets[-1] == os.path.getsize(path):
+            return offsets
+    offsets = build_line_index(path)
+    try:
+        np.save(index_path, offsets)
+    except OSError:
+        # read-only data directory, keep the index in memory only
+        pass
+    return offsets
+
+
+class JsonlData(object):
+    """Read-only, lazily parsed view on a ``.json`` file with one sample per line.
+
+    Only the line index is held in memory. The file is opened on first access in
+    each process, so DataLoader workers share the index and use their own handle,
+    also when they are forked after the parent opened it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = load_line_index(path)
+        self._reader = None
+        self._reader_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_reader"] = None
+        state["_reader_pid"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if self._reader is None or self._reader_pid != os.getpid():
+            # a forked worker must not seek in the file position it shares with
+            # the parent, leave the inherited handle to the parent
+            self._reader = open(self.path, "rb")
+            self._reader_pid = os.getpid()
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        self._reader.seek(start)
+        return json.loads(self._reader.read(end - start).decode("utf-8"))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
@@ -0,0 +1,163 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Packed binary storage for preprocessed samples.
+
+A dataset ``{task}_{split}.mmap`` is a directory holding:
+    header.json      dtypes and sample count
+    token_id.bin     flat token ids of all samples
+    type_id.bin      flat type ids of all samples
+    offsets.npy      int64 start offsets into the flat arrays (n + 1 entries)
+    meta.jsonl       one JSON line per sample with the remaining fields (uid, label, ...)
+    meta_offsets.npy int64 byte offsets of the lines in meta.jsonl (n + 1 entries)
+"""
+import os
+import json
+import numpy as np
+
+MMAP_SUFFIX = ".mmap"
+HEADER_FILE = "header.json"
+TOKEN_FILE = "token_id.bin"
+TYPE_FILE = "type_id.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.jsonl"
+META_OFFSETS_FILE = "meta_offsets.npy"
+# fields derived from token_id, they are not stored in the side table
+SKIPPED_FIELDS = ("token_id", "type_id", "attention_mask")
+
+
+def get_mmap_path(json_path):
+    """Map ``{task}_{split}.json`` to its binary counterpart ``{task}_{split}.mmap``"""
+    prefix, _ = os.path.splitext(json_path)
+    return prefix + MMAP_SUFFIX
+
+
+def is_mmap_data(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+class MMapDataWriter(object):
+    def __init__(self, path, token_dtype=np.int32, type_dtype=np.int16):
+        self.path = path
+        self.token_dtype = np.dtype(token_dtype)
+        self.type_dtype = np.dtype(type_dtype)
+        os.makedirs(path, exist_ok=True)
+        self._token_f = open(os.path.join(path, TOKEN_FILE), "wb")
+        self._type_f = open(os.path.join(path, TYPE_FILE), "wb")
+        self._meta_f = open(os.path.join(path, META_FILE), "wb")
+        self._offsets = [0]
+        self._meta_offsets = [0]
+
+    def add(self, sample):
+        token_id = sample["token_id"]
+        type_id = sample.get("type_id", None)
+        if len(token_id) > 0 and isinstance(token_id[0], (list, tuple)):
+            raise ValueError(
+                "Binary format only supports flat token_id, got a nested list for uid %s"
+                % sample.get("uid", None)
+            )
+        if type_id is None:
+            type_id = [0] * len(token_id)
+        assert len(token_id) == len(type_id)
+        self._token_f.write(np.asarray(token_id, dtype=self.token_dtype).tobytes())
+        self._type_f.write(np.asarray(type_id, dtype=self.type_dtype).tobytes())
+        self._offsets.append(self._offsets[-1] + len(token_id))
+        meta = {k: v for k, v in sample.items() if k not in SKIPPED_FIELDS}
+        line = "{}\n".format(json.dumps(meta)).encode("utf-8")
+        self._meta_f.write(line)
+        self._meta_offsets.append(self._meta_offsets[-1] + len(line))
+
+    def close(self):
+        self._token_f.close()
+        self._type_f.close()
+        self._meta_f.close()
+        np.save(
+            os.path.join(self.path, OFFSETS_FILE), np.array(self._offsets, dtype=np.int64)
+        )
+        np.save(
+            os.path.join(self.path, META_OFFSETS_FILE),
+            np.array(self._meta_offsets, dtype=np.int64),
+        )
+        header = {
+            "size": len(self._offsets) - 1,
+            "token_dtype": self.token_dtype.name,
+            "type_dtype": self.type_dtype.name,
+        }
+        with open(os.path.join(self.path, HEADER_FILE), "w", encoding="utf-8") as writer:
+            json.dump(header, writer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def dump_mmap_data(json_path, mmap_path=None, token_dtype=np.int32, type_dtype=np.int16):
+    """Convert a preprocessed ``.json`` (one sample per line) file to the binary format"""
+    mmap_path = get_mmap_path(json_path) if mmap_path is None else mmap_path
+    with MMapDataWriter(mmap_path, token_dtype, type_dtype) as writer, open(
+        json_path, "r", encoding="utf-8"
+    ) as reader:
+        for line in reader:
+            writer.add(json.loads(line))
+    return mmap_path
+
+
+class MMapData(object):
+    """Read-only view on a binary dataset.
+
+    Arrays are memory-mapped on first access in each process, so forked DataLoader
+    workers share the page cache instead of holding a pickled copy of the data.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE), "r", encoding="utf-8") as reader:
+            self.header = json.load(reader)
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self.meta_offsets = np.load(os.path.join(path, META_OFFSETS_FILE))
+        self._token_ids = None
+        self._type_ids = None
+        self._meta = None
+
+    def _memmap(self, file_name, dtype):
+        path = os.path.join(self.path, file_name)
+        # np.memmap refuses to map empty files
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r")
+
+    def _open(self):
+        self._token_ids = self._memmap(TOKEN_FILE, np.dtype(self.header["token_dtype"]))
+        self._type_ids = self._memmap(TYPE_FILE, np.dtype(self.header["type_dtype"]))
+        self._meta = self._memmap(META_FILE, np.uint8)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_token_ids"] = None
+        state["_type_ids"] = None
+        state["_meta"] = None
+        return state
+
+    def __len__(self):
+        return self.header["size"]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def get_meta(self, idx):
+        if self._meta is None:
+            self._open()
+        start, end = self.meta_offsets[idx], self.meta_offsets[idx + 1]
+        return json.loads(self._meta[start:end].tobytes().decode("utf-8"))
+
+    def __getitem__(self, idx):
+        if self._token_ids is None:
+            self._open()
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        sample = self.get_meta(idx)
+        # copy the slices out of the read-only mapping, torch refuses to wrap
+        # non-writable buffers without a warning
+        sample["token_id"] = np.array(self._token_ids[start:end])
+        sample["type_id"] = np.array(self._type_ids[start:end])
+        return sample
@@ -0,0 +1,84 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Fingerprints of preprocessed files, used to skip splits whose inputs did not change.
+
+The fingerprint of ``{task}_{split}.json`` is stored as
+``{fingerprint_dir}/{task}_{split}.json.fingerprint`` and covers the content of
+the input files, the tokenizer, the preprocessing parameters and the
+preprocessing code itself. Keep fingerprint_dir outside of the output directory
+so that the latter only holds the preprocessed data.
+"""
+import os
+import json
+import hashlib
+
+FINGERPRINT_SUFFIX = ".fingerprint"
+
+
+def file_hash(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as reader:
+        for block in iter(lambda: reader.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Name, class and a hash of the vocabulary, so a new tokenizer revision is detected"""
+    if tokenizer is None:
+        return None
+    import transformers
+
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return {
+        "name": getattr(tokenizer, "name_or_path", None),
+        "class": type(tokenizer).__name__,
+        "vocab": hashlib.sha256(vocab.encode("utf-8")).hexdigest(),
+        "transformers": transformers.__version__,
+    }
+
+
+def compute_fingerprint(input_paths, code_paths, tokenizer_info=None, **params):
+    """
+    :param input_paths: data files the output is built from
+    :param code_paths: source files of the preprocessing code
+    :param tokenizer_info: output of tokenizer_fingerprint, computed once per run
+    :param params: any other setting (max_seq_len, data format, ...), compared by repr
+    """
+    return {
+        "inputs": {os.path.basename(path): file_hash(path) for path in input_paths},
+        "code": {os.path.basename(path): file_hash(path) for path in code_paths},
+        "tokenizer": tokenizer_info,
+        "params": {k: repr(v) for k, v in sorted(params.items())},
+    }
+
+
+def get_fingerprint_path(output_path, fingerprint_dir):
+    return os.path.join(
+        fingerprint_dir, os.path.basename(output_path) + FINGERPRINT_SUFFIX
+    )
+
+
+def is_up_to_date(output_path, fingerprint, fingerprint_dir):
+    fingerprint_path = get_fingerprint_path(output_path, fingerprint_dir)
+    if not (os.path.exists(output_path) and os.path.exists(fingerprint_path)):
+        return False
+    with open(fingerprint_path, "r", encoding="utf-8") as reader:
+        try:
+            return json.load(reader) == fingerprint
+        except ValueError:
+            return False
+
+
+def invalidate(output_path, fingerprint_dir):
+    """Drop the fingerprint before rebuilding, an interrupted build is never reused"""
+    fingerprint_path = get_fingerprint_path(output_path, fingerprint_dir)
+    if os.path.exists(fingerprint_path):
+        os.remove(fingerprint_path)
+
+
+def save_fingerprint(output_path, fingerprint, fingerprint_dir):
+    os.makedirs(fingerprint_dir, exist_ok=True)
+    fingerprint_path = get_fingerprint_path(output_path, fingerprint_dir)
+    with open(fingerprint_path, "w", encoding="utf-8") as writer:
+        json.dump(fingerprint, writer, indent=2)
@@ -24,6 +24,53 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class DeviceAverageMeter(object):
+    """AverageMeter whose running sum stays on the device of the values.
+
+    update() queues an addition without a host sync. The sum is kept in float64,
+    as the python floats of AverageMeter, on the device of the tensor values.
+    Reading avg syncs once, sums over all ranks when distributed (every rank has to
+    read it), and is cached until the next update.
+    """
+
+    def __init__(self, distributed=False):
+        self.distributed = distributed
+        self.reset()
+
+    def reset(self):
+        self.sum = None
+        self.count = 0
+        self._avg = 0
+
+    def update(self, val, n=1):
+        if torch.is_tensor(val):
+            val = val.detach().to(torch.float64) * n
+        else:
+            device = "cpu" if self.sum is None else self.sum.device
+            val = torch.tensor(float(val) * n, dtype=torch.float64, device=device)
+        if self.sum is None:
+            self.sum = val
+        elif self.sum.device == val.device:
+            self.sum.add_(val)
+        elif self.sum.device.type == "cpu":
+            # plain floats came first, move to the device of the tensors
+            self.sum = self.sum.to(val.device).add_(val)
+        else:
+            self.sum.add_(val.to(self.sum.device))
+        self.count += n
+        self._avg = None
+
+    @property
+    def avg(self):
+        if self._avg is None:
+            stats = torch.stack([self.sum, self.sum.new_tensor(float(self.count))])
+            if self.distributed:
+                torch.distributed.all_reduce(stats)
+            total, count = stats.tolist()
+            self._avg = total / count
+        return self._avg
+
+
 def set_environment(seed, set_cuda=False):
     random.seed(seed)
     numpy.random.seed(seed)
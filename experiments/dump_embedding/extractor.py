@@ -10,7 +10,7 @@ from transformers import AutoTokenizer
 from torch.utils.data import DataLoader
 from data_utils.log_wrapper import create_logger
 from data_utils.utils import set_environment
-from mt_dnn.batcher import Collater, SingleTaskDataset
+from mt_dnn.batcher import Collater, SingleTaskDataset, DevicePrefetcher
 from mt_dnn.model import MTDNNModel
 from data_utils.task_def import DataFormat, EncoderModelType
 
@@ -190,14 +190,18 @@ def train_config(parser):
     parser.add_argument(
         "--fp16",
         action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        help="fp16 mixed precision through torch autocast with dynamic loss scaling (GPU only)",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="bfloat16 mixed precision through torch autocast, on GPU or CPU",
     )
     parser.add_argument(
         "--fp16_opt_level",
         type=str,
         default="O1",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-        "See details at https://nvidia.github.io/apex/amp.html",
+        help="ignored, kept for scripts written for the former apex backend",
     )
     return parser
 
@@ -299,8 +303,8 @@ def main():
         model.cuda()
 
     features_dict = {}
-    for batch_meta, batch_data in batcher:
-        batch_meta, batch_data = Collater.patch_data(args.cuda, batch_meta, batch_data)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    for batch_meta, batch_data in DevicePrefetcher(batcher, device):
         all_encoder_layers, _ = model.extract(batch_meta, batch_data)
         embeddings = [
             all_encoder_layers[idx].detach().cpu().numpy() for idx in layer_indexes
@@ -1,5 +1,6 @@
 # Copyright (c) Microsoft. All rights reserved.
 from random import shuffle
+import numpy as np
 from data_utils.metrics import calc_metrics
 
 
@@ -387,6 +388,8 @@ def submit(path, data, label_dict=None):
     header = "index\tprediction"
     with open(path, "w") as writer:
         predictions, uids = data["predictions"], data["uids"]
+        if isinstance(predictions, np.ndarray):
+            predictions = predictions.tolist()
         writer.write("{}\n".format(header))
         assert len(predictions) == len(uids)
         # sort label
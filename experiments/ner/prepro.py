@@ -5,7 +5,15 @@ from sys import path
 path.append(os.getcwd())
 from data_utils.task_def import DataFormat
 from data_utils.log_wrapper import create_logger
+from data_utils.prepro_cache import (
+    compute_fingerprint,
+    is_up_to_date,
+    invalidate,
+    save_fingerprint,
+)
+from experiments.ner import ner_utils
 from experiments.ner.ner_utils import load_conll_chunk, load_conll_ner, load_conll_pos
+from experiments import common_utils
 from experiments.common_utils import dump_rows
 
 logger = create_logger(
@@ -18,68 +26,60 @@ def parse_args():
     parser.add_argument("--data_dir", type=str, required=True)
     parser.add_argument("--seed", type=int, default=13)
     parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="rebuild every split, even if its fingerprint is unchanged",
+    )
     args = parser.parse_args()
     return args
 
 
+def dump_split(loader, input_path, output_path, fingerprint_dir, overwrite=False):
+    fingerprint = compute_fingerprint(
+        [input_path],
+        [__file__, ner_utils.__file__, common_utils.__file__],
+        loader=loader.__name__,
+        data_format=DataFormat.Seqence,
+    )
+    if not overwrite and is_up_to_date(output_path, fingerprint, fingerprint_dir):
+        logger.info("%s is up to date, skip" % output_path)
+        return
+    invalidate(output_path, fingerprint_dir)
+    data = loader(input_path)
+    logger.info("Loaded {} samples from {}".format(len(data), input_path))
+    dump_rows(data, output_path, DataFormat.Seqence)
+    save_fingerprint(output_path, fingerprint, fingerprint_dir)
+
+
 def main(args):
     data_dir = args.data_dir
     data_dir = os.path.abspath(data_dir)
     if not os.path.isdir(data_dir):
         os.mkdir(data_dir)
 
-    train_path = os.path.join(data_dir, "train.txt")
-    dev_path = os.path.join(data_dir, "valid.txt")
-    test_path = os.path.join(data_dir, "test.txt")
-
-    train_data = load_conll_ner(train_path)
-    dev_data = load_conll_ner(dev_path)
-    test_data = load_conll_ner(test_path)
-    logger.info("Loaded {} NER train samples".format(len(train_data)))
-    logger.info("Loaded {} NER dev samples".format(len(dev_data)))
-    logger.info("Loaded {} NER test samples".format(len(test_data)))
-
-    pos_train_data = load_conll_pos(train_path)
-    pos_dev_data = load_conll_pos(dev_path)
-    pos_test_data = load_conll_pos(test_path)
-    logger.info("Loaded {} POS train samples".format(len(pos_train_data)))
-    logger.info("Loaded {} POS dev samples".format(len(pos_train_data)))
-    logger.info("Loaded {} POS test samples".format(len(pos_train_data)))
-
-    chunk_train_data = load_conll_chunk(train_path)
-    chunk_dev_data = load_conll_chunk(dev_path)
-    chunk_test_data = load_conll_chunk(test_path)
-    logger.info("Loaded {} POS train samples".format(len(chunk_train_data)))
-    logger.info("Loaded {} POS dev samples".format(len(chunk_dev_data)))
-    logger.info("Loaded {} POS test samples".format(len(chunk_test_data)))
-
     bert_root = args.output_dir
     if not os.path.isdir(bert_root):
         os.mkdir(bert_root)
-    train_fout = os.path.join(bert_root, "ner_train.tsv")
-    dev_fout = os.path.join(bert_root, "ner_dev.tsv")
-    test_fout = os.path.join(bert_root, "ner_test.tsv")
-
-    dump_rows(train_data, train_fout, DataFormat.Seqence)
-    dump_rows(dev_data, dev_fout, DataFormat.Seqence)
-    dump_rows(test_data, test_fout, DataFormat.Seqence)
-    logger.info("done with NER")
-
-    train_fout = os.path.join(bert_root, "pos_train.tsv")
-    dev_fout = os.path.join(bert_root, "pos_dev.tsv")
-    test_fout = os.path.join(bert_root, "pos_test.tsv")
-    dump_rows(pos_train_data, train_fout, DataFormat.Seqence)
-    dump_rows(pos_dev_data, dev_fout, DataFormat.Seqence)
-    dump_rows(pos_test_data, test_fout, DataFormat.Seqence)
-    logger.info("done with POS")
-
-    train_fout = os.path.join(bert_root, "chunk_train.tsv")
-    dev_fout = os.path.join(bert_root, "chunk_dev.tsv")
-    test_fout = os.path.join(bert_root, "chunk_test.tsv")
-    dump_rows(chunk_train_data, train_fout, DataFormat.Seqence)
-    dump_rows(chunk_dev_data, dev_fout, DataFormat.Seqence)
-    dump_rows(chunk_test_data, test_fout, DataFormat.Seqence)
-    logger.info("done with chunk")
+    # fingerprints live next to bert_root, which only holds the data files
+    root, mt_dnn_suffix = os.path.split(os.path.abspath(bert_root))
+    fingerprint_dir = os.path.join(root, ".fingerprint", mt_dnn_suffix)
+
+    splits = [("train", "train.txt"), ("dev", "valid.txt"), ("test", "test.txt")]
+    for task, loader in [
+        ("ner", load_conll_ner),
+        ("pos", load_conll_pos),
+        ("chunk", load_conll_chunk),
+    ]:
+        for split_name, file_name in splits:
+            dump_split(
+                loader,
+                os.path.join(data_dir, file_name),
+                os.path.join(bert_root, "{}_{}.tsv".format(task, split_name)),
+                fingerprint_dir,
+                overwrite=args.overwrite,
+            )
+        logger.info("done with {}".format(task))
 
 
 if __name__ == "__main__":
@@ -10,6 +10,13 @@ from tqdm.auto import tqdm
 from data_utils.task_def import TaskType, DataFormat
 from data_utils.log_wrapper import create_logger
 from experiments.exp_def import TaskDefs, EncoderModelType
+from data_utils.prepro_cache import (
+    compute_fingerprint,
+    tokenizer_fingerprint,
+    is_up_to_date,
+    invalidate,
+    save_fingerprint,
+)
 from transformers import AutoTokenizer
 
 
@@ -406,6 +413,11 @@ def parse_args():
     )
     parser.add_argument("--max_seq_length", type=int, default=MAX_SEQ_LEN)
     parser.add_argument("--doc_stride", type=int, default=DOC_STRIDE)
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="rebuild every split, even if its fingerprint is unchanged",
+    )
     args = parser.parse_args()
     return args
 
@@ -446,6 +458,9 @@ def main(args):
         os.mkdir(mt_dnn_root)
 
     task_defs = TaskDefs(args.task_def)
+    # fingerprints live outside of mt_dnn_root, which only holds the data files
+    fingerprint_dir = os.path.join(root, ".fingerprint", mt_dnn_suffix)
+    tokenizer_info = tokenizer_fingerprint(tokenizer)
 
     for task in task_defs.get_task_names():
         task_def = task_defs.get_task_def(task)
@@ -463,8 +478,28 @@ def main(args):
             if not "train" in split_name:
                 is_training = False
 
-            rows = flat_squad(file_path, is_training)
             dump_path = os.path.join(mt_dnn_root, "%s_%s.json" % (task, split_name))
+            fingerprint = compute_fingerprint(
+                [file_path],
+                [__file__],
+                tokenizer_info=tokenizer_info,
+                model=args.model,
+                model_revision=args.model_revision,
+                max_seq_length=args.max_seq_length,
+                doc_stride=args.doc_stride,
+                is_training=is_training,
+                data_format=task_def.data_type,
+                labels=task_def.label_vocab.get_vocab_list()
+                if task_def.label_vocab is not None
+                else None,
+            )
+            if not args.overwrite and is_up_to_date(
+                dump_path, fingerprint, fingerprint_dir
+            ):
+                logger.info("%s is up to date, skip" % dump_path)
+                continue
+            invalidate(dump_path, fingerprint_dir)
+            rows = flat_squad(file_path, is_training)
             logger.info(dump_path)
             if is_training:
                 prepare_train_feature(
@@ -486,6 +521,7 @@ def main(args):
                     max_seq_length=args.max_seq_length,
                     doc_stride=args.doc_stride,
                 )
+            save_fingerprint(dump_path, fingerprint, fingerprint_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,18 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import argparse
+from mt_dnn.checkpoint import export_inference_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="strip the optimizer/scheduler/sampler state from a training checkpoint"
+    )
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+    export_inference_checkpoint(args.checkpoint, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,18 @@ import json
 import torch
 import random
 import numpy as np
+from itertools import chain, islice
+from collections import deque
+from contextlib import nullcontext
 from shutil import copyfile
 from data_utils.task_def import TaskType, DataFormat
 from data_utils.task_def import EncoderModelType
 import tasks
 from torch.utils.data import Dataset, DataLoader, BatchSampler, Sampler
 from experiments.exp_def import TaskDef
+from data_utils.mmap_data import MMapData
+from data_utils.jsonl_index import JsonlData
+from mt_dnn.task_scheduler import TaskScheduler
 from experiments.mlm.mlm_utils import truncate_seq_pair, load_loose_json
 from experiments.mlm.mlm_utils import (
     create_instances_from_document,
@@ -19,6 +25,34 @@ from experiments.mlm.mlm_utils import (
 
 UNK_ID = 100
 BOS_ID = 101
+EOS_ID = 102
+# word dropout replaces tokens by the unknown token of the vocabulary and never
+# touches the special tokens (cls/sep or bos/eos), the encoders missing here
+# (BERT, SAN, ELECTRA) use the BERT vocabulary
+DROPOUT_UNK_IDS = {
+    EncoderModelType.ROBERTA: 3,
+    EncoderModelType.XLM: 3,
+    EncoderModelType.DEBERTA: 3,
+    EncoderModelType.XLNET: 0,
+    EncoderModelType.T5: 2,
+    EncoderModelType.T5G: 2,
+}
+DROPOUT_SPECIAL_IDS = {
+    EncoderModelType.ROBERTA: (0, 2),
+    EncoderModelType.XLM: (0, 2),
+    EncoderModelType.DEBERTA: (1, 2),
+    EncoderModelType.XLNET: (1, 2, 3, 4),
+    EncoderModelType.T5: (1,),
+    EncoderModelType.T5G: (1,),
+}
+# packed batches need per segment position ids, these encoders take none (or
+# are encoder-decoders)
+PACKING_UNSUPPORTED_ENCODERS = [
+    EncoderModelType.XLNET,
+    EncoderModelType.SAN,
+    EncoderModelType.T5,
+    EncoderModelType.T5G,
+]
 
 
 def search_bin(bins, size):
@@ -34,7 +68,116 @@ def create_bins(bin_size, maxlen):
     return [min(i + bin_size, maxlen) for i in range(0, maxlen, bin_size)]
 
 
-class DistMultiTaskBatchSampler(Sampler):
+def get_token_budget_index_batches(
+    lengths, max_tokens, max_batch_size=None, pairwise_size=1, padded_len=None
+):
+    """Group sample indices of similar length into batches whose padded size
+    (rows x longest sample) stays within max_tokens, with at most max_batch_size
+    samples per batch.
+
+    A ranking sample expands to pairwise_size rows. With padded_len (do_padding)
+    every row is padded to it, whatever the sample length.
+
+    Samples are sorted by length with random tie-breaking, so batch composition
+    changes between calls while padding stays minimal. Batches are shuffled.
+    """
+    perm = np.random.permutation(len(lengths))
+    order = perm[np.argsort(lengths[perm], kind="stable")]
+    if padded_len is not None:
+        lengths = np.full(len(lengths), padded_len, dtype=np.int64)
+    lengths = lengths.tolist()
+    index_batches = []
+    batch = []
+    for idx in order.tolist():
+        # sorted ascending: the new sample is the longest one of the batch
+        size = lengths[idx] * (len(batch) + 1) * pairwise_size
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (size > max_tokens or full):
+            index_batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        index_batches.append(batch)
+    random.shuffle(index_batches)
+    return index_batches
+
+
+def get_dataset_token_budget_index_batches(
+    dataset, max_tokens, batch_size, do_padding=False, max_seq_len=512
+):
+    """get_token_budget_index_batches on the samples of dataset, batch_size caps
+    the samples per batch as it does without a token budget
+    """
+    return get_token_budget_index_batches(
+        dataset.get_lengths(),
+        max_tokens,
+        max_batch_size=batch_size,
+        pairwise_size=dataset.get_pairwise_size(),
+        padded_len=max_seq_len if do_padding else None,
+    )
+
+
+def cycle_batches(index_batches, start=0):
+    """Batches of a task in turn from index start, restarting when the sampling
+    strategies of TaskScheduler draw a task more often than it has batches.
+    """
+    start = start % len(index_batches) if index_batches else 0
+    while True:
+        yield from index_batches[start:]
+        start = 0
+
+
+class TaskScheduleMixin(object):
+    """Resumable iteration over the task schedule of a multi-task batch sampler.
+
+    The training loop reports the epoch (set_epoch) and the number of its batches
+    consumed so far (set_position), the DataLoader pulls batches ahead of that.
+    A sampler restored by load_state_dict replays the consumed part of the
+    schedule of the epoch without producing its batches.
+    """
+
+    position = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.scheduler.epoch:
+            self.scheduler.epoch = epoch
+            self.position = 0
+
+    def set_position(self, position):
+        self.position = position
+
+    def state_dict(self):
+        return {
+            "scheduler": self.scheduler.state_dict(),
+            "position": self.position,
+            "task_sizes": self.scheduler.task_sizes,
+        }
+
+    def load_state_dict(self, state_dict):
+        assert (
+            state_dict["task_sizes"] == self.scheduler.task_sizes
+        ), "the training data changed since the sampler state was saved"
+        self.scheduler.load_state_dict(state_dict["scheduler"])
+        self.position = state_dict["position"]
+        if self.position >= len(self):
+            # saved at the end of an epoch
+            self.set_epoch(self.scheduler.epoch + 1)
+
+    def _task_batches(self):
+        """(local task index, index batch) pairs of the epoch from position on"""
+        schedule = iter(self.scheduler)
+        consumed = [0] * len(self._train_data_list)
+        for local_task_idx in islice(schedule, self.position):
+            consumed[local_task_idx] += 1
+        all_iters = [
+            cycle_batches(item, start)
+            for item, start in zip(self._train_data_list, consumed)
+        ]
+        for local_task_idx in schedule:
+            yield local_task_idx, next(all_iters[local_task_idx])
+
+
+class DistMultiTaskBatchSampler(Sampler, TaskScheduleMixin):
     def __init__(
         self,
         datasets,
@@ -44,6 +187,11 @@ class DistMultiTaskBatchSampler(Sampler):
         rank=0,
         world_size=1,
         drop_last=False,
+        max_tokens=0,
+        task_sampling="mix",
+        temperature=1.0,
+        do_padding=False,
+        max_seq_len=512,
     ):
         self.rank = rank
         self.world_size = world_size
@@ -51,12 +199,27 @@ class DistMultiTaskBatchSampler(Sampler):
         self._mix_opt = mix_opt
         self._extra_task_ratio = extra_task_ratio
         self.drop_last = drop_last
+        self.max_tokens = max_tokens
         train_data_list = []
         for dataset in datasets:
-            train_data_list.append(
-                self._get_shuffled_index_batches(len(dataset), batch_size)
-            )
+            if max_tokens > 0:
+                train_data_list.append(
+                    get_dataset_token_budget_index_batches(
+                        dataset, max_tokens, batch_size, do_padding, max_seq_len
+                    )
+                )
+            else:
+                train_data_list.append(
+                    self._get_shuffled_index_batches(len(dataset), batch_size)
+                )
         self._train_data_list = train_data_list
+        self.scheduler = TaskScheduler(
+            [len(train_data) for train_data in train_data_list],
+            task_sampling,
+            mix_opt,
+            extra_task_ratio,
+            temperature,
+        )
 
     @staticmethod
     def _get_shuffled_index_batches(dataset_len, batch_size):
@@ -68,16 +231,11 @@ class DistMultiTaskBatchSampler(Sampler):
         return index_batches
 
     def __len__(self):
-        return sum(len(train_data) for train_data in self._train_data_list)
+        return len(self.scheduler)
 
     def __iter__(self):
-        all_iters = [iter(item) for item in self._train_data_list]
-        all_indices = self._gen_task_indices(
-            self._train_data_list, self._mix_opt, self._extra_task_ratio
-        )
-        for local_task_idx in all_indices:
+        for local_task_idx, batch in self._task_batches():
             task_id = self._datasets[local_task_idx].get_task_id()
-            batch = next(all_iters[local_task_idx])
             batch = [(task_id, sample_id) for sample_id in batch]
             if len(batch) % self.world_size != 0:
                 if self.drop_last:
@@ -94,35 +252,6 @@ class DistMultiTaskBatchSampler(Sampler):
             chunk_size = len(batch) // self.world_size
             yield batch[self.rank * chunk_size : (self.rank + 1) * chunk_size]
 
-    @staticmethod
-    def _gen_task_indices(train_data_list, mix_opt, extra_task_ratio):
-        all_indices = []
-        if len(train_data_list) > 1 and extra_task_ratio > 0:
-            main_indices = [0] * len(train_data_list[0])
-            extra_indices = []
-            for i in range(1, len(train_data_list)):
-                extra_indices += [i] * len(train_data_list[i])
-            random_picks = int(
-                min(len(train_data_list[0]) * extra_task_ratio, len(extra_indices))
-            )
-            extra_indices = np.random.choice(extra_indices, random_picks, replace=False)
-            if mix_opt > 0:
-                extra_indices = extra_indices.tolist()
-                random.shuffle(extra_indices)
-                all_indices = extra_indices + main_indices
-            else:
-                all_indices = main_indices + extra_indices.tolist()
-
-        else:
-            for i in range(1, len(train_data_list)):
-                all_indices += [i] * len(train_data_list[i])
-            if mix_opt > 0:
-                random.shuffle(all_indices)
-            all_indices += [0] * len(train_data_list[0])
-        if mix_opt < 1:
-            random.shuffle(all_indices)
-        return all_indices
-
 
 class DistSingleTaskBatchSampler(Sampler):
     def __init__(self, dataset, batch_size, rank=0, world_size=1, drop_last=False):
@@ -151,7 +280,7 @@ class DistSingleTaskBatchSampler(Sampler):
             yield batch
 
 
-class MultiTaskBatchSampler(BatchSampler):
+class MultiTaskBatchSampler(BatchSampler, TaskScheduleMixin):
     def __init__(
         self,
         datasets,
@@ -161,6 +290,11 @@ class MultiTaskBatchSampler(BatchSampler):
         bin_size=64,
         bin_on=False,
         bin_grow_ratio=0.5,
+        max_tokens=0,
+        task_sampling="mix",
+        temperature=1.0,
+        do_padding=False,
+        max_seq_len=512,
     ):
         self._datasets = datasets
         self._batch_size = batch_size
@@ -169,9 +303,16 @@ class MultiTaskBatchSampler(BatchSampler):
         self.bin_size = bin_size
         self.bin_on = bin_on
         self.bin_grow_ratio = bin_grow_ratio
+        self.max_tokens = max_tokens
         train_data_list = []
         for dataset in datasets:
-            if bin_on:
+            if max_tokens > 0:
+                train_data_list.append(
+                    get_dataset_token_budget_index_batches(
+                        dataset, max_tokens, batch_size, do_padding, max_seq_len
+                    )
+                )
+            elif bin_on:
                 train_data_list.append(
                     self._get_shuffled_index_batches_bin(
                         dataset,
@@ -185,6 +326,13 @@ class MultiTaskBatchSampler(BatchSampler):
                     self._get_shuffled_index_batches(len(dataset), batch_size)
                 )
         self._train_data_list = train_data_list
+        self.scheduler = TaskScheduler(
+            [len(train_data) for train_data in train_data_list],
+            task_sampling,
+            mix_opt,
+            extra_task_ratio,
+            temperature,
+        )
 
     @staticmethod
     def _get_shuffled_index_batches(dataset_len, batch_size):
@@ -201,8 +349,8 @@ class MultiTaskBatchSampler(BatchSampler):
         bins = create_bins(bin_size, maxlen)
         data = [[] for i in range(0, len(bins))]
 
-        for idx, sample in enumerate(dataset):
-            bin_idx = search_bin(bins, len(sample["sample"]["token_id"]))
+        for idx, length in enumerate(dataset.get_lengths().tolist()):
+            bin_idx = search_bin(bins, length)
             data[bin_idx].append(idx)
         index_batches = []
 
@@ -212,7 +360,7 @@ class MultiTaskBatchSampler(BatchSampler):
             batch_size = 1 if batch_size < 1 else batch_size
             sub_dataset_len = len(sub_data)
             sub_batches = [
-                list(range(i, min(i + batch_size, sub_dataset_len)))
+                sub_data[i : min(i + batch_size, sub_dataset_len)]
                 for i in range(0, sub_dataset_len, batch_size)
             ]
             index_batches.extend(sub_batches)
@@ -221,46 +369,71 @@ class MultiTaskBatchSampler(BatchSampler):
         return index_batches
 
     def __len__(self):
-        return sum(len(train_data) for train_data in self._train_data_list)
+        return len(self.scheduler)
 
     def __iter__(self):
-        all_iters = [iter(item) for item in self._train_data_list]
-        all_indices = self._gen_task_indices(
-            self._train_data_list, self._mix_opt, self._extra_task_ratio
-        )
-        for local_task_idx in all_indices:
+        for local_task_idx, batch in self._task_batches():
             task_id = self._datasets[local_task_idx].get_task_id()
-            batch = next(all_iters[local_task_idx])
             yield [(task_id, sample_id) for sample_id in batch]
 
-    @staticmethod
-    def _gen_task_indices(train_data_list, mix_opt, extra_task_ratio):
-        all_indices = []
-        if len(train_data_list) > 1 and extra_task_ratio > 0:
-            main_indices = [0] * len(train_data_list[0])
-            extra_indices = []
-            for i in range(1, len(train_data_list)):
-                extra_indices += [i] * len(train_data_list[i])
-            random_picks = int(
-                min(len(train_data_list[0]) * extra_task_ratio, len(extra_indices))
-            )
-            extra_indices = np.random.choice(extra_indices, random_picks, replace=False)
-            if mix_opt > 0:
-                extra_indices = extra_indices.tolist()
-                random.shuffle(extra_indices)
-                all_indices = extra_indices + main_indices
-            else:
-                all_indices = main_indices + extra_indices.tolist()
 
-        else:
-            for i in range(1, len(train_data_list)):
-                all_indices += [i] * len(train_data_list[i])
-            if mix_opt > 0:
-                random.shuffle(all_indices)
-            all_indices += [0] * len(train_data_list[0])
-        if mix_opt < 1:
-            random.shuffle(all_indices)
-        return all_indices
+class FusedTaskBatchSampler(Sampler):
+    """Concatenate every fused_batch_num consecutive batches of a multi-task batch
+    sampler into one batch, which then mixes the samples of several tasks.
+
+    Collater(fused_on=True) groups the rows of such a batch by task, so that the
+    shared encoder runs once for all of them.
+    """
+
+    def __init__(self, batch_sampler, fused_batch_num):
+        assert fused_batch_num > 0
+        self.batch_sampler = batch_sampler
+        self.fused_batch_num = fused_batch_num
+
+    def __len__(self):
+        return (len(self.batch_sampler) + self.fused_batch_num - 1) // (
+            self.fused_batch_num
+        )
+
+    def __iter__(self):
+        fused_batch = []
+        for i, batch in enumerate(self.batch_sampler, 1):
+            fused_batch.extend(batch)
+            if i % self.fused_batch_num == 0:
+                yield fused_batch
+                fused_batch = []
+        if fused_batch:
+            yield fused_batch
+
+    def set_epoch(self, epoch):
+        self.batch_sampler.set_epoch(epoch)
+
+    def set_position(self, position):
+        self.batch_sampler.set_position(position * self.fused_batch_num)
+
+    def state_dict(self):
+        return self.batch_sampler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.batch_sampler.load_state_dict(state_dict)
+        assert self.batch_sampler.position % self.fused_batch_num == 0
+
+    @property
+    def position(self):
+        return self.batch_sampler.position // self.fused_batch_num
+
+
+def worker_init_fn(worker_id):
+    """Give every DataLoader worker its own random streams.
+
+    torch already seeds the global random, numpy and torch generators of a
+    worker, but the generators owned by the datasets are copied from the main
+    process and would replay the same sequence in all workers.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    dataset = worker_info.dataset
+    if hasattr(dataset, "reseed"):
+        dataset.reseed(worker_info.seed % 2**32)
 
 
 class MultiTaskDataset(Dataset):
@@ -283,6 +456,10 @@ class MultiTaskDataset(Dataset):
         task_id, sample_id = idx
         return self._task_id_2_data_set_dic[task_id][sample_id]
 
+    def reseed(self, seed):
+        for dataset in self._datasets:
+            dataset.reseed(seed)
+
 
 class DistTaskDataset(Dataset):
     def __init__(self, dataset, task_id):
@@ -298,6 +475,9 @@ class DistTaskDataset(Dataset):
     def get_task_id(self):
         return self._dataset.get_task_id()
 
+    def reseed(self, seed):
+        self._dataset.reseed(seed)
+
 
 class SingleTaskDataset(Dataset):
     def __init__(
@@ -345,10 +525,36 @@ class SingleTaskDataset(Dataset):
         self._max_predictions_per_seq = max_predictions_per_seq
         self._rng = random.Random(seed)
         self.maxlen = maxlen
+        self._lengths = None
 
     def get_task_id(self):
         return self._task_id
 
+    def get_pairwise_size(self):
+        """Rows of a sample in a batch: the hypotheses of ranking samples"""
+        if self._task_def.task_type == TaskType.Ranking and len(self) > 0:
+            return len(self._data[0]["token_id"])
+        return 1
+
+    def reseed(self, seed):
+        """Restart the MLM instance stream, called in each DataLoader worker"""
+        self._rng = random.Random(seed + self._task_id)
+
+    def get_lengths(self):
+        """Token length of every sample, computed once and cached.
+        For ranking samples this is the length of the longest hypothesis pair.
+        """
+        if self._lengths is None:
+            assert self._task_def.task_type != TaskType.MaskLM
+            if self._task_def.task_type == TaskType.Ranking:
+                lengths = (
+                    max(len(tok) for tok in sample["token_id"]) for sample in self._data
+                )
+            else:
+                lengths = (len(sample["token_id"]) for sample in self._data)
+            self._lengths = np.fromiter(lengths, dtype=np.int64, count=len(self._data))
+        return self._lengths
+
     @staticmethod
     def load(
         path,
@@ -451,6 +657,95 @@ class SingleTaskDataset(Dataset):
             }
 
 
+class MMapSingleTaskDataset(SingleTaskDataset):
+    """SingleTaskDataset backed by the binary format of data_utils.mmap_data.
+
+    Samples are sliced out of memory-mapped arrays on access instead of being
+    parsed up front, so start-up cost no longer grows with the dataset size.
+    """
+
+    def __init__(
+        self,
+        path,
+        is_train=True,
+        maxlen=512,
+        factor=1.0,
+        task_id=0,
+        task_def: TaskDef = None,
+        printable=True,
+    ):
+        assert task_def.task_type not in (
+            TaskType.Ranking,
+            TaskType.MaskLM,
+        ), "binary format does not support %s" % task_def.task_type
+        self._data = MMapData(path)
+        cnt = len(self._data)
+        if is_train:
+            self._index = np.nonzero(self._data.lengths() <= maxlen)[0]
+        else:
+            self._index = np.arange(cnt)
+        if printable:
+            print("Loaded {} samples out of {}".format(len(self._index), cnt))
+        self._factor = factor
+        self._tokenizer = None
+        self._task_id = task_id
+        self._task_def = task_def
+        self._vocab_words = None
+        self.maxlen = maxlen
+        self._lengths = self._data.lengths()[self._index]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, idx):
+        sample = self._data[int(self._index[idx])]
+        sample["factor"] = self._factor
+        return {
+            "task": {"task_id": self._task_id, "task_def": self._task_def},
+            "sample": sample,
+        }
+
+
+class LazySingleTaskDataset(SingleTaskDataset):
+    """SingleTaskDataset for evaluation that parses a sample only when it is accessed.
+
+    Only the byte offsets of the lines are kept in memory (see
+    data_utils.jsonl_index), which matters for feature files carrying
+    offset_mapping and context per sample such as SQuAD.
+    """
+
+    def __init__(
+        self,
+        path,
+        is_train=False,
+        maxlen=512,
+        factor=1.0,
+        task_id=0,
+        task_def: TaskDef = None,
+        printable=True,
+    ):
+        assert not is_train, "lazy loading does not filter long samples"
+        assert task_def.task_type != TaskType.MaskLM
+        self._data = JsonlData(path)
+        if printable:
+            print("Indexed {} samples".format(len(self._data)))
+        self._factor = factor
+        self._tokenizer = None
+        self._task_id = task_id
+        self._task_def = task_def
+        self._vocab_words = None
+        self.maxlen = maxlen
+        self._lengths = None
+
+    def __getitem__(self, idx):
+        sample = self._data[idx]
+        sample["factor"] = self._factor
+        return {
+            "task": {"task_id": self._task_id, "task_def": self._task_def},
+            "sample": sample,
+        }
+
+
 class Collater:
     def __init__(
         self,
@@ -460,6 +755,8 @@ class Collater:
         encoder_type=EncoderModelType.BERT,
         max_seq_len=512,
         do_padding=False,
+        packing_on=False,
+        fused_on=False,
     ):
         self.is_train = is_train
         self.dropout_w = dropout_w
@@ -468,36 +765,32 @@ class Collater:
         self.pairwise_size = 1
         self.max_seq_len = max_seq_len
         self.do_padding = do_padding
+        self.packing_on = packing_on
+        self.fused_on = fused_on
 
-    def __random_select__(self, arr):
-        if self.dropout_w > 0:
-            return [UNK_ID if random.uniform(0, 1) < self.dropout_w else e for e in arr]
-        else:
-            return arr
+    def _word_dropout(self, token_ids, valid):
+        """Replace each valid, non special token by UNK with probability dropout_w.
+
+        Works in place on the padded (rows, len) int64 array token_ids, valid marks
+        the real tokens. Draws from np.random, which is seeded by set_environment
+        and per DataLoader worker by torch.
+        """
+        if not self.is_train or self.dropout_w <= 0:
+            return token_ids
+        unk_id = DROPOUT_UNK_IDS.get(self.encoder_type, UNK_ID)
+        special_ids = DROPOUT_SPECIAL_IDS.get(self.encoder_type, (BOS_ID, EOS_ID))
+        drop = np.random.random_sample(token_ids.shape) < self.dropout_w
+        drop &= valid.astype(bool)
+        drop &= ~np.isin(token_ids, special_ids)
+        token_ids[drop] = unk_id
+        return token_ids
 
     @staticmethod
     def patch_data(device, batch_info, batch_data):
-        if str(device) != "cpu":
-            for i, part in enumerate(batch_data):
-                if part is None:
-                    continue
-                if isinstance(part, torch.Tensor):
-                    batch_data[i] = part.pin_memory().to(device)
-                elif isinstance(part, tuple):
-                    batch_data[i] = tuple(
-                        sub_part.pin_memory().to(device) for sub_part in part
-                    )
-                elif isinstance(part, list):
-                    batch_data[i] = [
-                        sub_part.pin_memory().to(device) for sub_part in part
-                    ]
-                else:
-                    raise TypeError("unknown batch data type at %s: %s" % (i, part))
-
-                if "soft_label" in batch_info:
-                    batch_info["soft_label"] = (
-                        batch_info["soft_label"].pin_memory().to(device)
-                    )
+        """Blocking copy of a batch to device, DevicePrefetcher overlaps it with compute"""
+        device = torch.device(device)
+        if device.type != "cpu":
+            batch_info, batch_data = move_batch(device, batch_info, batch_data)
         return batch_info, batch_data
 
     def rebatch(self, batch):
@@ -528,7 +821,19 @@ class Collater:
             DataFormat.PremiseAndMultiHypothesis,
         ]
 
+    def __if_packable__(self, task_def):
+        return (
+            self.packing_on
+            and task_def.task_type in [TaskType.Classification, TaskType.Regression]
+            and task_def.data_type
+            in [DataFormat.PremiseOnly, DataFormat.PremiseAndOneHypothesis]
+            and not task_def.enable_san
+            and self.encoder_type not in PACKING_UNSUPPORTED_ENCODERS
+        )
+
     def collate_fn(self, batch):
+        if self.fused_on and self.is_train:
+            return self._collate_fused(batch)
         task_id = batch[0]["task"]["task_id"]
         task_def = batch[0]["task"]["task_def"]
         new_batch = []
@@ -544,7 +849,11 @@ class Collater:
             batch = self.rebatch(batch)
 
         # prepare model input
-        batch_info, batch_data = self._prepare_model_input(batch, data_type)
+        packed_data = None
+        if self.__if_packable__(task_def):
+            batch_info, batch_data, packed_data = self._pack_model_input(batch)
+        else:
+            batch_info, batch_data = self._prepare_model_input(batch, data_type)
         batch_info["task_id"] = task_id  # used for select correct decoding head
         batch_info["input_len"] = len(batch_data)  # used to select model inputs
         # select different loss function and other difference in training and testing
@@ -664,9 +973,59 @@ class Collater:
                 if task_type == TaskType.SeqenceGeneration:
                     batch_info["answer"] = [sample["answer"] for sample in batch]
 
+        if packed_data is not None:
+            # per-segment positions and the flat index of each sample's CLS token
+            position_ids, cls_index = packed_data
+            batch_data.append(position_ids)
+            batch_info["position_id"] = len(batch_data) - 1
+            batch_data.append(cls_index)
+            batch_info["cls_index"] = len(batch_data) - 1
+
         batch_info["uids"] = [sample["uid"] for sample in batch]  # used in scoring
         return batch_info, batch_data
 
+    def _collate_fused(self, batch):
+        """Collate a batch mixing classification/regression samples of several tasks.
+
+        The model input is built once for all samples. For every task, in order of
+        first appearance, batch_data gets the rows of its samples and their labels.
+        """
+        task_ids = []
+        task_defs = {}
+        task_rows = {}
+        for row, sample in enumerate(batch):
+            task_id = sample["task"]["task_id"]
+            if task_id not in task_rows:
+                task_ids.append(task_id)
+                task_defs[task_id] = sample["task"]["task_def"]
+                task_rows[task_id] = []
+            task_rows[task_id].append(row)
+        batch = [sample["sample"] for sample in batch]
+
+        # pair masks are only used by the SAN decoder, which is not fused
+        batch_info, batch_data = self._prepare_model_input(
+            batch, DataFormat.PremiseOnly
+        )
+        batch_info["task_id"] = tuple(task_ids)
+        batch_info["input_len"] = len(batch_data)
+        batch_info["task_def"] = [task_defs[task_id].__dict__ for task_id in task_ids]
+        batch_info["task_rows"] = []
+        batch_info["label"] = []
+        for task_id in task_ids:
+            task_obj = tasks.get_task_obj(task_defs[task_id])
+            assert (
+                task_obj is not None
+            ), "fused batches support classification/regression tasks only"
+            rows = task_rows[task_id]
+            batch_data.append(torch.LongTensor(rows))
+            batch_info["task_rows"].append(len(batch_data) - 1)
+            batch_data.append(
+                task_obj.train_prepare_label([batch[row]["label"] for row in rows])
+            )
+            batch_info["label"].append(len(batch_data) - 1)
+        batch_info["uids"] = [sample["uid"] for sample in batch]
+        return batch_info, batch_data
+
     def _get_max_len(self, batch, key="token_id"):
         tok_len = max(len(x[key]) for x in batch)
         tok_len = self.max_seq_len if self.do_padding else tok_len
@@ -678,31 +1037,38 @@ class Collater:
     def _prepare_model_input(self, batch, data_type):
         batch_size = self._get_batch_size(batch)
         tok_len = self._get_max_len(batch, key="token_id")
-        if self.encoder_type == EncoderModelType.ROBERTA:
-            token_ids = torch.LongTensor(batch_size, tok_len).fill_(1)
-            type_ids = torch.LongTensor(batch_size, tok_len).fill_(0)
-            masks = torch.LongTensor(batch_size, tok_len).fill_(0)
-        else:
-            token_ids = torch.LongTensor(batch_size, tok_len).fill_(0)
-            type_ids = torch.LongTensor(batch_size, tok_len).fill_(0)
-            masks = torch.LongTensor(batch_size, tok_len).fill_(0)
-        if self.__if_pair__(data_type):
-            hypothesis_masks = torch.BoolTensor(batch_size, tok_len).fill_(1)
-            premise_masks = torch.BoolTensor(batch_size, tok_len).fill_(1)
-        for i, sample in enumerate(batch):
-            select_len = min(len(sample["token_id"]), tok_len)
-            tok = sample["token_id"]
-            if self.is_train:
-                tok = self.__random_select__(tok)
-            token_ids[i, :select_len] = torch.LongTensor(tok[:select_len])
-            type_ids[i, :select_len] = torch.LongTensor(sample["type_id"][:select_len])
-            masks[i, :select_len] = torch.LongTensor([1] * select_len)
-            if self.__if_pair__(data_type):
-                plen = len(sample["type_id"]) - sum(sample["type_id"])
-                premise_masks[i, :plen] = torch.LongTensor([0] * plen)
-                for j in range(plen, select_len):
-                    hypothesis_masks[i, j] = 0
+        toks = [sample["token_id"] for sample in batch]
+        lengths = np.fromiter(
+            (len(tok) for tok in toks), dtype=np.int64, count=batch_size
+        )
+        total = int(lengths.sum())
+        flat_tok = np.fromiter(chain.from_iterable(toks), dtype=np.int64, count=total)
+        flat_type = np.fromiter(
+            chain.from_iterable(sample["type_id"] for sample in batch),
+            dtype=np.int64,
+            count=total,
+        )
+        # row and column of every token in the padded batch
+        rows = np.repeat(np.arange(batch_size), lengths)
+        cols = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        keep = cols < tok_len
+
+        pad_id = 1 if self.encoder_type == EncoderModelType.ROBERTA else 0
+        token_ids = np.full((batch_size, tok_len), pad_id, dtype=np.int64)
+        type_ids = np.zeros((batch_size, tok_len), dtype=np.int64)
+        token_ids[rows[keep], cols[keep]] = flat_tok[keep]
+        type_ids[rows[keep], cols[keep]] = flat_type[keep]
+        positions = np.arange(tok_len)[None, :]
+        select_len = np.minimum(lengths, tok_len)[:, None]
+        masks = (positions < select_len).astype(np.int64)
+        self._word_dropout(token_ids, masks)
         if self.__if_pair__(data_type):
+            # premise length is computed on the untruncated type ids
+            type_sum = np.zeros(batch_size, dtype=np.int64)
+            np.add.at(type_sum, rows, flat_type)
+            plen = (lengths - type_sum)[:, None]
+            premise_masks = positions >= plen
+            hypothesis_masks = ~((positions >= plen) & (positions < select_len))
             batch_info = {
                 "token_id": 0,
                 "segment_id": 1,
@@ -710,8 +1076,182 @@ class Collater:
                 "premise_mask": 3,
                 "hypothesis_mask": 4,
             }
-            batch_data = [token_ids, type_ids, masks, premise_masks, hypothesis_masks]
+            batch_data = [
+                torch.from_numpy(token_ids),
+                torch.from_numpy(type_ids),
+                torch.from_numpy(masks),
+                torch.from_numpy(premise_masks),
+                torch.from_numpy(hypothesis_masks),
+            ]
         else:
             batch_info = {"token_id": 0, "segment_id": 1, "mask": 2}
-            batch_data = [token_ids, type_ids, masks]
+            batch_data = [
+                torch.from_numpy(token_ids),
+                torch.from_numpy(type_ids),
+                torch.from_numpy(masks),
+            ]
+        return batch_info, batch_data
+
+    def _pack_model_input(self, batch):
+        """Pack several samples into each row.
+
+        A row holds as many tokens as the longest sample of the batch (max_seq_len
+        with do_padding), so a packed batch never has more rows or longer rows than
+        the padded one. Samples are placed first-fit in batch order. Each segment attends only to
+        itself through a block-diagonal (rows, len, len) mask, position ids restart
+        at every segment and cls_index holds the flat (row * len + start) index of
+        the first token of every sample, in batch order.
+        """
+        batch_size = self._get_batch_size(batch)
+        toks = [sample["token_id"][: self.max_seq_len] for sample in batch]
+        lengths = [len(tok) for tok in toks]
+        row_len = self.max_seq_len if self.do_padding else max(lengths)
+        row_fill = []
+        sample_row = []
+        sample_start = []
+        for length in lengths:
+            for row, fill in enumerate(row_fill):
+                if fill + length <= row_len:
+                    break
+            else:
+                row = len(row_fill)
+                row_fill.append(0)
+            sample_row.append(row)
+            sample_start.append(row_fill[row])
+            row_fill[row] += length
+        n_rows = len(row_fill)
+        tok_len = row_len if self.do_padding else max(row_fill)
+
+        lengths = np.array(lengths, dtype=np.int64)
+        total = int(lengths.sum())
+        flat_tok = np.fromiter(chain.from_iterable(toks), dtype=np.int64, count=total)
+        flat_type = np.fromiter(
+            chain.from_iterable(
+                sample["type_id"][:length] for sample, length in zip(batch, lengths)
+            ),
+            dtype=np.int64,
+            count=total,
+        )
+        sample_ids = np.repeat(np.arange(batch_size), lengths)
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = np.array(sample_row, dtype=np.int64)[sample_ids]
+        cols = np.array(sample_start, dtype=np.int64)[sample_ids] + offsets
+
+        pad_id = 1 if self.encoder_type == EncoderModelType.ROBERTA else 0
+        # roberta style models count positions from padding_idx + 1
+        position_offset = (
+            2
+            if self.encoder_type in [EncoderModelType.ROBERTA, EncoderModelType.XLM]
+            else 0
+        )
+        token_ids = np.full((n_rows, tok_len), pad_id, dtype=np.int64)
+        type_ids = np.zeros((n_rows, tok_len), dtype=np.int64)
+        position_ids = np.full((n_rows, tok_len), position_offset, dtype=np.int64)
+        segments = np.full((n_rows, tok_len), -1, dtype=np.int64)
+        token_ids[rows, cols] = flat_tok
+        type_ids[rows, cols] = flat_type
+        position_ids[rows, cols] = offsets + position_offset
+        segments[rows, cols] = sample_ids
+        self._word_dropout(token_ids, segments >= 0)
+        masks = (segments[:, :, None] == segments[:, None, :]) & (
+            segments[:, :, None] >= 0
+        )
+        cls_index = np.array(sample_row, dtype=np.int64) * tok_len + np.array(
+            sample_start, dtype=np.int64
+        )
+        batch_info = {"token_id": 0, "segment_id": 1, "mask": 2}
+        batch_data = [
+            torch.from_numpy(token_ids),
+            torch.from_numpy(type_ids),
+            torch.from_numpy(masks),
+        ]
+        return (
+            batch_info,
+            batch_data,
+            (torch.from_numpy(position_ids), torch.from_numpy(cls_index)),
+        )
+
+
+def move_to_device(part, device, non_blocking=False):
+    if part is None:
+        return None
+    if isinstance(part, tuple):
+        return tuple(move_to_device(p, device, non_blocking) for p in part)
+    if isinstance(part, list):
+        return [move_to_device(p, device, non_blocking) for p in part]
+    if not isinstance(part, torch.Tensor):
+        raise TypeError("unknown batch data type: %s" % part)
+    # the DataLoader already pins the batches when pin_memory=True
+    if device.type == "cuda" and part.device.type == "cpu" and not part.is_pinned():
+        part = part.pin_memory()
+    return part.to(device, non_blocking=non_blocking)
+
+
+def move_batch(device, batch_info, batch_data, non_blocking=False):
+    batch_data = [move_to_device(part, device, non_blocking) for part in batch_data]
+    if "soft_label" in batch_info:
+        batch_info["soft_label"] = move_to_device(
+            batch_info["soft_label"], device, non_blocking
+        )
+    return batch_info, batch_data
+
+
+class DevicePrefetcher(object):
+    """Iterate over (batch_info, batch_data) pairs with the tensors already on device.
+
+    On CUDA the copies of the next ``depth`` batches are issued non-blocking on a
+    side stream, so they overlap with the computation on the current batch. On
+    CPU batches are passed through unchanged. Any other device (e.g. "meta")
+    gets the look-ahead with plain copies, which is how the logic is tested
+    without a GPU.
+    """
+
+    def __init__(self, data, device, depth=1):
+        self.data = data
+        self.device = torch.device(device)
+        self.depth = depth
+        self._stream = None
+        if self.device.type == "cuda":
+            self._stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self):
+        return len(self.data)
+
+    def _preload(self, batch):
+        batch_info, batch_data = batch
+        if self.device.type == "cpu":
+            return batch_info, batch_data, None
+        stream_ctx = nullcontext()
+        if self._stream is not None:
+            stream_ctx = torch.cuda.stream(self._stream)
+        with stream_ctx:
+            batch_info, batch_data = move_batch(
+                self.device, batch_info, batch_data, non_blocking=True
+            )
+        event = None
+        if self._stream is not None:
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return batch_info, batch_data, event
+
+    def _wait(self, batch_info, batch_data, event):
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # the memory was allocated on the side stream but is consumed on the
+            # current one, keep the allocator from reusing it too early
+            for part in chain([batch_info.get("soft_label")], batch_data):
+                parts = part if isinstance(part, (tuple, list)) else [part]
+                for tensor in parts:
+                    if isinstance(tensor, torch.Tensor):
+                        tensor.record_stream(stream)
         return batch_info, batch_data
+
+    def __iter__(self):
+        pending = deque()
+        for batch in self.data:
+            pending.append(self._preload(batch))
+            if len(pending) > self.depth:
+                yield self._wait(*pending.popleft())
+        while pending:
+            yield self._wait(*pending.popleft())
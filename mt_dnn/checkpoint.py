@@ -0,0 +1,173 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import pickle
+import inspect
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+logger = logging.getLogger(__name__)
+
+# the optimizer, lr scheduler, loss scaler and sampler states of a checkpoint
+TRAIN_STATE_KEYS = ["optimizer", "scheduler", "grad_scaler", "sampler"]
+
+
+def get_train_state_path(filename):
+    """model_0.pt -> model_0.optim.pt, where split checkpoints keep the training state"""
+    root, ext = os.path.splitext(filename)
+    return "{}.optim{}".format(root, ext)
+
+
+# memory mapped loading (torch >= 2.1) reads tensors only when they are used
+TORCH_LOAD_OPTIONS = [
+    option
+    for option in ("mmap", "weights_only")
+    if option in inspect.signature(torch.load).parameters
+]
+
+
+def plain_config(config):
+    """The entries of a config that load with weights_only=True: task_def_list
+    (TaskDef objects) is dropped, it comes from the task definition file.
+    """
+
+    def is_plain(value):
+        if value is None or type(value) in (bool, int, float, str):
+            return True
+        if type(value) in (list, tuple):
+            return all(is_plain(v) for v in value)
+        if type(value) is dict:
+            return all(is_plain(k) and is_plain(v) for k, v in value.items())
+        return False
+
+    return {k: v for k, v in config.items() if is_plain(v)}
+
+
+def load_inference_checkpoint(filename):
+    """Weights and config of a checkpoint for inference.
+
+    The file is memory mapped, so the optimizer state of a training checkpoint is
+    never read and the weights are paged in while they are copied into the model.
+    """
+    options = {option: True for option in TORCH_LOAD_OPTIONS}
+    try:
+        state_dict = torch.load(filename, map_location="cpu", **options)
+    except pickle.UnpicklingError:
+        # training checkpoints pickle the TaskDef objects of their config
+        options.pop("weights_only", None)
+        state_dict = torch.load(filename, map_location="cpu", **options)
+    return {"state": state_dict["state"], "config": state_dict["config"]}
+
+
+def export_inference_checkpoint(filename, output_filename):
+    """Write the weights and plain config of a checkpoint, without training state"""
+    state_dict = load_inference_checkpoint(filename)
+    state_dict["config"] = plain_config(state_dict["config"])
+    atomic_save(state_dict, output_filename)
+
+
+def atomic_save(obj, filename):
+    """torch.save through a temporary file, a crash never leaves a truncated file"""
+    tmp_filename = "{}.tmp".format(filename)
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+class CheckpointWriter(object):
+    """Write checkpoints on a background thread.
+
+    With async_on, save() snapshots the tensors of a state into host memory
+    (pinned and reused between checkpoints for cuda tensors), so that training can
+    go on updating them, and hands the snapshot to a writer thread. Only one
+    checkpoint is in flight: the next save() first waits for the previous write.
+    Without it, save() writes the state before returning and keeps no buffers.
+
+    split_on writes the training state (TRAIN_STATE_KEYS) to its own file next to
+    the weights, see get_train_state_path, which leaves an inference checkpoint.
+    keep_last > 0 deletes the files of older checkpoints written by this writer.
+    """
+
+    def __init__(self, async_on=True, keep_last=0, split_on=False):
+        self.async_on = async_on
+        self.keep_last = keep_last
+        self.split_on = split_on
+        self._executor = ThreadPoolExecutor(max_workers=1) if async_on else None
+        self._pending = None
+        self._buffers = {}
+        self._written = deque()
+
+    def save(self, state, filename):
+        self.wait()
+        snapshot = self._snapshot(state, "")
+        if self._executor is None:
+            self._write(snapshot, filename, None)
+            return
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            # the copies to pinned memory are asynchronous
+            event = torch.cuda.Event()
+            event.record()
+        self._pending = self._executor.submit(self._write, snapshot, filename, event)
+
+    def wait(self):
+        """Block until the last checkpoint is on disk, raising its write error"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _snapshot(self, obj, key):
+        if isinstance(obj, torch.Tensor):
+            return self._copy_to_host(obj, key)
+        # plain containers only, subclasses like TaskDef are kept as they are
+        if type(obj) in (dict, OrderedDict):
+            return type(obj)(
+                (k, self._snapshot(v, "{}/{}".format(key, k))) for k, v in obj.items()
+            )
+        if type(obj) in (list, tuple):
+            return type(obj)(
+                self._snapshot(v, "{}/{}".format(key, i)) for i, v in enumerate(obj)
+            )
+        return obj
+
+    def _copy_to_host(self, tensor, key):
+        tensor = tensor.detach()
+        if self._executor is None:
+            # written before save() returns, cpu tensors are not copied
+            return tensor.cpu()
+        if tensor.device.type != "cuda":
+            # training updates it while the writer thread saves it
+            return tensor.clone()
+        buffer = self._buffers.get(key)
+        if (
+            buffer is None
+            or buffer.shape != tensor.shape
+            or buffer.dtype != tensor.dtype
+        ):
+            buffer = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True
+            )
+            self._buffers[key] = buffer
+        buffer.copy_(tensor, non_blocking=True)
+        return buffer
+
+    def _write(self, state, filename, event):
+        if event is not None:
+            event.synchronize()
+        if self.split_on:
+            train_state = {k: state.pop(k) for k in TRAIN_STATE_KEYS if k in state}
+            atomic_save(train_state, get_train_state_path(filename))
+            if "config" in state:
+                # the weights file doubles as inference checkpoint
+                state["config"] = plain_config(state["config"])
+        atomic_save(state, filename)
+        logger.info("model saved to {}".format(filename))
+        if filename in self._written:
+            self._written.remove(filename)
+        self._written.append(filename)
+        while self.keep_last > 0 and len(self._written) > self.keep_last:
+            old_filename = self._written.popleft()
+            for old_file in (old_filename, get_train_state_path(old_filename)):
+                if os.path.exists(old_file):
+                    os.remove(old_file)
@@ -0,0 +1,130 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def encoder_fingerprint(module):
+    """Hash of the weights of module, the version of its outputs"""
+    sha = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha.update(name.encode("utf-8"))
+        tensor = tensor.detach().cpu().contiguous().reshape(-1)
+        sha.update(tensor.view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+class EncoderCache(object):
+    """LRU cache of the encoder states of single samples.
+
+    An entry is the last_hidden_state of the real tokens of a sample, keyed by a
+    hash of its token and type ids. Entries belong to the encoder weights they were
+    computed with: the version counters of the weights tell cheaply whether they
+    changed (optimizer step, load), which starts a new cache. max_bytes bounds the
+    host memory of the entries, the least recently used ones are evicted. With
+    cache_dir the entries are also written to cache_dir/<encoder_fingerprint>/ and
+    read back on memory misses, so that runs on a frozen encoder share them.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._weight_versions = None
+
+    def encode(self, encode_fn, encoder, input_ids, token_type_ids, attention_mask):
+        """last_hidden_state of a right padded batch, encode_fn(input_ids,
+        token_type_ids, attention_mask) runs the encoder on the rows that miss.
+
+        Padding positions are zeros.
+        """
+        self._check_version(encoder)
+        batch_size, seq_len = input_ids.shape
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        if attention_mask is None:
+            lengths = [seq_len] * batch_size
+        else:
+            lengths = attention_mask.sum(1).tolist()
+        ids, type_ids = input_ids.cpu(), token_type_ids.cpu()
+        keys = [
+            self._key(ids[i, :length], type_ids[i, :length])
+            for i, length in enumerate(lengths)
+        ]
+        states = [self._get(key) for key in keys]
+        missing = [i for i, state in enumerate(states) if state is None]
+        self.hits += batch_size - len(missing)
+        self.misses += len(missing)
+        if missing:
+            rows = torch.tensor(missing, device=input_ids.device)
+            max_len = max(lengths[i] for i in missing)
+            inputs = [
+                None if t is None else t.index_select(0, rows)[:, :max_len]
+                for t in (input_ids, token_type_ids, attention_mask)
+            ]
+            hidden_states = encode_fn(*inputs).float().cpu()
+            for row, i in enumerate(missing):
+                # a copy, the entry must not keep the whole batch alive
+                states[i] = hidden_states[row, : lengths[i]].clone()
+                self._put(keys[i], states[i])
+        output = torch.zeros(batch_size, seq_len, states[0].size(-1))
+        for i, state in enumerate(states):
+            output[i, : state.size(0)] = state
+        return output.to(input_ids.device)
+
+    def _check_version(self, encoder):
+        tensors = list(encoder.parameters()) + list(encoder.buffers())
+        versions = [(id(t), t._version) for t in tensors]
+        if versions == self._weight_versions:
+            return
+        self._weight_versions = versions
+        self.fingerprint = encoder_fingerprint(encoder)
+        self._entries.clear()
+        self._bytes = 0
+
+    @staticmethod
+    def _key(token_ids, type_ids):
+        sha = hashlib.sha1(token_ids.numpy().tobytes())
+        sha.update(type_ids.numpy().tobytes())
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, self.fingerprint, "{}.npy".format(key))
+
+    def _get(self, key):
+        state = self._entries.get(key)
+        if state is not None:
+            self._entries.move_to_end(key)
+            return state
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        state = torch.from_numpy(np.load(self._path(key)))
+        self._insert(key, state)
+        return state
+
+    def _put(self, key, state):
+        self._insert(key, state)
+        if self.cache_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # np.save appends .npy to names without it
+            tmp_path = "{}.tmp.npy".format(path[: -len(".npy")])
+            np.save(tmp_path, state.numpy())
+            os.replace(tmp_path, path)
+
+    def _insert(self, key, state):
+        size = state.numel() * state.element_size()
+        if key in self._entries or size > self.max_bytes:
+            return
+        self._entries[key] = state
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, old_state = self._entries.popitem(last=False)
+            self._bytes -= old_state.numel() * old_state.element_size()
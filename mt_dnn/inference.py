@@ -1,12 +1,11 @@
 # coding=utf-8
 # Copyright (c) Microsoft. All rights reserved.
 import enum
-from numpy.lib.arraysetops import isin
-from numpy.lib.function_base import insert
 from data_utils.metrics import calc_metrics
-from mt_dnn.batcher import Collater
+from mt_dnn.batcher import DevicePrefetcher
 from data_utils.task_def import TaskType
 from data_utils.utils_qa import postprocess_qa_predictions
+from data_utils.encoding_store import EncodingWriter
 from copy import deepcopy
 import numpy as np
 import torch
@@ -16,10 +15,10 @@ from tqdm import tqdm
 def extract_encoding(model, data, use_cuda=True):
     if use_cuda:
         model.cuda()
+    device = torch.device("cuda" if use_cuda else "cpu")
     sequence_outputs = []
     max_seq_len = 0
-    for idx, (batch_info, batch_data) in enumerate(data):
-        batch_info, batch_data = Collater.patch_data(use_cuda, batch_info, batch_data)
+    for idx, (batch_info, batch_data) in enumerate(DevicePrefetcher(data, device)):
         sequence_output = model.encode(batch_info, batch_data)
         sequence_outputs.append(sequence_output)
         max_seq_len = max(max_seq_len, sequence_output.shape[1])
@@ -35,6 +34,26 @@ def extract_encoding(model, data, use_cuda=True):
     return torch.cat(new_sequence_outputs)
 
 
+def dump_encoding(model, data, path, use_cuda=True, dtype=np.float32):
+    """Streaming extract_encoding: the encodings of every batch go to an encoding
+    store at path (see data_utils.encoding_store) without padding, memory stays
+    bounded by one batch.
+    """
+    if use_cuda:
+        model.cuda()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    with EncodingWriter(path, dtype) as writer:
+        for batch_info, batch_data in DevicePrefetcher(data, device):
+            sequence_output = model.encode(batch_info, batch_data)
+            lengths = batch_data[batch_info["mask"]].sum(1).tolist()
+            sequence_output = sequence_output.cpu().numpy()
+            for uid, encoding, length in zip(
+                batch_info["uids"], sequence_output, lengths
+            ):
+                writer.add(uid, encoding[:length])
+    return path
+
+
 def reduce_multirc(uids, predictions, golds):
     assert len(uids) == len(predictions)
     assert len(uids) == len(golds)
@@ -78,6 +97,40 @@ def merge(src, tgt):
         return _mg(src, tgt)
 
 
+def concat_batches(batches):
+    """Join the per-batch outputs of model.predict once: numpy arrays are
+    concatenated, other outputs (lists, span tuples, generation dicts) merged.
+    """
+    if len(batches) > 0 and all(isinstance(b, np.ndarray) for b in batches):
+        return np.concatenate(batches)
+    merged = []
+    for batch in batches:
+        merged = merge(batch, merged)
+    return merged
+
+
+def to_json(obj):
+    """json.dump default for the numpy outputs of eval_model"""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(type(obj).__name__)
+    )
+
+
+def eval_loss(model, data, device):
+    """Average training loss over an evaluation set, None if the task has none"""
+    total_loss = 0.0
+    count = 0
+    for (batch_info, batch_data) in DevicePrefetcher(data, device):
+        loss = model.eval_loss(batch_info, batch_data)
+        if loss is None:
+            return None
+        total_loss += loss * len(batch_info["uids"])
+        count += len(batch_info["uids"])
+    return total_loss / count if count > 0 else None
+
+
 def eval_model(
     model,
     data,
@@ -92,13 +145,20 @@ def eval_model(
     scores = []
     ids = []
     metrics = {}
-    for (batch_info, batch_data) in tqdm(data, total=len(data)):
-        batch_info, batch_data = Collater.patch_data(device, batch_info, batch_data)
+    for (batch_info, batch_data) in tqdm(
+        DevicePrefetcher(data, device), total=len(data)
+    ):
         score, pred, gold = model.predict(batch_info, batch_data)
-        scores = merge(score, scores)
-        golds = merge(gold, golds)
-        predictions = merge(pred, predictions)
-        ids = merge(batch_info["uids"], ids)
+        scores.append(score)
+        golds.append(gold)
+        predictions.append(pred)
+        ids.append(batch_info["uids"])
+    # classification/regression/ranking scores and predictions stay numpy arrays,
+    # to_json turns them into lists when they are dumped
+    scores = concat_batches(scores)
+    golds = concat_batches(golds)
+    predictions = concat_batches(predictions)
+    ids = concat_batches(ids)
 
     if task_type == TaskType.Span:
         predictions, golds = postprocess_qa_predictions(
@@ -111,3 +171,27 @@ def eval_model(
     if with_label:
         metrics = calc_metrics(metric_meta, golds, predictions, scores, label_mapper)
     return metrics, predictions, scores, golds, ids
+
+
+def predict_tasks(model, data, task_ids, device):
+    """Scores and predictions of every task in task_ids on the same data, one
+    encoder pass per batch (MTDNNModel.predict_tasks).
+
+    Returns {task_id: (predictions, scores)} and the uids.
+    """
+    predictions = {task_id: [] for task_id in task_ids}
+    scores = {task_id: [] for task_id in task_ids}
+    ids = []
+    for (batch_info, batch_data) in tqdm(
+        DevicePrefetcher(data, device), total=len(data)
+    ):
+        results = model.predict_tasks(batch_info, batch_data, task_ids)
+        for task_id, (score, pred) in zip(task_ids, results):
+            scores[task_id].append(score)
+            predictions[task_id].append(pred)
+        ids.append(batch_info["uids"])
+    results = {
+        task_id: (concat_batches(predictions[task_id]), concat_batches(scores[task_id]))
+        for task_id in task_ids
+    }
+    return results, concat_batches(ids)
@@ -43,6 +43,7 @@ class CeCriterion(Criterion):
 
     def forward(self, input, target, weight=None, ignore_index=-1):
         """weight: sample weight"""
+        input = input.float()
         if weight is not None:
             loss = torch.sum(
                 F.cross_entropy(
@@ -85,6 +86,7 @@ class MseCriterion(Criterion):
 
     def forward(self, input, target, weight=None, ignore_index=-1):
         """weight: sample weight"""
+        input = input.float()
         if weight:
             loss = torch.mean(
                 F.mse_loss(input.squeeze(), target, reduce=False)
@@ -221,7 +223,7 @@ class RankCeCriterion(Criterion):
         self.name = name
 
     def forward(self, input, target, weight=None, ignore_index=-1, pairwise_size=1):
-        input = input.view(-1, pairwise_size)
+        input = input.view(-1, pairwise_size).float()
         target = target.contiguous().view(-1, pairwise_size)[:, 0]
         if weight:
             loss = torch.mean(
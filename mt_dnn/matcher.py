@@ -8,6 +8,7 @@ from module.dropout_wrapper import DropoutWrapper
 from module.san import SANClassifier, MaskLmHeader
 from module.san_model import SanModel
 from module.pooler import Pooler
+from mt_dnn.encoder_cache import EncoderCache
 from torch.nn.modules.normalization import LayerNorm
 from data_utils.task_def import EncoderModelType, TaskType
 import tasks
@@ -21,6 +22,22 @@ def generate_decoder_opt(enable_san, max_opt):
     return opt_v
 
 
+def reachable_parameter_ids(tensors):
+    """ids of the leaf tensors (parameters) the autograd graph of tensors reaches"""
+    stack = [t.grad_fn for t in tensors if t.grad_fn is not None]
+    seen = set()
+    reachable = set()
+    while stack:
+        fn = stack.pop()
+        if fn is None or fn in seen:
+            continue
+        seen.add(fn)
+        if hasattr(fn, "variable"):
+            reachable.add(id(fn.variable))
+        stack.extend(next_fn for next_fn, _ in fn.next_functions)
+    return reachable
+
+
 class SANBertNetwork(nn.Module):
     def __init__(self, opt, bert_config=None, initial_from_local=False):
         super(SANBertNetwork, self).__init__()
@@ -45,6 +62,25 @@ class SANBertNetwork(nn.Module):
             )
             self.bert = model_class(self.preloaded_config)
 
+        if opt.get("gradient_checkpointing_on", False):
+            # recompute the activations of every encoder layer in the backward pass
+            if not hasattr(self.bert, "gradient_checkpointing_enable"):
+                # transformers < 4.11, the encoders read the flag from their config
+                self.bert.config.gradient_checkpointing = True
+            elif not getattr(self.bert, "supports_gradient_checkpointing", False):
+                raise ValueError(
+                    "%s encoder does not support gradient checkpointing"
+                    % literal_encoder_type
+                )
+            else:
+                self.bert.gradient_checkpointing_enable()
+
+        self.encoder_cache = None
+        if opt.get("encoder_cache_mb", 0) > 0:
+            self.encoder_cache = EncoderCache(
+                opt["encoder_cache_mb"] * 1024 * 1024, opt.get("encoder_cache_dir")
+            )
+
         hidden_size = self.bert.config.hidden_size
 
         if opt.get("dump_feature", False):
@@ -117,6 +153,8 @@ class SANBertNetwork(nn.Module):
                     out_proj = nn.Linear(hidden_size, lab)
             self.scoring_list.append(out_proj)
         self.config = opt
+        self.touch_unused_params = opt.get("touch_unused_params_on", False)
+        self._unused_params = {}
 
     def embed_encode(self, input_ids, token_type_ids=None, attention_mask=None):
         if token_type_ids is None:
@@ -131,6 +169,42 @@ class SANBertNetwork(nn.Module):
         attention_mask,
         inputs_embeds=None,
         y_input_ids=None,
+        position_ids=None,
+    ):
+        if (
+            self.encoder_cache is not None
+            and not self.training
+            and not torch.is_grad_enabled()
+            and inputs_embeds is None
+            and position_ids is None
+            and self.encoder_type != EncoderModelType.T5G
+        ):
+            # inference: the states of known samples come from the cache
+            last_hidden_state = self.encoder_cache.encode(
+                lambda *inputs: self._encode(*inputs)[0],
+                self.bert,
+                input_ids,
+                token_type_ids,
+                attention_mask,
+            )
+            return last_hidden_state, None
+        return self._encode(
+            input_ids,
+            token_type_ids,
+            attention_mask,
+            inputs_embeds,
+            y_input_ids,
+            position_ids,
+        )
+
+    def _encode(
+        self,
+        input_ids,
+        token_type_ids,
+        attention_mask,
+        inputs_embeds=None,
+        y_input_ids=None,
+        position_ids=None,
     ):
         if self.encoder_type == EncoderModelType.T5:
             outputs = self.bert(
@@ -152,11 +226,14 @@ class SANBertNetwork(nn.Module):
                 outputs.encoder_last_hidden_state
             )  # num_layers + 1 (embeddings)
         else:
+            # only packed batches carry position ids, not every encoder accepts them
+            extra_inputs = {} if position_ids is None else {"position_ids": position_ids}
             outputs = self.bert(
                 input_ids=input_ids,
                 token_type_ids=token_type_ids,
                 attention_mask=attention_mask,
                 inputs_embeds=inputs_embeds,
+                **extra_inputs
             )
             last_hidden_state = outputs.last_hidden_state
             all_hidden_states = outputs.hidden_states  # num_layers + 1 (embeddings)
@@ -173,6 +250,152 @@ class SANBertNetwork(nn.Module):
         y_input_ids=None,
         fwd_type=0,
         embed=None,
+        position_ids=None,
+        cls_index=None,
+        task_rows=None,
+    ):
+        if task_rows is not None:
+            # fused batch: task_id is a tuple of tasks, task_rows their row indices
+            output = self._fused_forward(
+                input_ids, token_type_ids, attention_mask, task_id, task_rows
+            )
+        elif isinstance(task_id, (tuple, list)):
+            # every row scored by the head of every task in task_id
+            output = self._multi_head_forward(
+                input_ids,
+                token_type_ids,
+                attention_mask,
+                premise_mask,
+                hyp_mask,
+                task_id,
+                position_ids,
+                cls_index,
+            )
+        else:
+            output = self._forward(
+                input_ids,
+                token_type_ids,
+                attention_mask,
+                premise_mask,
+                hyp_mask,
+                task_id,
+                y_input_ids,
+                fwd_type,
+                embed,
+                position_ids,
+                cls_index,
+            )
+        if self.touch_unused_params and fwd_type == 0 and torch.is_grad_enabled():
+            output = self._touch_unused_parameters(task_id, output)
+        return output
+
+    def _touch_unused_parameters(self, task_id, output):
+        """Add a zero contribution of every parameter the graph of task_id does not
+        reach (heads of the other tasks, unused poolers), so that all parameters
+        get a gradient and DDP can run with find_unused_parameters=False.
+
+        The unused parameters are found once per task (per task tuple for fused
+        batches) by walking the autograd graph.
+        """
+        tensors = output if isinstance(output, (tuple, list)) else (output,)
+        if task_id not in self._unused_params:
+            reachable = reachable_parameter_ids(tensors)
+            self._unused_params[task_id] = [
+                p
+                for p in self.parameters()
+                if p.requires_grad and id(p) not in reachable
+            ]
+        unused = self.unused_parameters(task_id)
+        if not unused:
+            return output
+        zero = sum(p.sum() for p in unused) * 0.0
+        if isinstance(output, (tuple, list)):
+            return type(output)([tensors[0] + zero] + list(tensors[1:]))
+        return output + zero
+
+    def _fused_forward(
+        self, input_ids, token_type_ids, attention_mask, task_ids, task_rows
+    ):
+        """Run the shared encoder once over a batch mixing several tasks and score
+        the rows of every task with its own head. Returns one logits per task.
+        """
+        last_hidden_state, _ = self.encode(input_ids, token_type_ids, attention_mask)
+        pooled_output = self.pooler(last_hidden_state)
+        logits = []
+        for task_id, rows in zip(task_ids, task_rows):
+            task_obj = tasks.get_task_obj(self.task_def_list[task_id])
+            assert task_obj is not None and self.decoder_opt[task_id] != 1
+            logits.append(
+                task_obj.train_forward(
+                    None,
+                    pooled_output.index_select(0, rows),
+                    None,
+                    None,
+                    self.decoder_opt[task_id],
+                    self.dropout_list[task_id],
+                    self.scoring_list[task_id],
+                )
+            )
+        return logits
+
+    def _multi_head_forward(
+        self,
+        input_ids,
+        token_type_ids,
+        attention_mask,
+        premise_mask,
+        hyp_mask,
+        task_ids,
+        position_ids=None,
+        cls_index=None,
+    ):
+        """Run the shared encoder once and score the whole batch with the head of
+        every task in task_ids. Returns one logits per task.
+        """
+        last_hidden_state, _ = self.encode(
+            input_ids, token_type_ids, attention_mask, position_ids=position_ids
+        )
+        if cls_index is not None:
+            last_hidden_state = last_hidden_state.reshape(
+                -1, last_hidden_state.size(-1)
+            ).index_select(0, cls_index)
+            last_hidden_state = last_hidden_state.unsqueeze(1)
+        pooled_output = self.pooler(last_hidden_state)
+        logits = []
+        for task_id in task_ids:
+            task_obj = tasks.get_task_obj(self.task_def_list[task_id])
+            assert task_obj is not None, "only classification/regression heads"
+            assert cls_index is None or self.decoder_opt[task_id] != 1
+            logits.append(
+                task_obj.train_forward(
+                    last_hidden_state,
+                    pooled_output,
+                    premise_mask,
+                    hyp_mask,
+                    self.decoder_opt[task_id],
+                    self.dropout_list[task_id],
+                    self.scoring_list[task_id],
+                )
+            )
+        return logits
+
+    def unused_parameters(self, task_id):
+        """Parameters touched with a zero contribution in batches of task_id"""
+        return self._unused_params.get(task_id, [])
+
+    def _forward(
+        self,
+        input_ids,
+        token_type_ids,
+        attention_mask,
+        premise_mask=None,
+        hyp_mask=None,
+        task_id=0,
+        y_input_ids=None,
+        fwd_type=0,
+        embed=None,
+        position_ids=None,
+        cls_index=None,
     ):
         if fwd_type == 3:
             generated = self.bert.generate(
@@ -194,11 +417,22 @@ class SANBertNetwork(nn.Module):
             return self.embed_encode(input_ids, token_type_ids, attention_mask)
         else:
             last_hidden_state, all_hidden_states = self.encode(
-                input_ids, token_type_ids, attention_mask, y_input_ids=y_input_ids
+                input_ids,
+                token_type_ids,
+                attention_mask,
+                y_input_ids=y_input_ids,
+                position_ids=position_ids,
             )
         decoder_opt = self.decoder_opt[task_id]
         task_type = self.task_types[task_id]
         task_obj = tasks.get_task_obj(self.task_def_list[task_id])
+        if cls_index is not None:
+            # packed batch: gather the CLS state of every segment, one per sample
+            assert task_obj is not None and decoder_opt != 1
+            last_hidden_state = last_hidden_state.reshape(
+                -1, last_hidden_state.size(-1)
+            ).index_select(0, cls_index)
+            last_hidden_state = last_hidden_state.unsqueeze(1)
         if task_obj is not None:
             pooled_output = self.pooler(last_hidden_state)
             logits = task_obj.train_forward(
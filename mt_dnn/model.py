@@ -1,8 +1,9 @@
 # coding=utf-8
 # Copyright (c) Microsoft. All rights reserved.
-import copy
+import os
 import sys
 import torch
+from contextlib import nullcontext
 import tasks
 import logging
 import numpy as np
@@ -10,11 +11,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim.lr_scheduler import *
-from data_utils.utils import AverageMeter
+from data_utils.utils import DeviceAverageMeter
 from pytorch_pretrained_bert import BertAdam as Adam
-from module.bert_optim import Adamax, RAdam
+from mt_dnn.optim import AdamaxW
 from mt_dnn.loss import LOSS_REGISTRY
 from mt_dnn.matcher import SANBertNetwork
+from mt_dnn.checkpoint import CheckpointWriter, get_train_state_path
 from mt_dnn.perturbation import SmartPerturbation
 from mt_dnn.loss import *
 from data_utils.task_def import TaskType, EncoderModelType
@@ -32,11 +34,15 @@ class MTDNNModel(object):
             state_dict["updates"] if state_dict and "updates" in state_dict else 0
         )
         self.local_updates = 0
+        # parameters without a real gradient since the last optimizer step
+        self._unused_param_ids = None
         self.device = device
-        self.train_loss = AverageMeter()
-        self.adv_loss = AverageMeter()
-        self.emb_val = AverageMeter()
-        self.eff_perturb = AverageMeter()
+        # reduced across ranks only when the averages are read for logging
+        distributed = opt["local_rank"] != -1
+        self.train_loss = DeviceAverageMeter(distributed)
+        self.adv_loss = DeviceAverageMeter(distributed)
+        self.emb_val = DeviceAverageMeter(distributed)
+        self.eff_perturb = DeviceAverageMeter(distributed)
         self.initial_from_local = True if state_dict else False
         model = SANBertNetwork(opt, initial_from_local=self.initial_from_local)
         self.total_param = sum(
@@ -53,6 +59,12 @@ class MTDNNModel(object):
                 state_dict["state"], strict=False
             )
 
+        self.checkpoint_writer = CheckpointWriter(
+            async_on=opt.get("async_save_on", False),
+            keep_last=opt.get("keep_last_ckpts", 0),
+            split_on=opt.get("split_ckpt_on", False),
+        )
+
         optimizer_parameters = self._get_param_groups()
         self._setup_optim(optimizer_parameters, state_dict, num_train_step)
         self.optimizer.zero_grad()
@@ -63,9 +75,12 @@ class MTDNNModel(object):
         if self.config["local_rank"] != -1:
             self.mnetwork = torch.nn.parallel.DistributedDataParallel(
                 self.network,
-                device_ids=[self.config["local_rank"]],
-                output_device=self.config["local_rank"],
-                find_unused_parameters=True,
+                # cpu modules (gloo backend) take no device ids
+                device_ids=[self.config["local_rank"]] if opt["cuda"] else None,
+                output_device=self.config["local_rank"] if opt["cuda"] else None,
+                # with touch_unused_params_on the network gives every parameter a
+                # (possibly zero) gradient, which spares ddp a graph walk per step
+                find_unused_parameters=not opt.get("touch_unused_params_on", False),
             )
         elif self.config["multi_gpu_on"]:
             self.mnetwork = nn.DataParallel(self.network)
@@ -128,7 +143,7 @@ class MTDNNModel(object):
                                     lr=self.config['learning_rate'],
                                     weight_decay=self.config['weight_decay'])
         else:
-            raise RuntimeError('Unsupported optimizer: %s' % opt['optimizer'])
+            raise RuntimeError('Unsupported optimizer: %s' % self.config['optimizer'])
 
         if state_dict and 'optimizer' in state_dict:
             self.optimizer.load_state_dict(state_dict['optimizer'])
@@ -137,19 +152,7 @@ class MTDNNModel(object):
         if state_dict and "optimizer" in state_dict:
             self.optimizer.load_state_dict(state_dict["optimizer"])
 
-        if self.config["fp16"]:
-            try:
-                from apex import amp
-                global amp
-            except ImportError:
-                raise ImportError(
-                    "Please install apex from https://www.github.com/nvidia/apex to use fp16 training."
-                )
-            model, optimizer = amp.initialize(
-                self.network, self.optimizer, opt_level=self.config["fp16_opt_level"]
-            )
-            self.network = model
-            self.optimizer = optimizer
+        self._setup_amp(state_dict)
 
         # # set up scheduler
         self.scheduler = None
@@ -185,6 +188,39 @@ class MTDNNModel(object):
                 )
 
 
+    def _setup_amp(self, state_dict=None):
+        """Native mixed precision: fp16 autocast with loss scaling on GPU, bf16
+        autocast (GPU or CPU) which keeps the fp32 exponent range and needs no scaling.
+        """
+        self.amp_dtype = None
+        if self.config.get("bf16", False):
+            self.amp_dtype = torch.bfloat16
+        elif self.config.get("fp16", False):
+            assert self.config["cuda"], "fp16 requires cuda, use bf16 on cpu"
+            self.amp_dtype = torch.float16
+        self.amp_device_type = "cuda" if self.config["cuda"] else "cpu"
+        self.grad_scaler = torch.cuda.amp.GradScaler(
+            enabled=self.amp_dtype == torch.float16
+        )
+        if state_dict and "grad_scaler" in state_dict:
+            self.grad_scaler.load_state_dict(state_dict["grad_scaler"])
+
+    def _autocast(self):
+        return torch.autocast(
+            self.amp_device_type,
+            dtype=self.amp_dtype,
+            enabled=self.amp_dtype is not None,
+        )
+
+    @staticmethod
+    def _to_float(score):
+        """Upcast half precision outputs of autocast before they go to numpy"""
+        if isinstance(score, (tuple, list)):
+            return type(score)(MTDNNModel._to_float(s) for s in score)
+        if isinstance(score, torch.Tensor) and score.is_floating_point():
+            return score.float()
+        return score
+
     def _setup_lossmap(self, config):
         task_def_list: List[TaskDef] = config["task_def_list"]
         self.task_loss_criterion = []
@@ -243,8 +279,89 @@ class MTDNNModel(object):
             y.requires_grad = False
         return y
 
+    @staticmethod
+    def _get_packed_inputs(batch_meta, batch_data):
+        if "cls_index" not in batch_meta:
+            return {}
+        return {
+            "position_ids": batch_data[batch_meta["position_id"]],
+            "cls_index": batch_data[batch_meta["cls_index"]],
+        }
+
     def update(self, batch_meta, batch_data):
         self.network.train()
+        grad_accumulation_step = self.config.get("grad_accumulation_step", 1)
+        sync_gradients = (self.local_updates + 1) % grad_accumulation_step == 0
+        sync_context = nullcontext()
+        if not sync_gradients and isinstance(
+            self.mnetwork, torch.nn.parallel.DistributedDataParallel
+        ):
+            # accumulate locally, gradients are all-reduced once per optimizer step
+            sync_context = self.mnetwork.no_sync()
+        with sync_context:
+            self._forward_backward(batch_meta, batch_data)
+        if self.config.get("touch_unused_params_on", False):
+            task_id = batch_meta["task_id"]
+            unused = {id(p) for p in self.network.unused_parameters(task_id)}
+            if self._unused_param_ids is not None:
+                unused &= self._unused_param_ids
+            self._unused_param_ids = unused
+        self.local_updates += 1
+        if sync_gradients:
+            if self._unused_param_ids:
+                # drop the zero gradients of the touched parameters, so that weight
+                # decay and momentum leave them alone as with find_unused_parameters.
+                # All ranks run the same task in a step (DistMultiTaskBatchSampler
+                # splits one batch), so locally unused means globally unused.
+                for p in self.network.parameters():
+                    if id(p) in self._unused_param_ids:
+                        p.grad = None
+            self._unused_param_ids = None
+            if self.config["global_grad_clipping"] > 0:
+                self.grad_scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(
+                    self.network.parameters(), self.config["global_grad_clipping"]
+                )
+            self.updates += 1
+            # reset number of the grad accumulation
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
+            self.optimizer.zero_grad()
+            if self.scheduler:
+                self.scheduler.step()
+
+    def _fused_forward_backward(self, batch_meta, batch_data):
+        """One forward through the encoder for a batch mixing several tasks, the
+        loss is the sum of the losses of the tasks.
+        """
+        task_ids = batch_meta["task_id"]
+        task_rows = [batch_data[idx] for idx in batch_meta["task_rows"]]
+        inputs = batch_data[: batch_meta["input_len"]]
+        with self._autocast():
+            logits = self.mnetwork(*inputs, task_id=task_ids, task_rows=task_rows)
+            loss = 0
+            for task_id, rows, label_idx, task_logits in zip(
+                task_ids, task_rows, batch_meta["label"], logits
+            ):
+                y = batch_data[label_idx]
+                task_loss = self.task_loss_criterion[task_id](
+                    task_logits, y, None, ignore_index=-1
+                )
+                # rescale loss as dynamic batching
+                if self.config["bin_on"] or self.config.get("max_tokens", 0) > 0:
+                    task_loss = task_loss * (
+                        1.0 * rows.size(0) / self.config["batch_size"]
+                    )
+                loss = loss + task_loss
+
+        batch_size = batch_data[batch_meta["token_id"]].size(0)
+        self.train_loss.update(loss, batch_size)
+        loss = loss / self.config.get("grad_accumulation_step", 1)
+        self.grad_scaler.scale(loss).backward()
+
+    def _forward_backward(self, batch_meta, batch_data):
+        if "task_rows" in batch_meta:
+            return self._fused_forward_backward(batch_meta, batch_data)
         y = batch_data[batch_meta["label"]]
         y = self._to_cuda(y) if self.config["cuda"] else y
         if batch_meta["task_def"]["task_type"] == TaskType.SeqenceGeneration:
@@ -266,133 +383,96 @@ class MTDNNModel(object):
             else:
                 weight = batch_data[batch_meta["factor"]]
 
-        # fw to get logits
-        logits = self.mnetwork(*inputs)
+        with self._autocast():
+            # fw to get logits
+            logits = self.mnetwork(
+                *inputs, **self._get_packed_inputs(batch_meta, batch_data)
+            )
 
-        # compute loss
-        loss = 0
-        if self.task_loss_criterion[task_id] and (y is not None):
-            loss_criterion = self.task_loss_criterion[task_id]
-            if (
-                isinstance(loss_criterion, RankCeCriterion)
-                and batch_meta["pairwise_size"] > 1
-            ):
-                # reshape the logits for ranking.
-                loss = self.task_loss_criterion[task_id](
-                    logits,
-                    y,
-                    weight,
-                    ignore_index=-1,
-                    pairwise_size=batch_meta["pairwise_size"],
-                )
-            elif batch_meta["task_def"]["task_type"] == TaskType.SeqenceGeneration:
-                weight = (
-                    (
-                        1.0
-                        / torch.sum(
-                            (y > -1).float().view(-1, seq_length), 1, keepdim=True
+            # compute loss
+            loss = 0
+            if self.task_loss_criterion[task_id] and (y is not None):
+                loss_criterion = self.task_loss_criterion[task_id]
+                if (
+                    isinstance(loss_criterion, RankCeCriterion)
+                    and batch_meta["pairwise_size"] > 1
+                ):
+                    # reshape the logits for ranking.
+                    loss = self.task_loss_criterion[task_id](
+                        logits,
+                        y,
+                        weight,
+                        ignore_index=-1,
+                        pairwise_size=batch_meta["pairwise_size"],
+                    )
+                elif batch_meta["task_def"]["task_type"] == TaskType.SeqenceGeneration:
+                    weight = (
+                        (
+                            1.0
+                            / torch.sum(
+                                (y > -1).float().view(-1, seq_length), 1, keepdim=True
+                            )
                         )
+                        .repeat(1, seq_length)
+                        .view(-1)
+                    )
+                    loss = self.task_loss_criterion[task_id](
+                        logits, y, weight, ignore_index=-1
                     )
-                    .repeat(1, seq_length)
-                    .view(-1)
+                else:
+                    loss = self.task_loss_criterion[task_id](
+                        logits, y, weight, ignore_index=-1
+                    )
+
+            # compute kd loss
+            if self.config.get("mkd_opt", 0) > 0 and ("soft_label" in batch_meta):
+                soft_labels = batch_meta["soft_label"]
+                soft_labels = (
+                    self._to_cuda(soft_labels) if self.config["cuda"] else soft_labels
                 )
-                loss = self.task_loss_criterion[task_id](
-                    logits, y, weight, ignore_index=-1
+                kd_lc = self.kd_task_loss_criterion[task_id]
+                kd_loss = (
+                    kd_lc(logits, soft_labels, weight, ignore_index=-1) if kd_lc else 0
                 )
-            else:
-                loss = self.task_loss_criterion[task_id](
-                    logits, y, weight, ignore_index=-1
+                loss = loss + kd_loss
+
+            # adv training
+            if self.config.get("adv_train", False) and self.adv_teacher:
+                # task info
+                task_type = batch_meta["task_def"]["task_type"]
+                adv_inputs = (
+                    [self.mnetwork, logits]
+                    + inputs
+                    + [task_type, batch_meta.get("pairwise_size", 1)]
                 )
+                adv_loss, emb_val, eff_perturb = self.adv_teacher.forward(*adv_inputs)
+                loss = loss + self.config["adv_alpha"] * adv_loss
 
-        # compute kd loss
-        if self.config.get("mkd_opt", 0) > 0 and ("soft_label" in batch_meta):
-            soft_labels = batch_meta["soft_label"]
-            soft_labels = (
-                self._to_cuda(soft_labels) if self.config["cuda"] else soft_labels
-            )
-            kd_lc = self.kd_task_loss_criterion[task_id]
-            kd_loss = (
-                kd_lc(logits, soft_labels, weight, ignore_index=-1) if kd_lc else 0
-            )
-            loss = loss + kd_loss
-
-        # adv training
-        if self.config.get("adv_train", False) and self.adv_teacher:
-            # task info
-            task_type = batch_meta["task_def"]["task_type"]
-            adv_inputs = (
-                [self.mnetwork, logits]
-                + inputs
-                + [task_type, batch_meta.get("pairwise_size", 1)]
-            )
-            adv_loss, emb_val, eff_perturb = self.adv_teacher.forward(*adv_inputs)
-            loss = loss + self.config["adv_alpha"] * adv_loss
-
-        batch_size = batch_data[batch_meta["token_id"]].size(0)
+        if "cls_index" in batch_meta:
+            # packed rows hold several samples each
+            batch_size = batch_data[batch_meta["cls_index"]].size(0)
+        else:
+            batch_size = batch_data[batch_meta["token_id"]].size(0)
         # rescale loss as dynamic batching
-        if self.config["bin_on"]:
+        if self.config["bin_on"] or self.config.get("max_tokens", 0) > 0:
             loss = loss * (1.0 * batch_size / self.config["batch_size"])
-        if self.config["local_rank"] != -1:
-            # print('Rank ', self.config['local_rank'], ' loss ', loss)
-            copied_loss = copy.deepcopy(loss.data)
-            torch.distributed.all_reduce(copied_loss)
-            copied_loss = copied_loss / self.config["world_size"]
-            self.train_loss.update(copied_loss.item(), batch_size)
-        else:
-            self.train_loss.update(loss.item(), batch_size)
-
+        self.train_loss.update(loss, batch_size)
         if self.config.get("adv_train", False) and self.adv_teacher:
-            if self.config["local_rank"] != -1:
-                copied_adv_loss = copy.deepcopy(adv_loss.data)
-                torch.distributed.all_reduce(copied_adv_loss)
-                copied_adv_loss = copied_adv_loss / self.config["world_size"]
-                self.adv_loss.update(copied_adv_loss.item(), batch_size)
-
-                copied_emb_val = copy.deepcopy(emb_val.data)
-                torch.distributed.all_reduce(copied_emb_val)
-                copied_emb_val = copied_emb_val / self.config["world_size"]
-                self.emb_val.update(copied_emb_val.item(), batch_size)
-
-                copied_eff_perturb = copy.deepcopy(eff_perturb.data)
-                torch.distributed.all_reduce(copied_eff_perturb)
-                copied_eff_perturb = copied_eff_perturb / self.config["world_size"]
-                self.eff_perturb.update(copied_eff_perturb.item(), batch_size)
-            else:
-                self.adv_loss.update(adv_loss.item(), batch_size)
-                self.emb_val.update(emb_val.item(), batch_size)
-                self.eff_perturb.update(eff_perturb.item(), batch_size)
+            self.adv_loss.update(adv_loss, batch_size)
+            self.emb_val.update(emb_val, batch_size)
+            self.eff_perturb.update(eff_perturb, batch_size)
 
         # scale loss
         loss = loss / self.config.get("grad_accumulation_step", 1)
-        if self.config["fp16"]:
-            with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss.backward()
-        self.local_updates += 1
-        if self.local_updates % self.config.get("grad_accumulation_step", 1) == 0:
-            if self.config["global_grad_clipping"] > 0:
-                if self.config["fp16"]:
-                    torch.nn.utils.clip_grad_norm_(
-                        amp.master_params(self.optimizer),
-                        self.config["global_grad_clipping"],
-                    )
-                else:
-                    torch.nn.utils.clip_grad_norm_(
-                        self.network.parameters(), self.config["global_grad_clipping"]
-                    )
-            self.updates += 1
-            # reset number of the grad accumulation
-            self.optimizer.step()
-            self.optimizer.zero_grad()
-            if self.scheduler:
-                self.scheduler.step()
+        # a no-op unless fp16 loss scaling is on
+        self.grad_scaler.scale(loss).backward()
 
     def encode(self, batch_meta, batch_data):
         self.network.eval()
         inputs = batch_data[:3]
-        sequence_output = self.network.encode(*inputs)[0]
-        return sequence_output
+        with self._autocast():
+            sequence_output = self.network.encode(*inputs)[0]
+        return self._to_float(sequence_output)
 
     # TODO: similar as function extract, preserve since it is used by extractor.py
     # will remove after migrating to transformers package
@@ -400,8 +480,32 @@ class MTDNNModel(object):
         self.network.eval()
         # 'token_id': 0; 'segment_id': 1; 'mask': 2
         inputs = batch_data[:3]
-        all_encoder_layers, pooled_output = self.mnetwork.bert(*inputs)
-        return all_encoder_layers, pooled_output
+        with self._autocast():
+            all_encoder_layers, pooled_output = self.mnetwork.bert(*inputs)
+        return self._to_float(all_encoder_layers), self._to_float(pooled_output)
+
+    def eval_loss(self, batch_meta, batch_data):
+        """Training loss of an evaluation batch, None unless the task is a
+        classification/regression task with labels.
+        """
+        task_id = batch_meta["task_id"]
+        task_obj = tasks.get_task_obj(TaskDef.from_dict(batch_meta["task_def"]))
+        labels = batch_meta.get("label")
+        if task_obj is None or not labels or labels[0] is None:
+            return None
+        self.network.eval()
+        inputs = batch_data[: batch_meta["input_len"]]
+        if len(inputs) == 3:
+            inputs.append(None)
+            inputs.append(None)
+        inputs.append(task_id)
+        with torch.no_grad(), self._autocast():
+            logits = self.mnetwork(
+                *inputs, **self._get_packed_inputs(batch_meta, batch_data)
+            )
+            y = task_obj.train_prepare_label(labels).to(logits.device)
+            loss = self.task_loss_criterion[task_id](logits, y, None, ignore_index=-1)
+        return loss.item()
 
     def predict(self, batch_meta, batch_data):
         self.network.eval()
@@ -419,7 +523,11 @@ class MTDNNModel(object):
             inputs.append(None)
             inputs.append(3)
 
-        score = self.mnetwork(*inputs)
+        with self._autocast():
+            score = self.mnetwork(
+                *inputs, **self._get_packed_inputs(batch_meta, batch_data)
+            )
+        score = self._to_float(score)
         if task_obj is not None:
             score, predict = task_obj.test_predict(score)
         elif task_type == TaskType.Ranking:
@@ -432,8 +540,8 @@ class MTDNNModel(object):
             positive = np.argmax(score, axis=1)
             for idx, pos in enumerate(positive):
                 predict[idx, pos] = 1
-            predict = predict.reshape(-1).tolist()
-            score = score.reshape(-1).tolist()
+            predict = predict.reshape(-1)
+            score = score.reshape(-1)
             return score, predict, batch_meta["true_label"]
         elif task_type == TaskType.SeqenceLabeling:
             mask = batch_data[batch_meta["mask"]]
@@ -505,29 +613,80 @@ class MTDNNModel(object):
             raise ValueError("Unknown task_type: %s" % task_type)
         return score, predict, batch_meta["label"]
 
-    def save(self, filename):
+    def predict_tasks(self, batch_meta, batch_data, task_ids):
+        """predict() with the heads of several tasks on the same inputs.
+
+        The encoder runs once for the batch and every task of task_ids scores all of
+        its rows, so the tasks need the input format of the batch. Classification
+        and regression heads only. Returns the (score, predict) of every task.
+        """
+        self.network.eval()
+        inputs = batch_data[: batch_meta["input_len"]]
+        if len(inputs) == 3:
+            inputs.append(None)
+            inputs.append(None)
+        inputs.append(tuple(task_ids))
+        with self._autocast():
+            scores = self.mnetwork(
+                *inputs, **self._get_packed_inputs(batch_meta, batch_data)
+            )
+        results = []
+        for task_id, score in zip(task_ids, scores):
+            task_obj = tasks.get_task_obj(self.config["task_def_list"][task_id])
+            results.append(task_obj.test_predict(self._to_float(score)))
+        return results
+
+    def save(self, filename, sampler=None):
+        """Save a checkpoint, with the state of the training batch sampler when
+        given so that a resumed run continues in the middle of the epoch.
+        """
         if isinstance(self.mnetwork, torch.nn.parallel.DistributedDataParallel):
             model = self.mnetwork.module
         else:
             model = self.network
-        # network_state = dict([(k, v.cpu()) for k, v in self.network.state_dict().items()])
-        network_state = dict([(k, v.cpu()) for k, v in model.state_dict().items()])
+        # the writer copies the tensors to host memory
         params = {
-            "state": network_state,
+            "state": dict(model.state_dict()),
             "optimizer": self.optimizer.state_dict(),
             "config": self.config,
+            "updates": self.updates,
+            "local_updates": self.local_updates,
         }
-        torch.save(params, filename)
-        logger.info("model saved to {}".format(filename))
-
-    def load(self, checkpoint):
-        model_state_dict = torch.load(checkpoint)
+        if self.scheduler:
+            params["scheduler"] = self.scheduler.state_dict()
+        if self.grad_scaler.is_enabled():
+            params["grad_scaler"] = self.grad_scaler.state_dict()
+        if sampler is not None:
+            params["sampler"] = sampler.state_dict()
+        self.checkpoint_writer.save(params, filename)
+
+    def wait_for_checkpoint(self):
+        """Block until the checkpoints written in the background are on disk"""
+        self.checkpoint_writer.wait()
+
+    def load(self, checkpoint, sampler=None):
+        model_state_dict = torch.load(checkpoint, map_location=self.device)
+        train_state_file = get_train_state_path(checkpoint)
+        if "optimizer" not in model_state_dict and os.path.exists(train_state_file):
+            # split checkpoint
+            model_state_dict.update(
+                torch.load(train_state_file, map_location=self.device)
+            )
         if "state" in model_state_dict:
             self.network.load_state_dict(model_state_dict["state"], strict=False)
         if "optimizer" in model_state_dict:
             self.optimizer.load_state_dict(model_state_dict["optimizer"])
         if "config" in model_state_dict:
             self.config.update(model_state_dict["config"])
+        if "updates" in model_state_dict:
+            self.updates = model_state_dict["updates"]
+            self.local_updates = model_state_dict["local_updates"]
+        if self.scheduler and "scheduler" in model_state_dict:
+            self.scheduler.load_state_dict(model_state_dict["scheduler"])
+        if "grad_scaler" in model_state_dict:
+            self.grad_scaler.load_state_dict(model_state_dict["grad_scaler"])
+        if sampler is not None and "sampler" in model_state_dict:
+            sampler.load_state_dict(model_state_dict["sampler"])
 
     def cuda(self):
         self.network.cuda()
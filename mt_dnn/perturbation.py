@@ -116,7 +116,9 @@ class SmartPerturbation:
             ]
             adv_logits = model(*vat_args)
             if task_type == TaskType.Regression:
-                adv_loss = F.mse_loss(adv_logits, logits.detach(), reduction="sum")
+                adv_loss = F.mse_loss(
+                    adv_logits.float(), logits.detach().float(), reduction="sum"
+                )
             else:
                 if task_type == TaskType.Ranking:
                     adv_logits = adv_logits.view(-1, pairwise)
@@ -0,0 +1,269 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import json
+import time
+import logging
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from data_utils.task_def import DataFormat, EncoderModelType
+from mt_dnn.batcher import Collater
+from prepro_std import extract_features_chunk
+
+logger = logging.getLogger(__name__)
+
+# raw text inputs of the server, as the premise/hypothesis fields of prepro_std
+SERVING_DATA_FORMATS = [DataFormat.PremiseOnly, DataFormat.PremiseAndOneHypothesis]
+
+
+class LatencyStats(object):
+    """Request latencies (queueing + batch) over the last window requests"""
+
+    def __init__(self, window=10000):
+        self.count = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self.count += 1
+            self._latencies.append(latency)
+
+    def summary(self):
+        with self._lock:
+            count = self.count
+            latencies = np.array(self._latencies) * 1000
+        if not len(latencies):
+            return {"count": count}
+        p50, p99 = np.percentile(latencies, [50, 99])
+        return {
+            "count": count,
+            "p50_ms": float(p50),
+            "p99_ms": float(p99),
+            "mean_ms": float(latencies.mean()),
+        }
+
+
+class MicroBatcher(object):
+    """Group the requests of each task into micro-batches on a worker thread.
+
+    A batch of a task runs as soon as it holds max_batch_size requests, or once its
+    oldest request has waited max_wait seconds; the task with the oldest request
+    goes first. predict_fn(task_id, requests) returns one result per request, which
+    submit() hands back through a Future.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait=0.005):
+        assert max_batch_size > 0
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = LatencyStats()
+        self._queues = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, task_id, request):
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("the batcher is closed")
+            queue = self._queues.setdefault(task_id, deque())
+            queue.append((time.perf_counter(), request, future))
+            self._cond.notify()
+        return future
+
+    def close(self):
+        """Run the queued requests and stop the worker"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                oldest = [
+                    (q[0][0], task_id) for task_id, q in self._queues.items() if q
+                ]
+                if not oldest:
+                    if self._closed:
+                        return None, None
+                    self._cond.wait()
+                    continue
+                full = [
+                    (q[0][0], task_id)
+                    for task_id, q in self._queues.items()
+                    if len(q) >= self.max_batch_size
+                ]
+                arrival, task_id = min(full or oldest)
+                timeout = arrival + self.max_wait - time.perf_counter()
+                if not full and timeout > 0 and not self._closed:
+                    self._cond.wait(timeout)
+                    continue
+                queue = self._queues[task_id]
+                size = min(len(queue), self.max_batch_size)
+                return task_id, [queue.popleft() for _ in range(size)]
+
+    def _run(self):
+        while True:
+            task_id, batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                results = self.predict_fn(task_id, [request for _, request, _ in batch])
+            except Exception as e:
+                logger.exception("batch of task {} failed".format(task_id))
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for (arrival, _, future), result in zip(batch, results):
+                self.stats.record(now - arrival)
+                future.set_result(result)
+
+
+class InferenceService(object):
+    """Score raw text with MTDNNModel.predict in dynamic micro-batches.
+
+    task_names/task_defs list the tasks of the checkpoint in the order of their
+    task ids (--train_datasets of train.py). A request is a dict with the premise
+    and, for pair tasks, the hypothesis text; it is tokenized like prepro_std does
+    for the data files, once per micro-batch.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        task_names,
+        task_defs,
+        max_seq_len=512,
+        max_batch_size=32,
+        max_wait=0.005,
+        encoder_type=EncoderModelType.BERT,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.task_defs = task_defs
+        self.task_ids = {name: task_id for task_id, name in enumerate(task_names)}
+        self.max_seq_len = max_seq_len
+        self.collater = Collater(
+            is_train=False, encoder_type=encoder_type, max_seq_len=max_seq_len
+        )
+        self.batcher = MicroBatcher(self.predict_batch, max_batch_size, max_wait)
+
+    def submit(self, task, request):
+        """Queue a request of task (a name), a Future of its score and prediction"""
+        if task not in self.task_ids:
+            raise KeyError("unknown task {}".format(task))
+        task_id = self.task_ids[task]
+        data_type = self.task_defs[task_id].data_type
+        if data_type not in SERVING_DATA_FORMATS:
+            raise ValueError("task {} takes {} inputs".format(task, data_type.name))
+        fields = ["premise"]
+        if data_type == DataFormat.PremiseAndOneHypothesis:
+            fields.append("hypothesis")
+        for field in fields:
+            if not isinstance(request.get(field), str):
+                raise ValueError("task {} needs a {} text".format(task, field))
+        return self.batcher.submit(task_id, {field: request[field] for field in fields})
+
+    def predict(self, task, request, timeout=None):
+        return self.submit(task, request).result(timeout)
+
+    def predict_batch(self, task_id, requests):
+        task_def = self.task_defs[task_id]
+        samples = [
+            dict(request, uid=str(i), label=None) for i, request in enumerate(requests)
+        ]
+        features = extract_features_chunk(
+            samples,
+            data_format=task_def.data_type,
+            max_seq_len=self.max_seq_len,
+            tokenizer=self.tokenizer,
+        )
+        batch_info, batch_data = self.collater.collate_fn(
+            [
+                {"task": {"task_id": task_id, "task_def": task_def}, "sample": feature}
+                for feature in features
+            ]
+        )
+        batch_info, batch_data = Collater.patch_data(
+            self.model.device, batch_info, batch_data
+        )
+        with torch.no_grad():
+            score, predict, _ = self.model.predict(batch_info, batch_data)
+        scores = np.asarray(score).reshape(len(requests), -1).tolist()
+        predictions = np.asarray(predict).reshape(len(requests)).tolist()
+        return [
+            {"score": score, "prediction": prediction}
+            for score, prediction in zip(scores, predictions)
+        ]
+
+    def stats(self):
+        return self.batcher.stats.summary()
+
+    def close(self):
+        self.batcher.close()
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """POST /predict {"task": ..., "premise": ..., "hypothesis": ...} and GET /stats"""
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self._send(404, {"error": "not found"})
+            return
+        self._send(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            future = self.server.service.submit(request.get("task"), request)
+        except (KeyError, ValueError, AttributeError) as e:
+            self._send(400, {"error": str(e)})
+            return
+        try:
+            self._send(200, future.result())
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+
+    def _send(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return str(self.client_address or "unix")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=8000, unix_socket=None):
+    """A threading http server of service on host:port, or on a unix socket"""
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, InferenceRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.service = service
+    return server
@@ -0,0 +1,168 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import numpy as np
+
+TASK_SAMPLING_STRATEGIES = ["mix", "proportional", "temperature", "uniform"]
+
+
+def task_sampling_probs(task_sizes, strategy="proportional", temperature=1.0):
+    """Probability of drawing a batch of each task, p_i ~ n_i ** (1 / temperature).
+
+    proportional is temperature 1, uniform is an infinite temperature.
+    """
+    sizes = np.asarray(task_sizes, dtype=np.float64)
+    if strategy == "uniform":
+        probs = (sizes > 0).astype(np.float64)
+    elif strategy == "proportional":
+        probs = sizes
+    elif strategy == "temperature":
+        assert temperature > 0
+        probs = sizes ** (1.0 / temperature)
+    else:
+        raise ValueError("unknown task sampling strategy %s" % strategy)
+    return probs / probs.sum()
+
+
+class TaskScheduler(object):
+    """Order in which the batches of the tasks are drawn in an epoch.
+
+    task_sizes holds the number of batches of every task, task 0 being the main
+    task. Iterating yields task indices one at a time with O(#tasks) memory, the
+    schedule of an epoch is never materialized.
+
+    strategy "mix" draws every batch of an epoch exactly once, in random order:
+    mix_opt > 0 puts the batches of the main task after the other tasks, and
+    extra_task_ratio > 0 keeps all main task batches plus that ratio of randomly
+    picked batches of the other tasks. The sampling strategies (proportional,
+    temperature, uniform) draw tasks with replacement from task_sampling_probs,
+    for as many batches as the tasks have together; reweight() scales these
+    probabilities by the dev losses of the tasks.
+
+    The schedule of an epoch is a function of (seed, epoch): seed is drawn from
+    np.random once, so that ranks with the same seed draw the same schedules, and
+    a resumed run can replay the schedule of any epoch from state_dict().
+    """
+
+    def __init__(
+        self,
+        task_sizes,
+        strategy="mix",
+        mix_opt=0,
+        extra_task_ratio=0,
+        temperature=1.0,
+        chunk_size=1024,
+    ):
+        if strategy not in TASK_SAMPLING_STRATEGIES:
+            raise ValueError("unknown task sampling strategy %s" % strategy)
+        self.task_sizes = [int(size) for size in task_sizes]
+        self.strategy = strategy
+        self.mix_opt = mix_opt
+        self.extra_task_ratio = extra_task_ratio
+        self.chunk_size = chunk_size
+        self.probs = None
+        if strategy != "mix":
+            self.probs = task_sampling_probs(self.task_sizes, strategy, temperature)
+        self.base_probs = self.probs
+        self.seed = int(np.random.randint(2**31))
+        self.epoch = 0
+
+    def __len__(self):
+        if self.strategy == "mix" and self._extra_picks() is not None:
+            return self.task_sizes[0] + self._extra_picks()
+        return sum(self.task_sizes)
+
+    def _extra_picks(self):
+        if len(self.task_sizes) < 2 or self.extra_task_ratio <= 0:
+            return None
+        return int(
+            min(
+                self.task_sizes[0] * self.extra_task_ratio, sum(self.task_sizes[1:])
+            )
+        )
+
+    def reweight(self, task_losses):
+        """Draw tasks in proportion to base probability x dev loss / mean dev loss.
+
+        task_losses maps task indices to their dev loss, tasks without one keep
+        their base probability. Only for the sampling strategies.
+        """
+        assert self.strategy != "mix", "reweighting needs a sampling strategy"
+        if not task_losses:
+            return
+        mean_loss = np.mean(list(task_losses.values()))
+        scale = np.ones(len(self.task_sizes))
+        for task_idx, loss in task_losses.items():
+            scale[task_idx] = loss / mean_loss if mean_loss > 0 else 1.0
+        probs = self.base_probs * scale
+        self.probs = probs / probs.sum()
+
+    def state_dict(self):
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "probs": None if self.probs is None else self.probs.tolist(),
+        }
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        if state_dict["probs"] is not None:
+            self.probs = np.asarray(state_dict["probs"])
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        if self.strategy != "mix":
+            return self._sample(rng, sum(self.task_sizes))
+        return self._mix(rng)
+
+    def _sample(self, rng, num_batches):
+        num_tasks = len(self.task_sizes)
+        while num_batches > 0:
+            size = min(self.chunk_size, num_batches)
+            yield from rng.choice(num_tasks, size=size, p=self.probs).tolist()
+            num_batches -= size
+
+    def _mix(self, rng):
+        counts = np.array(self.task_sizes, dtype=np.int64)
+        extra_picks = self._extra_picks()
+        if extra_picks is not None:
+            # randomly picked batches of the other tasks
+            counts[1:] = self._hypergeometric(rng, counts[1:], extra_picks)
+        if self.mix_opt > 0:
+            main_count = counts[0]
+            counts[0] = 0
+            yield from self._draw_without_replacement(rng, counts)
+            for _ in range(main_count):
+                yield 0
+        else:
+            yield from self._draw_without_replacement(rng, counts)
+
+    @staticmethod
+    def _hypergeometric(rng, counts, num_draws):
+        """How many of num_draws draws without replacement fall on every task"""
+        picks = np.zeros_like(counts)
+        left = int(counts.sum())
+        for task_idx, count in enumerate(counts.tolist()):
+            left -= count
+            if num_draws == 0:
+                break
+            picks[task_idx] = rng.hypergeometric(count, left, num_draws) if count else 0
+            num_draws -= picks[task_idx]
+        return picks
+
+    def _draw_without_replacement(self, rng, counts):
+        """A uniformly random order of counts[i] draws of every task i.
+
+        The next chunk_size draws of a random order are a multivariate
+        hypergeometric sample of the remaining counts, in random order.
+        """
+        counts = counts.copy()
+        total = int(counts.sum())
+        while total > 0:
+            size = min(self.chunk_size, total)
+            picks = self._hypergeometric(rng, counts, size)
+            chunk = np.repeat(np.arange(len(counts)), picks)
+            rng.shuffle(chunk)
+            yield from chunk.tolist()
+            counts -= picks
+            total -= size
@@ -8,16 +8,17 @@ from torch.utils.data import DataLoader
 from data_utils.task_def import TaskType
 from experiments.exp_def import TaskDefs, EncoderModelType
 from torch.utils.data import Dataset, DataLoader, BatchSampler
-from mt_dnn.batcher import SingleTaskDataset, Collater
+from mt_dnn.batcher import SingleTaskDataset, LazySingleTaskDataset, Collater
 from mt_dnn.model import MTDNNModel
+from mt_dnn.checkpoint import load_inference_checkpoint
 from data_utils.metrics import calc_metrics
-from mt_dnn.inference import eval_model
+from mt_dnn.inference import eval_model, predict_tasks, to_json
 from data_utils.metrics import Metric
 
 
 def dump(path, data):
     with open(path, "w") as f:
-        json.dump(data, f)
+        json.dump(data, f, default=to_json)
 
 
 parser = argparse.ArgumentParser()
@@ -26,6 +27,13 @@ parser.add_argument(
 )
 parser.add_argument("--task", type=str)
 parser.add_argument("--task_id", type=int, help="the id of this task when training")
+parser.add_argument(
+    "--head_tasks",
+    type=str,
+    default=None,
+    help="score the input with the heads of these tasks (all the tasks of the "
+    "checkpoint, in training order) in one encoder pass",
+)
 
 parser.add_argument("--prep_input", type=str)
 parser.add_argument("--with_label", action="store_true")
@@ -33,6 +41,27 @@ parser.add_argument("--score", type=str, help="score output path")
 parser.add_argument("--metric", type=str, default=None)
 parser.add_argument("--max_seq_len", type=int, default=512)
 parser.add_argument("--batch_size_eval", type=int, default=8)
+parser.add_argument(
+    "--fp16", action="store_true", help="fp16 autocast for inference (GPU only)"
+)
+parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast for inference")
+parser.add_argument(
+    "--lazy_on",
+    action="store_true",
+    help="parse samples on access through a byte-offset index instead of loading them into memory",
+)
+parser.add_argument(
+    "--encoder_cache_mb",
+    type=int,
+    default=0,
+    help="cache the encoder states of the input in this much host memory",
+)
+parser.add_argument(
+    "--encoder_cache_dir",
+    type=str,
+    default=None,
+    help="keep the cached encoder states on disk, reused by later runs on the same input",
+)
 parser.add_argument(
     "--cuda",
     type=bool,
@@ -69,23 +98,29 @@ if args.cuda:
 else:
     device = torch.device("cpu")
 
-state_dict = torch.load(checkpoint_path, map_location=device)
+# weights only, the optimizer state of training checkpoints is skipped
+state_dict = load_inference_checkpoint(checkpoint_path)
 
 config = state_dict["config"]
 config["cuda"] = args.cuda
 task_def = task_defs.get_task_def(prefix)
 task_def_list = [task_def]
+if args.head_tasks:
+    head_tasks = args.head_tasks.split(",")
+    task_def_list = [task_defs.get_task_def(name.split("_")[0]) for name in head_tasks]
 config["task_def_list"] = task_def_list
-## temp fix
-config["fp16"] = False
+config["fp16"] = args.fp16
+config["bf16"] = args.bf16
 config["answer_opt"] = 0
 config["adv_train"] = False
-del state_dict["optimizer"]
+config["encoder_cache_mb"] = args.encoder_cache_mb
+config["encoder_cache_dir"] = args.encoder_cache_dir
 
 model = MTDNNModel(config, device=device, state_dict=state_dict)
 encoder_type = config.get("encoder_type", EncoderModelType.BERT)
 # load data
-test_data_set = SingleTaskDataset(
+dataset_cls = LazySingleTaskDataset if args.lazy_on else SingleTaskDataset
+test_data_set = dataset_cls(
     args.prep_input,
     False,
     maxlen=args.max_seq_len,
@@ -100,20 +135,30 @@ test_data = DataLoader(
     pin_memory=args.cuda,
 )
 with torch.no_grad():
-    test_metrics, test_predictions, scores, golds, test_ids = eval_model(
-        model,
-        test_data,
-        metric_meta=metric_meta,
-        device=device,
-        with_label=args.with_label,
-    )
+    if args.head_tasks:
+        results, test_ids = predict_tasks(
+            model, test_data, list(range(len(head_tasks))), device
+        )
+        results = {
+            name: {"predictions": predictions, "scores": scores}
+            for name, (predictions, scores) in zip(head_tasks, results.values())
+        }
+        dump(args.score, {"uids": test_ids, "tasks": results})
+    else:
+        test_metrics, test_predictions, scores, golds, test_ids = eval_model(
+            model,
+            test_data,
+            metric_meta=metric_meta,
+            device=device,
+            with_label=args.with_label,
+        )
 
-    results = {
-        "metrics": test_metrics,
-        "predictions": test_predictions,
-        "uids": test_ids,
-        "scores": scores,
-    }
-    dump(args.score, results)
-    if args.with_label:
-        print(test_metrics)
+        results = {
+            "metrics": test_metrics,
+            "predictions": test_predictions,
+            "uids": test_ids,
+            "scores": scores,
+        }
+        dump(args.score, results)
+        if args.with_label:
+            print(test_metrics)
@@ -6,13 +6,24 @@ import numpy as np
 import argparse
 import json
 import sys
-from data_utils import load_data
+import data_utils
+import tasks
+from data_utils import iter_data
 from data_utils.task_def import TaskType, DataFormat
 from data_utils.log_wrapper import create_logger
+from data_utils.mmap_data import dump_mmap_data, get_mmap_path, HEADER_FILE
+from data_utils.prepro_cache import (
+    compute_fingerprint,
+    tokenizer_fingerprint,
+    is_up_to_date,
+    invalidate,
+    save_fingerprint,
+)
 from experiments.exp_def import TaskDefs
 from transformers import AutoTokenizer
 from tqdm import tqdm
-from functools import partial
+from itertools import islice
+from collections import deque
 import multiprocessing
 
 
@@ -57,40 +68,6 @@ def feature_extractor(tokenizer, text_a, text_b=None, max_length=512, do_padding
     return input_ids, attention_mask, token_type_ids
 
 
-def extract_feature_premise_only(sample, max_seq_len=MAX_SEQ_LEN, tokenizer=None):
-    """extract feature of single sentence tasks"""
-    input_ids, input_mask, type_ids = feature_extractor(
-        tokenizer, sample["premise"], max_length=max_seq_len
-    )
-    feature = {
-        "uid": sample["uid"],
-        "label": sample["label"],
-        "token_id": input_ids,
-        "type_id": type_ids,
-        "attention_mask": input_mask,
-    }
-    return feature
-
-
-def extract_feature_premise_and_one_hypo(
-    sample, max_seq_len=MAX_SEQ_LEN, tokenizer=None
-):
-    input_ids, input_mask, type_ids = feature_extractor(
-        tokenizer,
-        sample["premise"],
-        text_b=sample["hypothesis"],
-        max_length=max_seq_len,
-    )
-    feature = {
-        "uid": sample["uid"],
-        "label": sample["label"],
-        "token_id": input_ids,
-        "type_id": type_ids,
-        "attention_mask": input_mask,
-    }
-    return feature
-
-
 def extract_feature_premise_and_multi_hypo(
     sample, max_seq_len=MAX_SEQ_LEN, tokenizer=None
 ):
@@ -149,6 +126,98 @@ def extract_feature_sequence(
     return feature
 
 
+def feature_extractor_batch(tokenizer, texts_a, texts_b=None, max_length=512):
+    """Batched feature_extractor, one tokenizer call for the whole chunk"""
+    inputs = tokenizer(
+        texts_a,
+        texts_b,
+        add_special_tokens=True,
+        max_length=max_length,
+        truncation=True,
+        padding=False,
+    )
+    input_ids = inputs["input_ids"]
+    token_type_ids = (
+        inputs["token_type_ids"]
+        if "token_type_ids" in inputs
+        else [[0] * len(ids) for ids in input_ids]
+    )
+    attention_mask = inputs["attention_mask"]
+    return input_ids, attention_mask, token_type_ids
+
+
+def extract_features_chunk(
+    samples,
+    data_format=DataFormat.PremiseOnly,
+    max_seq_len=MAX_SEQ_LEN,
+    tokenizer=None,
+    lab_dict=None,
+):
+    if data_format in (DataFormat.PremiseOnly, DataFormat.PremiseAndOneHypothesis):
+        texts_b = (
+            [sample["hypothesis"] for sample in samples]
+            if data_format == DataFormat.PremiseAndOneHypothesis
+            else None
+        )
+        input_ids, input_mask, type_ids = feature_extractor_batch(
+            tokenizer,
+            [sample["premise"] for sample in samples],
+            texts_b,
+            max_length=max_seq_len,
+        )
+        return [
+            {
+                "uid": sample["uid"],
+                "label": sample["label"],
+                "token_id": input_ids[i],
+                "type_id": type_ids[i],
+                "attention_mask": input_mask[i],
+            }
+            for i, sample in enumerate(samples)
+        ]
+    elif data_format == DataFormat.PremiseAndMultiHypothesis:
+        return [
+            extract_feature_premise_and_multi_hypo(
+                sample, max_seq_len=max_seq_len, tokenizer=tokenizer
+            )
+            for sample in samples
+        ]
+    elif data_format == DataFormat.Seqence:
+        return [
+            extract_feature_sequence(
+                sample,
+                max_seq_len=max_seq_len,
+                tokenizer=tokenizer,
+                label_mapper=lab_dict,
+            )
+            for sample in samples
+        ]
+    else:
+        raise ValueError(data_format)
+
+
+# tokenizer of a pool worker, sent once by the pool initializer instead of with every chunk
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _extract_features_chunk_in_worker(samples, **kwargs):
+    return extract_features_chunk(samples, tokenizer=_worker_tokenizer, **kwargs)
+
+
+def iter_chunks(data, chunk_size):
+    data = iter(data)
+    while True:
+        chunk = list(islice(data, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def build_data(
     data,
     dump_path,
@@ -159,45 +228,57 @@ def build_data(
     do_padding=False,
     truncation=True,
     workers=1,
+    chunk_size=1000,
 ):
-    if data_format == DataFormat.PremiseOnly:
-        partial_feature = partial(
-            extract_feature_premise_only, max_seq_len=max_seq_len, tokenizer=tokenizer
-        )
-    elif data_format == DataFormat.PremiseAndOneHypothesis:
-        partial_feature = partial(
-            extract_feature_premise_and_one_hypo,
-            max_seq_len=max_seq_len,
-            tokenizer=tokenizer,
-        )
-    elif data_format == DataFormat.PremiseAndMultiHypothesis:
-        partial_feature = partial(
-            extract_feature_premise_and_multi_hypo,
-            max_seq_len=max_seq_len,
-            tokenizer=tokenizer,
-        )
-    elif data_format == DataFormat.Seqence:
-        partial_feature = partial(
-            extract_feature_sequence,
-            max_seq_len=max_seq_len,
-            tokenizer=tokenizer,
-            label_mapper=lab_dict,
-        )
-    else:
+    """Tokenize data (any iterable of rows) chunk by chunk and write the features
+    as they come, so memory stays bounded by a few chunks per worker.
+    """
+    if data_format not in (
+        DataFormat.PremiseOnly,
+        DataFormat.PremiseAndOneHypothesis,
+        DataFormat.PremiseAndMultiHypothesis,
+        DataFormat.Seqence,
+    ):
         raise ValueError(data_format)
+    kwargs = {
+        "data_format": data_format,
+        "max_seq_len": max_seq_len,
+        "lab_dict": lab_dict,
+    }
+    total = len(data) if hasattr(data, "__len__") else None
+    chunks = iter_chunks(data, chunk_size)
 
-    if workers > 1:
-        with multiprocessing.Pool(processes=workers) as pool:
-            features = pool.map(partial_feature, data)
-        logger.info("begin to write features")
-        with open(dump_path, "w", encoding="utf-8") as writer:
-            for feature in tqdm(features, total=len(features)):
-                writer.write("{}\n".format(json.dumps(feature)))
-    else:
-        with open(dump_path, "w", encoding="utf-8") as writer:
-            for sample in tqdm(data, total=len(data)):
-                feature = partial_feature(sample)
+    with open(dump_path, "w", encoding="utf-8") as writer, tqdm(total=total) as pbar:
+
+        def write(features):
+            for feature in features:
                 writer.write("{}\n".format(json.dumps(feature)))
+            pbar.update(len(features))
+
+        if workers > 1:
+            # Pool.imap would drain the input iterator up front, keep at most
+            # max_pending chunks in flight instead and write them in order
+            max_pending = 2 * workers
+            # each worker tokenizes on its own core, avoid the fork warning of
+            # the rust tokenizer thread pool
+            os.environ["TOKENIZERS_PARALLELISM"] = "false"
+            pending = deque()
+            with multiprocessing.Pool(
+                processes=workers, initializer=_init_worker, initargs=(tokenizer,)
+            ) as pool:
+                for chunk in chunks:
+                    pending.append(
+                        pool.apply_async(
+                            _extract_features_chunk_in_worker, (chunk,), kwargs
+                        )
+                    )
+                    if len(pending) >= max_pending:
+                        write(pending.popleft().get())
+                while pending:
+                    write(pending.popleft().get())
+        else:
+            for chunk in chunks:
+                write(extract_features_chunk(chunk, tokenizer=tokenizer, **kwargs))
 
 
 def parse_args():
@@ -217,6 +298,22 @@ def parse_args():
     )
     parser.add_argument("--transformer_cache", default=".cache", type=str)
     parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1000,
+        help="number of rows tokenized in one batched tokenizer call",
+    )
+    parser.add_argument(
+        "--mmap_on",
+        action="store_true",
+        help="also emit the memory-mapped binary format ({task}_{split}.mmap)",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="rebuild every split, even if its fingerprint is unchanged",
+    )
     args = parser.parse_args()
     return args
 
@@ -235,6 +332,10 @@ def main(args):
         os.makedirs(mt_dnn_root)
 
     task_defs = TaskDefs(args.task_def)
+    # fingerprints live outside of mt_dnn_root, which only holds the data files
+    fingerprint_dir = os.path.join(root, ".fingerprint", args.model)
+    tokenizer_info = tokenizer_fingerprint(tokenizer)
+    code_paths = [__file__, data_utils.__file__, tasks.__file__]
 
     for task in task_defs.get_task_names():
         task_def = task_defs.get_task_def(task)
@@ -244,17 +345,50 @@ def main(args):
             if not os.path.exists(file_path):
                 logger.warning("File %s doesnot exit")
                 sys.exit(1)
-            rows = load_data(file_path, task_def)
             dump_path = os.path.join(mt_dnn_root, "%s_%s.json" % (task, split_name))
-            logger.info(dump_path)
-            build_data(
-                rows,
-                dump_path,
-                tokenizer,
-                task_def.data_type,
-                lab_dict=task_def.label_vocab,
-                workers=args.workers,
+            fingerprint = compute_fingerprint(
+                [file_path],
+                code_paths,
+                tokenizer_info=tokenizer_info,
+                model=args.model,
+                max_seq_len=MAX_SEQ_LEN,
+                data_format=task_def.data_type,
+                task_type=task_def.task_type,
+                labels=task_def.label_vocab.get_vocab_list()
+                if task_def.label_vocab is not None
+                else None,
             )
+            if not args.overwrite and is_up_to_date(
+                dump_path, fingerprint, fingerprint_dir
+            ):
+                logger.info("%s is up to date, skip" % dump_path)
+            else:
+                logger.info(dump_path)
+                invalidate(dump_path, fingerprint_dir)
+                build_data(
+                    iter_data(file_path, task_def),
+                    dump_path,
+                    tokenizer,
+                    task_def.data_type,
+                    lab_dict=task_def.label_vocab,
+                    workers=args.workers,
+                    chunk_size=args.chunk_size,
+                )
+                save_fingerprint(dump_path, fingerprint, fingerprint_dir)
+            if args.mmap_on:
+                if task_def.data_type == DataFormat.PremiseAndMultiHypothesis:
+                    logger.warning(
+                        "Skip binary format of %s: ranking data is not supported"
+                        % dump_path
+                    )
+                    continue
+                mmap_header = os.path.join(get_mmap_path(dump_path), HEADER_FILE)
+                if os.path.exists(mmap_header) and os.path.getmtime(
+                    mmap_header
+                ) >= os.path.getmtime(dump_path):
+                    logger.info("%s is up to date, skip" % get_mmap_path(dump_path))
+                else:
+                    logger.info(dump_mmap_data(dump_path))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import argparse
+import os
+import torch
+from transformers import AutoTokenizer
+
+from data_utils.log_wrapper import create_logger
+from experiments.exp_def import TaskDefs, EncoderModelType
+from mt_dnn.model import MTDNNModel
+from mt_dnn.checkpoint import load_inference_checkpoint
+from mt_dnn.serving import InferenceService, make_server
+
+logger = create_logger(__name__, to_disk=False)
+
+parser = argparse.ArgumentParser(
+    description="Serve a checkpoint over http, scoring raw text in micro-batches."
+)
+parser.add_argument(
+    "--task_def", type=str, default="experiments/glue/glue_task_def.yml"
+)
+parser.add_argument(
+    "--tasks",
+    type=str,
+    default="mnli",
+    help="the tasks of the checkpoint, in the order of --train_datasets",
+)
+parser.add_argument(
+    "--checkpoint", default="mt_dnn_models/bert_model_base_uncased.pt", type=str
+)
+parser.add_argument(
+    "--model",
+    type=str,
+    default=None,
+    help="tokenizer of prepro_std.py, the init_checkpoint of the model by default",
+)
+parser.add_argument("--max_seq_len", type=int, default=512)
+parser.add_argument("--max_batch_size", type=int, default=32)
+parser.add_argument(
+    "--max_wait_ms",
+    type=float,
+    default=5.0,
+    help="how long a request waits for others to fill its micro-batch",
+)
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument(
+    "--unix_socket", type=str, default=None, help="listen on a unix socket instead"
+)
+parser.add_argument(
+    "--fp16", action="store_true", help="fp16 autocast for inference (GPU only)"
+)
+parser.add_argument(
+    "--bf16", action="store_true", help="bfloat16 autocast for inference"
+)
+parser.add_argument(
+    "--cuda",
+    type=bool,
+    default=torch.cuda.is_available(),
+    help="whether to use GPU acceleration.",
+)
+
+args = parser.parse_args()
+
+task_defs = TaskDefs(args.task_def)
+task_names = args.tasks.split(",")
+task_def_list = [task_defs.get_task_def(name.split("_")[0]) for name in task_names]
+
+assert os.path.exists(args.checkpoint)
+device = torch.device("cuda") if args.cuda else torch.device("cpu")
+state_dict = load_inference_checkpoint(args.checkpoint)
+config = state_dict["config"]
+config["cuda"] = args.cuda
+config["task_def_list"] = task_def_list
+config["fp16"] = args.fp16
+config["bf16"] = args.bf16
+config["answer_opt"] = 0
+config["adv_train"] = False
+model = MTDNNModel(config, device=device, state_dict=state_dict)
+
+tokenizer = AutoTokenizer.from_pretrained(args.model or config["init_checkpoint"])
+service = InferenceService(
+    model,
+    tokenizer,
+    task_names,
+    task_def_list,
+    max_seq_len=args.max_seq_len,
+    max_batch_size=args.max_batch_size,
+    max_wait=args.max_wait_ms / 1000,
+    encoder_type=config.get("encoder_type", EncoderModelType.BERT),
+)
+server = make_server(service, args.host, args.port, args.unix_socket)
+logger.info(
+    "serving {} on {}".format(
+        ",".join(task_names), args.unix_socket or "{}:{}".format(args.host, args.port)
+    )
+)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    service.close()
+    if args.unix_socket and os.path.exists(args.unix_socket):
+        os.remove(args.unix_socket)
+    logger.info("latency: {}".format(service.stats()))
@@ -115,10 +115,11 @@ class RegressionTask(MTDNNTask):
 
     @staticmethod
     def test_predict(score):
+        # numpy arrays, eval_model concatenates them once per evaluation
         score = score.data.cpu()
         score = score.numpy()
-        predict = np.argmax(score, axis=1).tolist()
-        score = score.reshape(-1).tolist()
+        predict = np.argmax(score, axis=1)
+        score = score.reshape(-1)
         return score, predict
 
 @register_task('Classification')
@@ -146,8 +147,8 @@ class ClassificationTask(MTDNNTask):
         score = F.softmax(score, dim=1)
         score = score.data.cpu()
         score = score.numpy()
-        predict = np.argmax(score, axis=1).tolist()
-        score = score.reshape(-1).tolist()
+        predict = np.argmax(score, axis=1)
+        score = score.reshape(-1)
         return score, predict
 
 # TODO
@@ -0,0 +1,107 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import re
+import json
+from transformers import BertTokenizerFast
+from data_utils import iter_data
+from data_utils.task_def import DataFormat
+from experiments.exp_def import TaskDefs
+from prepro_std import build_data, feature_extractor
+
+INPUT_DIR = "int_test_data/glue/input/prepro_std"
+
+
+# the per sample path build_data used before batching, kept as the reference
+def extract_feature_premise_only(sample, max_seq_len=512, tokenizer=None):
+    """extract feature of single sentence tasks"""
+    input_ids, input_mask, type_ids = feature_extractor(
+        tokenizer, sample["premise"], max_length=max_seq_len
+    )
+    feature = {
+        "uid": sample["uid"],
+        "label": sample["label"],
+        "token_id": input_ids,
+        "type_id": type_ids,
+        "attention_mask": input_mask,
+    }
+    return feature
+
+
+def extract_feature_premise_and_one_hypo(sample, max_seq_len=512, tokenizer=None):
+    input_ids, input_mask, type_ids = feature_extractor(
+        tokenizer,
+        sample["premise"],
+        text_b=sample["hypothesis"],
+        max_length=max_seq_len,
+    )
+    feature = {
+        "uid": sample["uid"],
+        "label": sample["label"],
+        "token_id": input_ids,
+        "type_id": type_ids,
+        "attention_mask": input_mask,
+    }
+    return feature
+
+
+def make_tokenizer(path, texts):
+    words = sorted({w for text in texts for w in re.findall(r"\w+|[^\w\s]", text)})
+    vocab_file = str(path / "vocab.txt")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words))
+    return BertTokenizerFast(vocab_file)
+
+
+def load_rows(task_def, file_name, n_copies=10):
+    """The rows of the input file n_copies times, with distinct uids"""
+    rows = list(iter_data("{}/{}".format(INPUT_DIR, file_name), task_def))
+    return [
+        dict(row, uid="{}-{}".format(copy, row["uid"]))
+        for copy in range(n_copies)
+        for row in rows
+    ]
+
+
+def read_lines(path):
+    with open(path, "r", encoding="utf-8") as reader:
+        return reader.readlines()
+
+
+def test_build_data(tmp_path):
+    task_defs = TaskDefs("{}/glue_task_def.yml".format(INPUT_DIR))
+    data = {
+        task: load_rows(task_defs.get_task_def(task), "{}_train.tsv".format(task))
+        for task in ("cola", "mnli", "stsb")
+    }
+    texts = [
+        row[field].lower()
+        for rows in data.values()
+        for row in rows
+        for field in ("premise", "hypothesis")
+        if field in row
+    ]
+    tokenizer = make_tokenizer(tmp_path, texts)
+    for task, rows in data.items():
+        task_def = task_defs.get_task_def(task)
+        if task_def.data_type == DataFormat.PremiseOnly:
+            extract_fn = extract_feature_premise_only
+        else:
+            extract_fn = extract_feature_premise_and_one_hypo
+        # truncates the longer mnli pairs
+        features = [
+            extract_fn(row, max_seq_len=32, tokenizer=tokenizer) for row in rows
+        ]
+        expected = ["{}\n".format(json.dumps(feature)) for feature in features]
+        for workers, chunk_size in ((1, 1000), (1, 7), (3, 4)):
+            dump_path = str(tmp_path / "{}_{}.json".format(task, workers))
+            build_data(
+                iter(rows),
+                dump_path,
+                tokenizer,
+                task_def.data_type,
+                max_seq_len=32,
+                lab_dict=task_def.label_vocab,
+                workers=workers,
+                chunk_size=chunk_size,
+            )
+            assert read_lines(dump_path) == expected
@@ -0,0 +1,84 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import torch
+from mt_dnn.checkpoint import CheckpointWriter, get_train_state_path
+from mt_dnn.checkpoint import export_inference_checkpoint, load_inference_checkpoint
+from tests.test_model import make_model, make_batches
+
+
+def test_checkpoint_writer(tmp_path):
+    writer = CheckpointWriter(keep_last=2, split_on=True)
+    weight = torch.zeros(3)
+    files = [str(tmp_path / "model_{}.pt".format(i)) for i in range(3)]
+    for i, filename in enumerate(files):
+        writer.save({"state": {"weight": weight}, "optimizer": {"step": i}}, filename)
+        # training goes on while the snapshot is written
+        weight += 1
+    writer.wait()
+    assert sorted(os.listdir(tmp_path)) == [
+        "model_1.optim.pt",
+        "model_1.pt",
+        "model_2.optim.pt",
+        "model_2.pt",
+    ]
+    state = torch.load(files[2])
+    assert torch.equal(state["state"]["weight"], torch.full((3,), 2.0))
+    assert "optimizer" not in state
+    assert torch.load(get_train_state_path(files[2])) == {"optimizer": {"step": 2}}
+
+
+def test_sync_checkpoint_writer(tmp_path):
+    writer = CheckpointWriter(async_on=False)
+    weight = torch.zeros(3)
+    state = {"state": {"weight": weight}, "optimizer": {"exp_avg": [weight]}}
+    # written in place, without copies of the cpu tensors or buffers kept around
+    snapshot = writer._snapshot(state, "")
+    assert snapshot["state"]["weight"].data_ptr() == weight.data_ptr()
+    assert snapshot["optimizer"]["exp_avg"][0].data_ptr() == weight.data_ptr()
+    filename = str(tmp_path / "model_0.pt")
+    writer.save(state, filename)
+    weight += 1
+    assert writer._buffers == {}
+    assert torch.equal(torch.load(filename)["state"]["weight"], torch.zeros(3))
+
+
+def test_save_load_split_checkpoint(tmp_path):
+    torch.manual_seed(0)
+    model = make_model(async_save_on=True, split_ckpt_on=True)
+    for batch_meta, batch_data in make_batches(model, 2):
+        model.update(batch_meta, batch_data)
+    filename = str(tmp_path / "model_0.pt")
+    model.save(filename)
+    model.wait_for_checkpoint()
+
+    resumed = make_model()
+    resumed.load(filename)
+    assert resumed.updates == model.updates
+    assert resumed.optimizer.state_dict()["state"].keys() == (
+        model.optimizer.state_dict()["state"].keys()
+    )
+    for p, q in zip(model.network.parameters(), resumed.network.parameters()):
+        assert torch.equal(p, q)
+
+
+def test_export_inference_checkpoint(tmp_path):
+    torch.manual_seed(0)
+    model = make_model()
+    for batch_meta, batch_data in make_batches(model, 2):
+        model.update(batch_meta, batch_data)
+    filename = str(tmp_path / "model_0.pt")
+    model.save(filename)
+    export_filename = str(tmp_path / "model_0.inference.pt")
+    export_inference_checkpoint(filename, export_filename)
+
+    # no pickled objects left, only weights and a plain config
+    state_dict = torch.load(export_filename, weights_only=True)
+    assert sorted(state_dict) == ["config", "state"]
+    assert "task_def_list" not in state_dict["config"]
+    state_dict = load_inference_checkpoint(export_filename)
+    config = dict(state_dict["config"], task_def_list=model.config["task_def_list"])
+    inference_model = make_model(**config)
+    inference_model.network.load_state_dict(state_dict["state"])
+    for p, q in zip(model.network.parameters(), inference_model.network.parameters()):
+        assert torch.equal(p, q)
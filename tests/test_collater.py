@@ -0,0 +1,250 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import random
+import timeit
+from functools import partial
+import numpy as np
+import torch
+from transformers import BertConfig
+from data_utils.task_def import DataFormat, EncoderModelType
+from experiments.exp_def import TaskDefs
+from mt_dnn.batcher import Collater
+from mt_dnn.matcher import SANBertNetwork
+
+
+def make_batch(batch_size, min_len=5, max_len=128, seed=0):
+    rng = random.Random(seed)
+    batch = []
+    for i in range(batch_size):
+        plen = rng.randint(2, min_len)
+        hlen = rng.randint(1, max_len - plen)
+        batch.append(
+            {
+                "uid": str(i),
+                "token_id": [rng.randint(1000, 30000) for _ in range(plen + hlen)],
+                "type_id": [0] * plen + [1] * hlen,
+                "label": rng.randint(0, 2),
+            }
+        )
+    return batch
+
+
+def prepare_model_input_per_sample(collater, batch, data_type):
+    """Reference implementation of Collater._prepare_model_input, sample by sample"""
+    batch_size = collater._get_batch_size(batch)
+    tok_len = collater._get_max_len(batch, key="token_id")
+    if collater.encoder_type == EncoderModelType.ROBERTA:
+        token_ids = torch.LongTensor(batch_size, tok_len).fill_(1)
+        type_ids = torch.LongTensor(batch_size, tok_len).fill_(0)
+        masks = torch.LongTensor(batch_size, tok_len).fill_(0)
+    else:
+        token_ids = torch.LongTensor(batch_size, tok_len).fill_(0)
+        type_ids = torch.LongTensor(batch_size, tok_len).fill_(0)
+        masks = torch.LongTensor(batch_size, tok_len).fill_(0)
+    if collater.__if_pair__(data_type):
+        hypothesis_masks = torch.BoolTensor(batch_size, tok_len).fill_(1)
+        premise_masks = torch.BoolTensor(batch_size, tok_len).fill_(1)
+    for i, sample in enumerate(batch):
+        select_len = min(len(sample["token_id"]), tok_len)
+        tok = sample["token_id"]
+        token_ids[i, :select_len] = torch.LongTensor(tok[:select_len])
+        type_ids[i, :select_len] = torch.LongTensor(sample["type_id"][:select_len])
+        masks[i, :select_len] = torch.LongTensor([1] * select_len)
+        if collater.__if_pair__(data_type):
+            plen = len(sample["type_id"]) - sum(sample["type_id"])
+            premise_masks[i, :plen] = torch.LongTensor([0] * plen)
+            for j in range(plen, select_len):
+                hypothesis_masks[i, j] = 0
+    collater._word_dropout(token_ids.numpy(), masks.numpy())
+    if collater.__if_pair__(data_type):
+        batch_info = {
+            "token_id": 0,
+            "segment_id": 1,
+            "mask": 2,
+            "premise_mask": 3,
+            "hypothesis_mask": 4,
+        }
+        batch_data = [token_ids, type_ids, masks, premise_masks, hypothesis_masks]
+    else:
+        batch_info = {"token_id": 0, "segment_id": 1, "mask": 2}
+        batch_data = [token_ids, type_ids, masks]
+    return batch_info, batch_data
+
+
+def assert_same_model_input(collater, batch, data_type):
+    info, data = collater._prepare_model_input(batch, data_type)
+    ref_info, ref_data = prepare_model_input_per_sample(collater, batch, data_type)
+    assert info == ref_info
+    assert len(data) == len(ref_data)
+    for part, ref_part in zip(data, ref_data):
+        assert part.dtype == ref_part.dtype
+        assert torch.equal(part, ref_part)
+
+
+def test_prepare_model_input():
+    batch = make_batch(32)
+    for encoder_type in (EncoderModelType.BERT, EncoderModelType.ROBERTA):
+        for data_type in (DataFormat.PremiseOnly, DataFormat.PremiseAndOneHypothesis):
+            for do_padding in (False, True):
+                collater = Collater(
+                    is_train=False,
+                    encoder_type=encoder_type,
+                    max_seq_len=64,
+                    do_padding=do_padding,
+                )
+                assert_same_model_input(collater, batch, data_type)
+
+
+def test_prepare_model_input_word_dropout():
+    # (cls, sep, unk) ids of the vocabularies
+    for encoder_type, (cls_id, sep_id, unk_id) in (
+        (EncoderModelType.BERT, (101, 102, 100)),
+        (EncoderModelType.ROBERTA, (0, 2, 3)),
+        (EncoderModelType.XLM, (0, 2, 3)),
+        (EncoderModelType.DEBERTA, (1, 2, 3)),
+    ):
+        batch = make_batch(64)
+        for sample in batch:
+            sample["token_id"][0] = cls_id
+            sample["token_id"][-1] = sep_id
+        collater = Collater(is_train=True, dropout_w=0.1, encoder_type=encoder_type)
+        np.random.seed(1)
+        _, data = collater._prepare_model_input(batch, DataFormat.PremiseOnly)
+        np.random.seed(1)
+        _, ref_data = prepare_model_input_per_sample(
+            collater, batch, DataFormat.PremiseOnly
+        )
+        assert torch.equal(data[0], ref_data[0])
+
+        _, clean_data = Collater(
+            is_train=False, encoder_type=encoder_type
+        )._prepare_model_input(batch, DataFormat.PremiseOnly)
+        dropped = data[0] != clean_data[0]
+        assert (data[0][dropped] == unk_id).all()
+        # padding and special tokens are kept
+        assert not dropped[clean_data[2] == 0].any()
+        assert not dropped[(clean_data[0] == cls_id) | (clean_data[0] == sep_id)].any()
+        rate = dropped.sum().item() / clean_data[2].sum().item()
+        assert 0.07 < rate < 0.13
+
+
+def test_packed_forward():
+    torch.manual_seed(0)
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    opt = BertConfig(
+        vocab_size=30522,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+    ).to_dict()
+    opt.update(
+        encoder_type=EncoderModelType.BERT,
+        update_bert_opt=0,
+        task_def_list=[task_def],
+        answer_opt=0,
+        dropout_p=0.0,
+        vb_dropout=True,
+        pooler_actf="tanh",
+    )
+    network = SANBertNetwork(opt, initial_from_local=True).eval()
+    batch = [
+        {"task": {"task_id": 0, "task_def": task_def}, "sample": sample}
+        for sample in make_batch(9, max_len=30)
+    ]
+    info, data = Collater(is_train=False).collate_fn(batch)
+    packed_info, packed_data = Collater(
+        is_train=False, max_seq_len=64, packing_on=True
+    ).collate_fn(batch)
+    # never more rows, nor longer rows, than the padded batch
+    assert packed_data[0].size(0) < data[0].size(0)
+    assert packed_data[0].size(1) <= data[0].size(1)
+    assert packed_info["uids"] == info["uids"]
+    with torch.no_grad():
+        logits = network(*data[:3], None, None, 0)
+        packed_logits = network(
+            *packed_data[:3],
+            None,
+            None,
+            0,
+            position_ids=packed_data[packed_info["position_id"]],
+            cls_index=packed_data[packed_info["cls_index"]],
+        )
+    assert torch.allclose(logits, packed_logits, atol=1e-5)
+
+
+def test_packing_unsupported():
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    assert Collater(packing_on=True).__if_packable__(task_def)
+    # no position ids
+    for encoder_type in (EncoderModelType.XLNET, EncoderModelType.SAN):
+        collater = Collater(packing_on=True, encoder_type=encoder_type)
+        assert not collater.__if_packable__(task_def)
+    # the SAN decoder reads every token, not one CLS state per sample
+    task_def.enable_san = True
+    assert not Collater(packing_on=True).__if_packable__(task_def)
+
+
+def benchmark_prepare_model_input(batch_size=32, number=200):
+    batch = make_batch(batch_size, min_len=64, max_len=512)
+    collater = Collater(is_train=False)
+    for name, fn in (
+        ("per sample", partial(prepare_model_input_per_sample, collater)),
+        ("vectorized", collater._prepare_model_input),
+    ):
+        cost = timeit.timeit(
+            lambda: fn(batch, DataFormat.PremiseAndOneHypothesis), number=number
+        )
+        print("{}: {:.3f} ms/batch".format(name, cost * 1000 / number))
+
+
+def benchmark_packed_training(batch_size=32, n_batches=10, number=2):
+    """Training samples/sec with and without packing, on long tailed lengths"""
+    from tests.test_model import make_model
+
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("mnli")
+    rng = np.random.RandomState(0)
+    batches = []
+    for b in range(n_batches):
+        # mostly short samples and a few long ones, as in GLUE
+        lengths = np.clip(rng.lognormal(3.3, 0.6, batch_size), 8, 256).astype(int)
+        lengths[0] = 256
+        samples = make_batch(batch_size, max_len=256, seed=b)
+        for sample, length in zip(samples, lengths):
+            sample["token_id"] = sample["token_id"][:length]
+            sample["type_id"] = sample["type_id"][:length]
+        batches.append(
+            [
+                {"task": {"task_id": 0, "task_def": task_def}, "sample": sample}
+                for sample in samples
+            ]
+        )
+    for packing_on in (False, True):
+        torch.manual_seed(0)
+        model = make_model(
+            task_names=("mnli",),
+            vocab_size=30522,
+            hidden_size=256,
+            num_hidden_layers=4,
+            num_attention_heads=4,
+            intermediate_size=1024,
+        )
+        collater = Collater(dropout_w=0.0, max_seq_len=512, packing_on=packing_on)
+        collated = [collater.collate_fn(batch) for batch in batches]
+
+        def train():
+            for batch_meta, batch_data in collated:
+                model.update(batch_meta, batch_data)
+
+        train()
+        cost = timeit.timeit(train, number=number)
+        print(
+            "packing_on={}: {:.0f} samples/s".format(
+                packing_on, number * n_batches * batch_size / cost
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark_prepare_model_input()
+    benchmark_packed_training()
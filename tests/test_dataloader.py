@@ -0,0 +1,156 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import json
+import random
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from experiments.exp_def import TaskDefs
+from mt_dnn.batcher import (
+    SingleTaskDataset,
+    MultiTaskDataset,
+    MultiTaskBatchSampler,
+    FusedTaskBatchSampler,
+    Collater,
+    DevicePrefetcher,
+    worker_init_fn,
+)
+
+
+class RngDataset(SingleTaskDataset):
+    def __getitem__(self, idx):
+        return self._rng.random()
+
+
+def load_rte(
+    path="tests/sample_data/output/rte_dev.json", dataset_cls=SingleTaskDataset
+):
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    return dataset_cls(path, False, task_def=task_def)
+
+
+def test_worker_rng():
+    dataset = load_rte(dataset_cls=RngDataset)
+    # the two workers take the samples in turn
+    draws = list(
+        DataLoader(
+            dataset,
+            sampler=range(4),
+            num_workers=2,
+            worker_init_fn=worker_init_fn,
+        )
+    )
+    assert draws[0] != draws[1]
+    assert draws[0] != draws[2]
+
+
+def write_rte(path, n_samples=50):
+    with open(path, "w", encoding="utf-8") as writer:
+        for i in range(n_samples):
+            sample = {"uid": str(i), "label": i % 2, "token_id": [101] * (i + 2)}
+            sample["type_id"] = [0] * len(sample["token_id"])
+            writer.write("{}\n".format(json.dumps(sample)))
+
+
+def test_multi_worker_batches(tmp_path):
+    path = str(tmp_path / "rte_train.json")
+    write_rte(path)
+    dataset = load_rte(path)
+    random.seed(0)
+    sampler = MultiTaskBatchSampler([dataset], 4, 0, 0)
+    collater = Collater(is_train=False)
+    loaders = [
+        DataLoader(
+            MultiTaskDataset([dataset]),
+            batch_sampler=sampler,
+            collate_fn=collater.collate_fn,
+            **kwargs
+        )
+        for kwargs in (
+            {},
+            {
+                "num_workers": 2,
+                "prefetch_factor": 2,
+                "persistent_workers": True,
+                "worker_init_fn": worker_init_fn,
+            },
+        )
+    ]
+    for (info, data), (ref_info, ref_data) in zip(*loaders):
+        assert info["uids"] == ref_info["uids"]
+        for part, ref_part in zip(data, ref_data):
+            assert torch.equal(part, ref_part)
+
+
+def test_device_prefetcher():
+    batches = [
+        ({"uids": [i], "soft_label": torch.rand(1, 2)}, [torch.full((1, 3), i), None])
+        for i in range(5)
+    ]
+    pulled = []
+
+    def loader():
+        for batch in batches:
+            pulled.append(batch)
+            yield batch
+
+    # on cpu batches pass through untouched
+    for (info, data), (ref_info, ref_data) in zip(
+        DevicePrefetcher(batches, "cpu"), batches
+    ):
+        assert data[0] is ref_data[0]
+    # "meta" stands in for an accelerator: copies are issued depth batches ahead
+    for i, (info, data) in enumerate(DevicePrefetcher(loader(), "meta", depth=2)):
+        assert info["uids"] == [i]
+        assert data[0].device.type == "meta" and data[1] is None
+        assert info["soft_label"].device.type == "meta"
+        assert len(pulled) == min(i + 3, len(batches))
+
+
+def test_resume_sampler(tmp_path):
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    path = str(tmp_path / "rte_train.json")
+    write_rte(path, 20)
+    datasets = [
+        SingleTaskDataset(path, True, task_id=i, task_def=task_def) for i in range(2)
+    ]
+
+    def make_sampler(fused_batch_num=1, **kwargs):
+        random.seed(0)
+        np.random.seed(0)
+        sampler = MultiTaskBatchSampler(datasets, 2, 0, 0, **kwargs)
+        if fused_batch_num > 1:
+            sampler = FusedTaskBatchSampler(sampler, fused_batch_num)
+        return sampler
+
+    for fused_batch_num, kwargs in (
+        (1, {}),
+        (1, {"task_sampling": "uniform"}),
+        (2, {}),
+    ):
+        sampler = make_sampler(fused_batch_num, **kwargs)
+        epochs = []
+        for epoch in range(2):
+            sampler.set_epoch(epoch)
+            epochs.append(list(sampler))
+        assert epochs[0] != epochs[1]
+
+        # preempted after 3 batches of the first epoch
+        sampler = make_sampler(fused_batch_num, **kwargs)
+        sampler.set_epoch(0)
+        for position, batch in enumerate(sampler, 1):
+            sampler.set_position(position)
+            if position == 3:
+                break
+        state = sampler.state_dict()
+        sampler = make_sampler(fused_batch_num, **kwargs)
+        sampler.load_state_dict(state)
+        sampler.set_epoch(0)
+        assert list(sampler) == epochs[0][3:]
+        # saved at the end of the epoch, the next one follows
+        sampler.set_position(len(sampler))
+        state = sampler.state_dict()
+        sampler = make_sampler(fused_batch_num, **kwargs)
+        sampler.load_state_dict(state)
+        sampler.set_epoch(1)
+        assert list(sampler) == epochs[1]
@@ -0,0 +1,91 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import timeit
+import numpy as np
+import torch
+from data_utils.metrics import Metric
+from mt_dnn.encoder_cache import EncoderCache
+from mt_dnn.inference import eval_model
+from tests.test_model import make_model, make_batches
+
+
+def predict_all(model, batches):
+    with torch.no_grad():
+        return np.concatenate(
+            [model.predict(meta, list(data))[0] for meta, data in batches]
+        )
+
+
+def test_encoder_cache(tmp_path):
+    torch.manual_seed(0)
+    ref_model = make_model()
+    torch.manual_seed(0)
+    model = make_model(encoder_cache_mb=1, encoder_cache_dir=str(tmp_path))
+    cache = model.network.encoder_cache
+    batches = make_batches(model, 3, is_train=False)
+    ref_scores = predict_all(ref_model, batches)
+    assert np.allclose(predict_all(model, batches), ref_scores, atol=1e-6)
+    assert (cache.hits, cache.misses) == (0, 24)
+    # the second pass runs the heads only
+    assert np.allclose(predict_all(model, batches), ref_scores, atol=1e-6)
+    assert (cache.hits, cache.misses) == (24, 24)
+
+    # a new process with the same weights reads the states from disk
+    torch.manual_seed(0)
+    model = make_model(encoder_cache_mb=1, encoder_cache_dir=str(tmp_path))
+    assert np.allclose(predict_all(model, batches), ref_scores, atol=1e-6)
+    assert model.network.encoder_cache.hits == 24
+
+    # an update of the encoder invalidates the cache
+    for batch_meta, batch_data in make_batches(model, 1):
+        model.update(batch_meta, batch_data)
+    fingerprint = model.network.encoder_cache.fingerprint
+    predict_all(model, batches)
+    assert model.network.encoder_cache.fingerprint != fingerprint
+    assert model.network.encoder_cache.misses == 24
+
+
+def test_encoder_cache_eviction():
+    hidden_size = 4
+    cache = EncoderCache(max_bytes=3 * 10 * hidden_size * 4)
+    encoder = torch.nn.Linear(1, hidden_size)
+
+    def encode_fn(input_ids, token_type_ids, attention_mask):
+        return input_ids.float().unsqueeze(-1).expand(-1, -1, hidden_size)
+
+    input_ids = torch.arange(50).reshape(5, 10)
+    output = cache.encode(encode_fn, encoder, input_ids, None, None)
+    assert torch.equal(output, encode_fn(input_ids, None, None))
+    # the 3 most recent samples fit
+    assert len(cache._entries) == 3 and cache._bytes <= cache.max_bytes
+    cache.encode(encode_fn, encoder, input_ids[2:], None, None)
+    assert (cache.hits, cache.misses) == (3, 5)
+
+
+def benchmark_frozen_encoder_eval(n_batches=20, batch_size=32, number=3):
+    """Repeated evaluation on a frozen encoder, as in train.py with --update_bert_opt 1"""
+    for encoder_cache_mb in (0, 512):
+        torch.manual_seed(0)
+        model = make_model(
+            hidden_size=256,
+            num_hidden_layers=6,
+            num_attention_heads=4,
+            intermediate_size=1024,
+            update_bert_opt=1,
+            encoder_cache_mb=encoder_cache_mb,
+        )
+        batches = make_batches(model, n_batches, batch_size, is_train=False)
+        with torch.no_grad():
+            eval_model(model, batches, [Metric.ACC], "cpu")
+            cost = timeit.timeit(
+                lambda: eval_model(model, batches, [Metric.ACC], "cpu"), number=number
+            )
+        print(
+            "encoder_cache_mb {:>3}: {:.0f} ms per evaluation of {} samples".format(
+                encoder_cache_mb, cost * 1000 / number, n_batches * batch_size
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark_frozen_encoder_eval()
@@ -0,0 +1,136 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import argparse
+import prepro_std
+from data_utils.prepro_cache import (
+    compute_fingerprint,
+    is_up_to_date,
+    save_fingerprint,
+)
+from tests.test_serving import make_tokenizer, WORDS
+
+TASK_DEF = """rte:
+  data_format: PremiseAndOneHypothesis
+  enable_san: false
+  labels:
+  - not_entailment
+  - entailment
+  metric_meta:
+  - ACC
+  loss: CeCriterion
+  n_class: 2
+  split_names:
+  - train
+  - dev
+  task_type: Classification
+"""
+
+
+def write_split(path, n_samples, offset=0):
+    with open(path, "w", encoding="utf-8") as writer:
+        for i in range(offset, offset + n_samples):
+            premise = " ".join(WORDS[j % len(WORDS)] for j in range(i, i + 5))
+            label = "entailment" if i % 2 else "not_entailment"
+            writer.write("{}\t{}\t{}\t{}\n".format(i, label, premise, "the cat"))
+
+
+def setup_root(path):
+    """data/rte_{train,dev}.tsv, the task def and a local tokenizer tok/"""
+    os.makedirs(path / "data")
+    write_split(path / "data" / "rte_train.tsv", 20)
+    write_split(path / "data" / "rte_dev.tsv", 10)
+    with open(path / "task_def.yml", "w") as f:
+        f.write(TASK_DEF)
+    make_tokenizer(path).save_pretrained(str(path / "tok"))
+
+
+def run(monkeypatch, overwrite=False):
+    """prepro_std.main on the cwd, returns the names of the rebuilt splits"""
+    built = []
+    build_data = prepro_std.build_data
+
+    def spy(data, dump_path, *args, **kwargs):
+        built.append(os.path.basename(dump_path))
+        return build_data(data, dump_path, *args, **kwargs)
+
+    monkeypatch.setattr(prepro_std, "build_data", spy)
+    args = argparse.Namespace(
+        model="tok",
+        do_padding=False,
+        root_dir="data",
+        task_def="task_def.yml",
+        transformer_cache=".cache",
+        workers=1,
+        chunk_size=1000,
+        mmap_on=False,
+        overwrite=overwrite,
+    )
+    prepro_std.main(args)
+    return sorted(built)
+
+
+def test_skip_unchanged(tmp_path, monkeypatch):
+    setup_root(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    assert run(monkeypatch) == ["rte_dev.json", "rte_train.json"]
+    assert run(monkeypatch) == []
+    # the output directory only holds the data files
+    assert sorted(os.listdir("data/tok")) == ["rte_dev.json", "rte_train.json"]
+    assert os.path.exists("data/.fingerprint/tok/rte_dev.json.fingerprint")
+
+
+def test_rebuild_on_change(tmp_path, monkeypatch):
+    setup_root(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    run(monkeypatch)
+
+    write_split(tmp_path / "data" / "rte_dev.tsv", 10, offset=1)
+    assert run(monkeypatch) == ["rte_dev.json"]
+
+    # a new tokenizer revision, with one more word
+    tokenizer = make_tokenizer(tmp_path)
+    tokenizer.add_tokens(["bird"])
+    tokenizer.save_pretrained(str(tmp_path / "tok"))
+    assert run(monkeypatch) == ["rte_dev.json", "rte_train.json"]
+
+    monkeypatch.setattr(prepro_std, "MAX_SEQ_LEN", 256)
+    assert run(monkeypatch) == ["rte_dev.json", "rte_train.json"]
+    assert run(monkeypatch) == []
+
+
+def test_rebuild_on_code_change(tmp_path):
+    input_path, code_path = str(tmp_path / "input.tsv"), str(tmp_path / "code.py")
+    output_path = str(tmp_path / "output.json")
+    fingerprint_dir = str(tmp_path / ".fingerprint")
+    for path in (input_path, code_path, output_path):
+        with open(path, "w") as f:
+            f.write("0")
+    fingerprint = compute_fingerprint([input_path], [code_path], max_seq_len=512)
+    save_fingerprint(output_path, fingerprint, fingerprint_dir)
+    assert is_up_to_date(output_path, fingerprint, fingerprint_dir)
+
+    with open(code_path, "w") as f:
+        f.write("1")
+    fingerprint = compute_fingerprint([input_path], [code_path], max_seq_len=512)
+    assert not is_up_to_date(output_path, fingerprint, fingerprint_dir)
+
+
+def test_rebuild_on_overwrite(tmp_path, monkeypatch):
+    setup_root(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    run(monkeypatch)
+    assert run(monkeypatch, overwrite=True) == ["rte_dev.json", "rte_train.json"]
+
+
+def test_rebuild_missing_output(tmp_path, monkeypatch):
+    setup_root(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    run(monkeypatch)
+    with open("data/tok/rte_train.json") as f:
+        expected = f.read()
+    # the fingerprint is still there and matches
+    os.remove("data/tok/rte_train.json")
+    assert run(monkeypatch) == ["rte_train.json"]
+    with open("data/tok/rte_train.json") as f:
+        assert f.read() == expected
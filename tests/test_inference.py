@@ -0,0 +1,114 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import json
+import time
+import numpy as np
+import torch
+from data_utils.encoding_store import EncodingStore
+from data_utils.metrics import Metric, calc_metrics
+from experiments.exp_def import TaskDefs
+from mt_dnn.inference import dump_encoding, eval_model, extract_encoding, merge, to_json
+import tasks
+from tests.test_model import make_model, make_batches
+
+
+class ScoreModel(object):
+    """Stands in for MTDNNModel.predict with precomputed logits"""
+
+    def __init__(self, task_obj):
+        self.task_obj = task_obj
+
+    def predict(self, batch_info, batch_data):
+        score, predict = self.task_obj.test_predict(batch_data[0])
+        return score, predict, batch_info["label"]
+
+
+def make_score_batches(n_samples, batch_size=256, n_class=3, seed=0):
+    rng = np.random.RandomState(seed)
+    batches = []
+    for start in range(0, n_samples, batch_size):
+        size = min(batch_size, n_samples - start)
+        logits = torch.from_numpy(rng.randn(size, n_class).astype(np.float32))
+        batch_info = {
+            "uids": [str(uid) for uid in range(start, start + size)],
+            "label": rng.randint(n_class, size=size).tolist(),
+        }
+        batches.append((batch_info, [logits]))
+    return batches
+
+
+def eval_model_lists(model, data, metric_meta):
+    """eval_model before the results were kept in numpy arrays"""
+    predictions, golds, scores, ids = [], [], [], []
+    for batch_info, batch_data in data:
+        score, pred, gold = model.predict(batch_info, batch_data)
+        scores = merge(score.tolist(), scores)
+        golds = merge(gold, golds)
+        predictions = merge(pred.tolist(), predictions)
+        ids = merge(batch_info["uids"], ids)
+    metrics = calc_metrics(metric_meta, golds, predictions, scores)
+    return metrics, predictions, scores, golds, ids
+
+
+def test_eval_model_arrays():
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("mnli")
+    model = ScoreModel(tasks.get_task_obj(task_def))
+    data = make_score_batches(1000, batch_size=64)
+    metric_meta = [Metric.ACC, Metric.F1MAC]
+    results = eval_model(model, data, metric_meta, torch.device("cpu"))
+    ref_results = eval_model_lists(model, data, metric_meta)
+    assert results[0] == ref_results[0]
+    for result, ref_result in zip(results[1:], ref_results[1:]):
+        assert json.dumps(result, default=to_json) == json.dumps(ref_result)
+
+
+def test_dump_encoding(tmp_path):
+    torch.manual_seed(0)
+    model = make_model()
+    batches = make_batches(model, 3, is_train=False)
+    with torch.no_grad():
+        encoding = extract_encoding(model, batches, use_cuda=False)
+        path = dump_encoding(
+            model, batches, str(tmp_path / "rte_encoding.mmap"), use_cuda=False
+        )
+    store = EncodingStore(path)
+    uids = sum((batch_meta["uids"] for batch_meta, _ in batches), [])
+    lengths = torch.cat([data[meta["mask"]].sum(1) for meta, data in batches])
+    assert len(store) == len(uids) and store.uids == uids
+    assert store.lengths().tolist() == lengths.tolist()
+    for idx, (uid, length) in enumerate(zip(uids, lengths.tolist())):
+        assert np.allclose(store.get(uid), encoding[idx, :length].numpy(), atol=1e-6)
+
+    # half precision halves the store
+    with torch.no_grad():
+        path = dump_encoding(
+            model,
+            batches,
+            str(tmp_path / "rte_fp16.mmap"),
+            use_cuda=False,
+            dtype=np.float16,
+        )
+    fp16_store = EncodingStore(path)
+    assert fp16_store[0].dtype == np.float16
+    assert np.allclose(fp16_store[0], store[0], atol=1e-2)
+
+
+def benchmark_eval_model(n_samples=1000000):
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("mnli")
+    model = ScoreModel(tasks.get_task_obj(task_def))
+    data = make_score_batches(n_samples)
+    for name, evaluate in (
+        ("lists", lambda: eval_model_lists(model, data, [Metric.ACC])),
+        ("arrays", lambda: eval_model(model, data, [Metric.ACC], "cpu")),
+    ):
+        start = time.perf_counter()
+        evaluate()
+        print(
+            "{} accumulation: {:.2f} s for {} samples".format(
+                name, time.perf_counter() - start, n_samples
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark_eval_model()
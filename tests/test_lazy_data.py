@@ -0,0 +1,59 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import pickle
+import shutil
+from experiments.exp_def import TaskDefs
+from data_utils.jsonl_index import get_index_path
+from torch.utils.data import DataLoader
+from mt_dnn.batcher import SingleTaskDataset, LazySingleTaskDataset
+from tests.test_dataloader import write_rte
+
+
+def test_lazy_single_task_dataset(tmp_path):
+    path = str(tmp_path / "rte_dev.json")
+    shutil.copy("tests/sample_data/output/rte_dev.json", path)
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    dataset = SingleTaskDataset(path, False, task_def=task_def)
+    lazy_dataset = LazySingleTaskDataset(path, task_def=task_def)
+    assert os.path.exists(get_index_path(path))
+    assert len(lazy_dataset) == len(dataset)
+    # workers receive a pickled copy holding the index but no open file
+    lazy_dataset[0]
+    lazy_dataset = pickle.loads(pickle.dumps(lazy_dataset))
+    for idx in reversed(range(len(dataset))):
+        assert lazy_dataset[idx] == dataset[idx]
+
+    # the persisted index is rebuilt once the data file changes
+    with open(path, "a", encoding="utf-8") as writer:
+        writer.write('{"uid": "extra", "label": 0, "token_id": [101, 102]}')
+    os.utime(path, (0, os.path.getmtime(get_index_path(path)) + 1))
+    lazy_dataset = LazySingleTaskDataset(path, task_def=task_def)
+    assert len(lazy_dataset) == len(dataset) + 1
+    assert lazy_dataset[len(dataset)]["sample"]["uid"] == "extra"
+
+
+class ReaderDataset(LazySingleTaskDataset):
+    def __getitem__(self, idx):
+        sample = super().__getitem__(idx)["sample"]
+        return sample["uid"], self._data._reader.fileno()
+
+
+def test_lazy_data_forked_workers(tmp_path):
+    path = str(tmp_path / "rte_dev.json")
+    write_rte(path, n_samples=2000)
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    dataset = ReaderDataset(path, task_def=task_def, printable=False)
+    # the parent opens the file before the workers are forked
+    _, parent_fileno = dataset[0]
+    loader = DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=4,
+        multiprocessing_context="fork",
+    )
+    samples = list(loader)
+    assert [uid for uid, _ in samples] == [str(i) for i in range(2000)]
+    assert all(fileno != parent_fileno for _, fileno in samples)
+    # the parent handle is still at its own position
+    assert dataset[1] == ("1", parent_fileno)
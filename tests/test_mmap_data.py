@@ -0,0 +1,49 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import pickle
+import numpy as np
+from experiments.exp_def import TaskDefs
+from data_utils.mmap_data import dump_mmap_data
+from mt_dnn.batcher import SingleTaskDataset, MMapSingleTaskDataset
+from tests.test_dataloader import write_rte
+
+
+def to_lists(sample):
+    return {
+        k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in sample.items()
+    }
+
+
+def test_mmap_round_trip(tmp_path):
+    path = str(tmp_path / "rte_train.json")
+    # token lengths 2 .. 51
+    write_rte(path)
+    mmap_path = dump_mmap_data(path)
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    for is_train in (True, False):
+        kwargs = {"maxlen": 20, "factor": 0.5, "task_id": 3, "task_def": task_def}
+        dataset = SingleTaskDataset(path, is_train, **kwargs)
+        mmap_dataset = MMapSingleTaskDataset(mmap_path, is_train, **kwargs)
+        # workers receive a pickled copy without the mappings
+        mmap_dataset[0]
+        mmap_dataset = pickle.loads(pickle.dumps(mmap_dataset))
+        assert len(mmap_dataset) == len(dataset) == (19 if is_train else 50)
+        assert np.array_equal(mmap_dataset.get_lengths(), dataset.get_lengths())
+        for idx in range(len(dataset)):
+            expected, sample = dataset[idx], mmap_dataset[idx]
+            assert sample["task"] == expected["task"]
+            assert to_lists(sample["sample"]) == expected["sample"]
+
+
+def test_mmap_attention_mask(tmp_path):
+    """attention_mask is not stored, the collater derives it from token_id"""
+    path = "tests/sample_data/output/rte_dev.json"
+    mmap_path = dump_mmap_data(path, str(tmp_path / "rte_dev.mmap"))
+    task_def = TaskDefs("experiments/glue/glue_task_def.yml").get_task_def("rte")
+    dataset = SingleTaskDataset(path, False, task_def=task_def)
+    mmap_dataset = MMapSingleTaskDataset(mmap_path, False, task_def=task_def)
+    assert len(mmap_dataset) == len(dataset)
+    for idx in range(len(dataset)):
+        expected = dict(dataset[idx]["sample"])
+        assert expected.pop("attention_mask") == [1] * len(expected["token_id"])
+        assert to_lists(mmap_dataset[idx]["sample"]) == expected
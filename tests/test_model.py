@@ -0,0 +1,439 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import time
+import random
+import timeit
+import tempfile
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+from transformers import BertConfig, PreTrainedModel
+from data_utils.task_def import EncoderModelType
+from experiments.exp_def import TaskDefs
+from mt_dnn.batcher import Collater
+from mt_dnn.model import MTDNNModel
+
+
+def make_model(task_names=("rte",), **kwargs):
+    task_defs = TaskDefs("experiments/glue/glue_task_def.yml")
+    opt = BertConfig(
+        vocab_size=1000,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+    ).to_dict()
+    opt.update(
+        encoder_type=EncoderModelType.BERT,
+        # a local directory without tokenizer files, nothing is downloaded
+        init_checkpoint="tests/sample_data",
+        transformer_cache=None,
+        update_bert_opt=0,
+        task_def_list=[task_defs.get_task_def(name) for name in task_names],
+        answer_opt=0,
+        dropout_p=0.0,
+        vb_dropout=True,
+        pooler_actf="tanh",
+        cuda=False,
+        local_rank=-1,
+        multi_gpu_on=False,
+        optimizer="adam",
+        learning_rate=1e-3,
+        weight_decay=0.0,
+        scheduler_type=2,
+        warmup=0,
+        bin_on=False,
+        batch_size=8,
+        global_grad_clipping=1.0,
+        grad_accumulation_step=1,
+        fp16=False,
+        bf16=False,
+    )
+    opt.update(kwargs)
+    # an empty state dict keeps the encoder from being downloaded
+    return MTDNNModel(opt, device=torch.device("cpu"), state_dict={"state": {}})
+
+
+def make_samples(model, rng, batch_size=8, task_id=0):
+    task_def = model.config["task_def_list"][task_id]
+    samples = []
+    for _ in range(batch_size):
+        length = rng.randint(4, 24)
+        sample = {
+            "uid": str(rng.random()),
+            "token_id": [rng.randint(103, 999) for _ in range(length)],
+            "type_id": [0] * (length // 2) + [1] * (length - length // 2),
+            "label": rng.randint(0, 1),
+        }
+        samples.append(
+            {"task": {"task_id": task_id, "task_def": task_def}, "sample": sample}
+        )
+    return samples
+
+
+def make_batches(model, n_batches, batch_size=8, task_id=0, is_train=True, seed=0):
+    rng = random.Random(seed)
+    collater = Collater(is_train=is_train, dropout_w=0.0)
+    return [
+        collater.collate_fn(make_samples(model, rng, batch_size, task_id))
+        for _ in range(n_batches)
+    ]
+
+
+def test_bf16_autocast_on_cpu():
+    torch.manual_seed(0)
+    model = make_model(bf16=True)
+    assert model.amp_dtype == torch.bfloat16
+    assert not model.grad_scaler.is_enabled()
+    before = [p.detach().clone() for p in model.network.parameters()]
+    for batch_meta, batch_data in make_batches(model, 3):
+        model.update(batch_meta, batch_data)
+    assert model.updates == 3
+    assert torch.isfinite(torch.tensor(model.train_loss.avg))
+    changed = [
+        not torch.equal(p, q) for p, q in zip(before, model.network.parameters())
+    ]
+    assert any(changed)
+    # parameters stay in fp32, only the computation is autocast
+    assert all(p.dtype == torch.float32 for p in model.network.parameters())
+
+    batch_meta, batch_data = make_batches(model, 1, is_train=False)[0]
+    score, predict, gold = model.predict(batch_meta, batch_data)
+    assert len(score) == 2 * len(gold) and len(predict) == len(gold)
+
+
+def saved_activation_bytes(model, batch_meta, batch_data):
+    """Bytes of the tensors autograd keeps from the forward for the backward pass"""
+    saved = []
+
+    def pack(tensor):
+        saved.append(tensor.numel() * tensor.element_size())
+        return tensor
+
+    model.network.train()
+    inputs = batch_data[: batch_meta["input_len"]]
+    if len(inputs) == 3:
+        inputs += [None, None]
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        logits = model.network(*inputs, batch_meta["task_id"])
+    logits.sum().backward()
+    return sum(saved)
+
+
+def test_gradient_checkpointing():
+    batches = None
+    params = []
+    for gradient_checkpointing_on in (False, True):
+        torch.manual_seed(0)
+        model = make_model(
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            gradient_checkpointing_on=gradient_checkpointing_on,
+        )
+        assert model.network.bert.is_gradient_checkpointing == gradient_checkpointing_on
+        batches = batches or make_batches(model, 2)
+        for batch_meta, batch_data in batches:
+            model.update(batch_meta, batch_data)
+        params.append([p.detach() for p in model.network.parameters()])
+    for p, q in zip(*params):
+        assert torch.allclose(p, q, atol=1e-6)
+
+
+def test_gradient_checkpointing_legacy_api(monkeypatch):
+    # transformers < 4.11, as pinned in requirements.txt, has no
+    # gradient_checkpointing_enable and reads the flag from the config instead
+    monkeypatch.delattr(PreTrainedModel, "gradient_checkpointing_enable")
+    torch.manual_seed(0)
+    model = make_model(gradient_checkpointing_on=True)
+    assert model.network.bert.config.gradient_checkpointing
+    for batch_meta, batch_data in make_batches(model, 1):
+        model.update(batch_meta, batch_data)
+
+
+def test_fused_step():
+    torch.manual_seed(0)
+    model = make_model(task_names=("rte", "stsb", "cola"))
+    # dropout off, so that the fused and the separate forwards are comparable
+    model.network.eval()
+    rng = random.Random(0)
+    task_samples = [make_samples(model, rng, 4, task_id) for task_id in (1, 0, 1, 2)]
+    collater = Collater(dropout_w=0.0)
+    ref_grads = [torch.zeros_like(p) for p in model.network.parameters()]
+    ref_loss = 0
+    # same task batches of a step are fused
+    for samples in (task_samples[0] + task_samples[2], *task_samples[1::2]):
+        model.train_loss.reset()
+        model._forward_backward(*collater.collate_fn(samples))
+        ref_loss += model.train_loss.avg
+        for grad, p in zip(ref_grads, model.network.parameters()):
+            if p.grad is not None:
+                grad += p.grad
+        model.optimizer.zero_grad()
+
+    fused_batch = sum(task_samples, [])
+    random.Random(1).shuffle(fused_batch)
+    batch_meta, batch_data = Collater(dropout_w=0.0, fused_on=True).collate_fn(
+        fused_batch
+    )
+    assert sorted(batch_meta["task_id"]) == [0, 1, 2]
+    model.train_loss.reset()
+    model._forward_backward(batch_meta, batch_data)
+    # the loss of a fused step is the sum of the task losses
+    assert abs(model.train_loss.avg - ref_loss) < 1e-5
+    for grad, p in zip(ref_grads, model.network.parameters()):
+        fused_grad = p.grad if p.grad is not None else torch.zeros_like(p)
+        assert torch.allclose(grad, fused_grad, atol=1e-5)
+
+
+def test_predict_tasks():
+    torch.manual_seed(0)
+    model = make_model(task_names=("rte", "mnli", "stsb"))
+    task_ids = [2, 0, 1]
+    for batch_meta, batch_data in make_batches(model, 2, is_train=False):
+        results = model.predict_tasks(batch_meta, list(batch_data), task_ids)
+        assert len(results) == len(task_ids)
+        for task_id, (score, predict) in zip(task_ids, results):
+            # the same inputs through predict() with the head of task_id
+            task_meta = dict(
+                batch_meta,
+                task_id=task_id,
+                task_def=model.config["task_def_list"][task_id].__dict__,
+            )
+            ref_score, ref_predict, _ = model.predict(task_meta, list(batch_data))
+            assert np.allclose(score, ref_score, atol=1e-6)
+            assert np.array_equal(predict, ref_predict)
+
+
+# deterministic updates, sgd moves the parameters proportionally to the gradients
+NO_SYNC_OPT = {
+    "hidden_dropout_prob": 0.0,
+    "attention_probs_dropout_prob": 0.0,
+    "optimizer": "sgd",
+    "learning_rate": 1.0,
+}
+
+
+def counting_allreduce_hook(calls, bucket):
+    calls.append(bucket.index())
+    return allreduce_hook(None, bucket)
+
+
+def run_ddp_rank(rank, world_size, init_file, batches, result_file, opt):
+    dist.init_process_group(
+        "gloo", init_method="file://" + init_file, rank=rank, world_size=world_size
+    )
+    torch.manual_seed(0)
+    model = make_model(local_rank=rank, world_size=world_size, **opt)
+    calls = []
+    model.mnetwork.register_comm_hook(calls, counting_allreduce_hook)
+    all_reduce_calls = []
+    update_times = []
+    for batch_meta, batch_data in batches[rank::world_size]:
+        del calls[:]
+        start = time.perf_counter()
+        model.update(batch_meta, batch_data)
+        update_times.append(time.perf_counter() - start)
+        all_reduce_calls.append(len(calls))
+    if rank == 0:
+        torch.save(
+            {
+                "params": [p.detach() for p in model.network.parameters()],
+                "all_reduce_calls": all_reduce_calls,
+                "update_times": update_times,
+            },
+            result_file,
+        )
+    dist.destroy_process_group()
+
+
+def spawn_ddp(tmp_dir, batches, world_size=2, **opt):
+    result_file = os.path.join(tmp_dir, "result.pt")
+    init_file = os.path.join(tmp_dir, "init")
+    if os.path.exists(init_file):
+        os.remove(init_file)
+    mp.spawn(
+        run_ddp_rank,
+        args=(world_size, init_file, batches, result_file, opt),
+        nprocs=world_size,
+    )
+    return torch.load(result_file)
+
+
+def test_no_sync_gradient_accumulation(tmp_path):
+    torch.manual_seed(0)
+    ref_model = make_model(grad_accumulation_step=4, **NO_SYNC_OPT)
+    batches = make_batches(ref_model, 4)
+    # one optimizer step over the 4 micro-batches in a single process ...
+    for batch_meta, batch_data in batches:
+        ref_model.update(batch_meta, batch_data)
+    assert ref_model.updates == 1
+
+    # ... equals 2 ranks with 2 micro-batches each, averaged by ddp
+    result = spawn_ddp(str(tmp_path), batches, grad_accumulation_step=2, **NO_SYNC_OPT)
+    # no communication on the first micro-batch
+    assert result["all_reduce_calls"][0] == 0 and result["all_reduce_calls"][1] > 0
+    for p, q in zip(result["params"], ref_model.network.parameters()):
+        assert torch.allclose(p, q, atol=1e-5)
+
+
+def test_touch_unused_params(tmp_path):
+    task_names = ("rte", "stsb")
+    torch.manual_seed(0)
+    ref_model = make_model(task_names, grad_accumulation_step=2, **NO_SYNC_OPT)
+    # like DistMultiTaskBatchSampler, all ranks run the same task in a step
+    batches = make_batches(ref_model, 2, task_id=0) + make_batches(
+        ref_model, 2, task_id=1
+    )
+    for batch_meta, batch_data in batches:
+        ref_model.update(batch_meta, batch_data)
+
+    # ddp fails on the second step if a parameter got no gradient in the first one,
+    # the heads of the task not in the step must not move
+    result = spawn_ddp(
+        str(tmp_path),
+        batches,
+        task_names=task_names,
+        touch_unused_params_on=True,
+        **NO_SYNC_OPT
+    )
+    for p, q in zip(result["params"], ref_model.network.parameters()):
+        assert torch.allclose(p, q, atol=1e-5)
+
+
+def benchmark_touch_unused_params(
+    n_batches=40, batch_size=16, hidden_size=256, num_hidden_layers=4
+):
+    task_names = ("rte", "mrpc", "qnli", "stsb")
+    opt = {
+        "task_names": task_names,
+        "hidden_size": hidden_size,
+        "num_hidden_layers": num_hidden_layers,
+        "num_attention_heads": 4,
+        "intermediate_size": 4 * hidden_size,
+    }
+    model = make_model(**opt)
+    batches = [
+        batch
+        for task_id in range(len(task_names))
+        for batch in make_batches(model, n_batches // 4, batch_size, task_id=task_id)
+    ]
+    random.Random(0).shuffle(batches)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for touch_unused_params_on in (False, True):
+            result = spawn_ddp(
+                tmp_dir, batches, touch_unused_params_on=touch_unused_params_on, **opt
+            )
+            # the first updates warm up and walk the graph once per task
+            times = result["update_times"][len(task_names) :]
+            print(
+                "find_unused_parameters={}: {:.1f} ms/update".format(
+                    not touch_unused_params_on, 1000 * sum(times) / len(times)
+                )
+            )
+
+
+def benchmark_gradient_checkpointing(batch_size=32, number=5):
+    for gradient_checkpointing_on in (False, True):
+        torch.manual_seed(0)
+        model = make_model(
+            hidden_size=256,
+            num_hidden_layers=6,
+            num_attention_heads=4,
+            intermediate_size=1024,
+            gradient_checkpointing_on=gradient_checkpointing_on,
+        )
+        batch_meta, batch_data = make_batches(model, 1, batch_size=batch_size)[0]
+        memory = saved_activation_bytes(model, batch_meta, batch_data)
+        cost = timeit.timeit(
+            lambda: model.update(batch_meta, batch_data), number=number
+        )
+        print(
+            "gradient checkpointing {}: {:.1f} MB activations, {:.1f} ms/update".format(
+                gradient_checkpointing_on, memory / 2**20, cost * 1000 / number
+            )
+        )
+
+
+def benchmark_fused_step(batch_size=8, number=5):
+    task_names = ("rte", "mrpc", "qnli", "stsb")
+    torch.manual_seed(0)
+    model = make_model(
+        task_names=task_names,
+        hidden_size=256,
+        num_hidden_layers=6,
+        num_attention_heads=4,
+        intermediate_size=1024,
+    )
+    rng = random.Random(0)
+    task_samples = [
+        make_samples(model, rng, batch_size, task_id)
+        for task_id in range(len(task_names))
+    ]
+    collater = Collater(dropout_w=0.0)
+    batches = [collater.collate_fn(samples) for samples in task_samples]
+    fused_batch = Collater(dropout_w=0.0, fused_on=True).collate_fn(
+        sum(task_samples, [])
+    )
+
+    def separate():
+        for batch_meta, batch_data in batches:
+            model.update(batch_meta, batch_data)
+
+    for name, step in (
+        ("separate", separate),
+        ("fused", lambda: model.update(*fused_batch)),
+    ):
+        cost = timeit.timeit(step, number=number)
+        print(
+            "{} steps: {:.1f} ms per {} task batches".format(
+                name, cost * 1000 / number, len(task_names)
+            )
+        )
+
+
+def benchmark_predict_tasks(batch_size=32, number=5):
+    task_names = ("rte", "mrpc", "qnli", "stsb")
+    torch.manual_seed(0)
+    model = make_model(
+        task_names=task_names,
+        hidden_size=256,
+        num_hidden_layers=6,
+        num_attention_heads=4,
+        intermediate_size=1024,
+    )
+    batch_meta, batch_data = make_batches(model, 1, batch_size, is_train=False)[0]
+    task_ids = list(range(len(task_names)))
+
+    def separate():
+        for task_id in task_ids:
+            task_meta = dict(
+                batch_meta,
+                task_id=task_id,
+                task_def=model.config["task_def_list"][task_id].__dict__,
+            )
+            model.predict(task_meta, list(batch_data))
+
+    with torch.no_grad():
+        for name, step in (
+            ("separate", separate),
+            (
+                "single pass",
+                lambda: model.predict_tasks(batch_meta, list(batch_data), task_ids),
+            ),
+        ):
+            cost = timeit.timeit(step, number=number)
+            print(
+                "{} inference: {:.1f} ms per batch for {} tasks".format(
+                    name, cost * 1000 / number, len(task_names)
+                )
+            )
+
+
+if __name__ == "__main__":
+    benchmark_gradient_checkpointing()
+    benchmark_touch_unused_params()
+    benchmark_fused_step()
+    benchmark_predict_tasks()
@@ -0,0 +1,88 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import json
+import numpy as np
+from experiments.exp_def import TaskDefs
+from mt_dnn.batcher import (
+    get_token_budget_index_batches,
+    MultiTaskBatchSampler,
+    SingleTaskDataset,
+)
+from tests.test_dataloader import load_rte, write_rte
+
+RANKING_TASK_DEF = """hnli:
+  data_format: PremiseAndMultiHypothesis
+  enable_san: false
+  metric_meta:
+  - ACC
+  loss: RankCeCriterion
+  n_class: 1
+  task_type: Ranking
+"""
+
+
+def test_token_budget_index_batches():
+    np.random.seed(0)
+    lengths = np.random.randint(5, 500, size=2000)
+    batches = get_token_budget_index_batches(lengths, 4096)
+    # every sample is used exactly once
+    assert sorted(idx for batch in batches for idx in batch) == list(range(2000))
+    for batch in batches:
+        assert len(batch) * lengths[batch].max() <= 4096
+    padded = sum(len(batch) * lengths[batch].max() for batch in batches)
+    assert lengths.sum() / padded > 0.95
+
+    batches = get_token_budget_index_batches(lengths, 4096, max_batch_size=4)
+    assert max(len(batch) for batch in batches) == 4
+
+    # each row is padded to 128 tokens
+    batches = get_token_budget_index_batches(lengths, 4096, padded_len=128)
+    assert max(len(batch) for batch in batches) == 32
+    # ranking samples of 4 rows
+    batches = get_token_budget_index_batches(lengths, 4096, pairwise_size=4)
+    for batch in batches:
+        assert len(batch) * 4 * lengths[batch].max() <= 4096
+
+
+def write_ranking(path, n_samples=50, pairwise_size=4):
+    with open(path, "w", encoding="utf-8") as writer:
+        for i in range(n_samples):
+            token_id = [[101] * (i % 10 + 2)] * pairwise_size
+            sample = {
+                "uid": str(i),
+                "ruid": [str(i)] * pairwise_size,
+                "olabel": [0] * pairwise_size,
+                "label": 0,
+                "token_id": token_id,
+                "type_id": [[0] * len(tok) for tok in token_id],
+            }
+            writer.write("{}\n".format(json.dumps(sample)))
+
+
+def test_sampler_token_budget(tmp_path):
+    path = str(tmp_path / "rte_train.json")
+    # 2 .. 51 tokens
+    write_rte(path)
+    dataset = load_rte(path)
+    # batch_size caps the samples of the short batches
+    sampler = MultiTaskBatchSampler([dataset], 8, 0, 0, max_tokens=4096)
+    batches = sampler._train_data_list[0]
+    assert max(len(batch) for batch in batches) == 8
+    assert sorted(idx for batch in batches for idx in batch) == list(range(50))
+    # do_padding pads every row to max_seq_len
+    sampler = MultiTaskBatchSampler(
+        [dataset], 8, 0, 0, max_tokens=1024, do_padding=True, max_seq_len=512
+    )
+    assert max(len(batch) for batch in sampler._train_data_list[0]) == 2
+
+    with open(tmp_path / "task_def.yml", "w") as f:
+        f.write(RANKING_TASK_DEF)
+    task_def = TaskDefs(str(tmp_path / "task_def.yml")).get_task_def("hnli")
+    path = str(tmp_path / "hnli_train.json")
+    write_ranking(path)
+    dataset = SingleTaskDataset(path, True, task_def=task_def)
+    assert dataset.get_pairwise_size() == 4
+    sampler = MultiTaskBatchSampler([dataset], 64, 0, 0, max_tokens=128)
+    lengths = dataset.get_lengths()
+    for batch in sampler._train_data_list[0]:
+        assert len(batch) * 4 * lengths[batch].max() <= 128
@@ -0,0 +1,139 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import json
+import time
+import random
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from transformers import BertTokenizerFast
+from mt_dnn.serving import InferenceService, MicroBatcher, make_server
+from tests.test_model import make_model
+
+WORDS = ["the", "a", "cat", "dog", "sat", "ran", "on", "mat", "away", "home"]
+
+
+def make_tokenizer(path):
+    vocab_file = str(path / "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS))
+    return BertTokenizerFast(vocab_file)
+
+
+def make_service(path, **kwargs):
+    torch.manual_seed(0)
+    model = make_model(task_names=("rte", "stsb"))
+    return InferenceService(
+        model,
+        make_tokenizer(path),
+        ["rte", "stsb"],
+        model.config["task_def_list"],
+        **kwargs
+    )
+
+
+def make_text(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+
+
+def post(url, obj):
+    request = urllib.request.Request(
+        url, data=json.dumps(obj).encode("utf-8"), method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_micro_batcher():
+    batches = []
+
+    def predict_fn(task_id, requests):
+        batches.append((task_id, len(requests)))
+        return [(task_id, request) for request in requests]
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=4, max_wait=10.0)
+    futures = [batcher.submit(i % 2, i) for i in range(13)]
+    # full batches do not wait
+    assert futures[6].result(timeout=5) == (0, 6)
+    batcher.close()
+    assert [future.result() for future in futures] == [(i % 2, i) for i in range(13)]
+    assert sorted(batches) == [(0, 3), (0, 4), (1, 2), (1, 4)]
+    assert batcher.stats.summary()["count"] == 13
+
+
+def test_inference_server(tmp_path):
+    service = make_service(tmp_path, max_batch_size=8, max_wait=0.05)
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    rng = random.Random(0)
+    requests = [
+        {
+            "task": rng.choice(["rte", "stsb"]),
+            "premise": make_text(rng),
+            "hypothesis": make_text(rng),
+        }
+        for _ in range(24)
+    ]
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            responses = list(
+                executor.map(lambda request: post(url + "/predict", request), requests)
+            )
+        for request, (status, result) in zip(requests, responses):
+            assert status == 200
+            # the same score as a batch of one
+            task_id = service.task_ids[request["task"]]
+            expected = service.predict_batch(task_id, [request])[0]
+            assert np.allclose(result["score"], expected["score"], atol=1e-5)
+            assert result["prediction"] == expected["prediction"]
+
+        status, result = post(url + "/predict", {"task": "cola", "premise": "a"})
+        assert status == 400 and "cola" in result["error"]
+        status, result = post(url + "/predict", {"task": "rte", "premise": "a"})
+        assert status == 400 and "hypothesis" in result["error"]
+        with urllib.request.urlopen(url + "/stats") as response:
+            stats = json.loads(response.read())
+        assert stats["count"] == 24 and stats["p50_ms"] <= stats["p99_ms"]
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def benchmark_micro_batching(tmp_path, n_requests=512, n_clients=32):
+    rng = random.Random(0)
+    requests = [
+        {"premise": make_text(rng), "hypothesis": make_text(rng)}
+        for _ in range(n_requests)
+    ]
+    for max_batch_size in (1, 8, 32):
+        service = make_service(tmp_path, max_batch_size=max_batch_size)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(n_clients) as executor:
+            list(executor.map(lambda r: service.predict("rte", r), requests))
+        elapsed = time.perf_counter() - start
+        stats = service.stats()
+        service.close()
+        print(
+            "max_batch_size {:>2}: {:.0f} req/s, p50 {:.1f} ms, p99 {:.1f} ms".format(
+                max_batch_size,
+                n_requests / elapsed,
+                stats["p50_ms"],
+                stats["p99_ms"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmark_micro_batching(pathlib.Path(tmp_dir))
@@ -0,0 +1,43 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+from collections import Counter
+import numpy as np
+from mt_dnn.task_scheduler import TaskScheduler, task_sampling_probs
+
+
+def test_mix_schedule():
+    np.random.seed(0)
+    task_sizes = [50, 20, 0, 7]
+    schedule = list(TaskScheduler(task_sizes, chunk_size=8))
+    assert Counter(schedule) == {0: 50, 1: 20, 3: 7}
+    assert schedule != sorted(schedule)
+
+    # the main task comes last
+    schedule = list(TaskScheduler(task_sizes, mix_opt=1, chunk_size=8))
+    assert schedule[-50:] == [0] * 50 and 0 not in schedule[:-50]
+
+    # all main task batches and a ratio of the others
+    scheduler = TaskScheduler(task_sizes, extra_task_ratio=0.4, chunk_size=8)
+    schedule = list(scheduler)
+    counts = Counter(schedule)
+    assert len(schedule) == len(scheduler) == 70
+    assert counts[0] == 50 and counts[1] + counts[3] == 20 and counts[3] <= 7
+
+
+def test_sampling_schedule():
+    np.random.seed(0)
+    task_sizes = [900, 100, 0]
+    assert np.allclose(task_sampling_probs(task_sizes), [0.9, 0.1, 0])
+    assert np.allclose(
+        task_sampling_probs(task_sizes, "temperature", 2), [0.75, 0.25, 0]
+    )
+    assert np.allclose(task_sampling_probs(task_sizes, "uniform"), [0.5, 0.5, 0])
+
+    scheduler = TaskScheduler(task_sizes, "temperature", temperature=2)
+    schedule = list(scheduler)
+    assert len(schedule) == len(scheduler) == 1000
+    assert 200 < schedule.count(1) < 300 and 2 not in schedule
+
+    # three times the dev loss triples the odds relative to the other task
+    scheduler.reweight({0: 1.0, 1: 3.0})
+    assert np.allclose(scheduler.probs, [0.5, 0.5, 0])
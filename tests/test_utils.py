@@ -0,0 +1,65 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import random
+import pytest
+import torch
+from data_utils.utils import AverageMeter, DeviceAverageMeter
+
+# the tensor methods that copy a value to the host, and wait for the device
+HOST_SYNCS = ("item", "tolist", "cpu", "numpy", "__float__", "__bool__")
+
+
+def count_host_syncs(monkeypatch):
+    calls = []
+    for name in HOST_SYNCS:
+        method = getattr(torch.Tensor, name)
+
+        def wrapper(self, *args, __name=name, __method=method, **kwargs):
+            calls.append(__name)
+            return __method(self, *args, **kwargs)
+
+        monkeypatch.setattr(torch.Tensor, name, wrapper)
+    return calls
+
+
+def test_device_average_meter(monkeypatch):
+    rng = random.Random(0)
+    # a few large losses among many small ones, float32 sums drift on these
+    updates = [
+        (rng.uniform(0, 1) * 10 ** rng.randint(-4, 4), rng.randint(1, 32))
+        for _ in range(10000)
+    ]
+    meter, device_meter = AverageMeter(), DeviceAverageMeter()
+    weight = torch.ones(1, dtype=torch.float64, requires_grad=True)
+    calls = count_host_syncs(monkeypatch)
+    for i, (val, n) in enumerate(updates):
+        meter.update(val, n)
+        # losses are tensors of the graph, python floats are accepted too
+        device_meter.update(val if i % 10 == 0 else (weight * val).sum(), n)
+    assert calls == []
+    assert device_meter.count == meter.count
+    assert device_meter.avg == pytest.approx(meter.avg, rel=1e-12)
+    assert calls == ["tolist"]
+    # cached until the next update
+    device_meter.avg
+    assert calls == ["tolist"]
+
+    meter.update(2.0, 3)
+    device_meter.update(torch.tensor(2.0), 3)
+    assert calls == ["tolist"]
+    assert device_meter.avg == pytest.approx(meter.avg, rel=1e-12)
+    assert calls == ["tolist", "tolist"]
+
+    device_meter.reset()
+    assert device_meter.avg == 0 and device_meter.count == 0
+
+
+def test_device_average_meter_devices():
+    # the meta device stands in for cuda, a float first, then device tensors
+    meter = DeviceAverageMeter()
+    meter.update(1.0)
+    meter.update(torch.tensor(2.0, device="meta"), 2)
+    meter.update(3.0)
+    meter.update(torch.tensor(4.0))
+    assert meter.sum.device.type == "meta" and meter.sum.dtype == torch.float64
+    assert meter.count == 5
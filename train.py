@@ -14,9 +14,11 @@ from tensorboardX import SummaryWriter
 
 # from torch.utils.tensorboard import SummaryWriter
 from experiments.exp_def import TaskDefs
-from mt_dnn.inference import eval_model, extract_encoding
+from mt_dnn.inference import eval_model, eval_loss, extract_encoding, to_json
+from mt_dnn.inference import dump_encoding
+from mt_dnn.task_scheduler import TASK_SAMPLING_STRATEGIES
 from data_utils.log_wrapper import create_logger
-from data_utils.task_def import EncoderModelType
+from data_utils.task_def import EncoderModelType, TaskType
 from data_utils.utils import set_environment
 from mt_dnn.batcher import (
     SingleTaskDataset,
@@ -25,8 +27,13 @@ from mt_dnn.batcher import (
     MultiTaskBatchSampler,
     DistMultiTaskBatchSampler,
     DistSingleTaskBatchSampler,
+    FusedTaskBatchSampler,
 )
-from mt_dnn.batcher import DistTaskDataset
+from mt_dnn.batcher import DistTaskDataset, MMapSingleTaskDataset
+from mt_dnn.batcher import LazySingleTaskDataset, worker_init_fn
+from mt_dnn.batcher import DevicePrefetcher, PACKING_UNSUPPORTED_ENCODERS
+from data_utils.mmap_data import get_mmap_path
+from data_utils.encoding_store import get_encoding_store_path
 from mt_dnn.model import MTDNNModel
 
 
@@ -67,6 +74,23 @@ def model_config(parser):
     parser.add_argument("--mtl_opt", type=int, default=0)
     parser.add_argument("--ratio", type=float, default=0)
     parser.add_argument("--mix_opt", type=int, default=0)
+    parser.add_argument(
+        "--task_sampling",
+        default="mix",
+        choices=TASK_SAMPLING_STRATEGIES,
+        help="mix: every batch once per epoch (with --mix_opt/--ratio), otherwise draw tasks with replacement by size, size ** (1 / temperature) or uniformly",
+    )
+    parser.add_argument(
+        "--task_sampling_temperature",
+        type=float,
+        default=2.0,
+        help="temperature of --task_sampling temperature",
+    )
+    parser.add_argument(
+        "--task_sampling_reweight_on",
+        action="store_true",
+        help="after every epoch scale the task sampling probabilities by the dev losses of the tasks",
+    )
     parser.add_argument("--max_seq_len", type=int, default=512)
     parser.add_argument("--init_ratio", type=float, default=1)
     parser.add_argument("--encoder_type", type=int, default=EncoderModelType.BERT)
@@ -83,6 +107,26 @@ def model_config(parser):
     parser.add_argument("--bin_on", action="store_true")
     parser.add_argument("--bin_size", type=int, default=64)
     parser.add_argument("--bin_grow_ratio", type=int, default=0.5)
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=0,
+        help=">0 to batch samples of similar length up to max_tokens padded tokens per batch (overrides bin_on, batch_size caps the samples per batch)",
+    )
+
+    # data loading workers
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="number of DataLoader worker processes collating training batches, 0 to collate in the main process",
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=2,
+        help="batches prepared ahead by each worker",
+    )
 
     # dist training
     parser.add_argument(
@@ -127,6 +171,27 @@ def data_config(parser):
         help=">0 to turn on knowledge distillation, requires 'softlabel' column in input data",
     )
     parser.add_argument("--do_padding", action="store_true")
+    parser.add_argument(
+        "--mmap_data_on",
+        action="store_true",
+        help="load training data from the binary {task}_train.mmap files emitted by prepro_std.py --mmap_on",
+    )
+    parser.add_argument(
+        "--lazy_eval_on",
+        action="store_true",
+        help="parse dev/test samples on access through a byte-offset index instead of loading them into memory",
+    )
+    parser.add_argument(
+        "--packing_on",
+        action="store_true",
+        help="pack several short classification/regression samples into one max_seq_len row",
+    )
+    parser.add_argument(
+        "--fused_batch_num",
+        type=int,
+        default=1,
+        help=">1 to fuse that many consecutive task batches into one step, which runs the encoder once for all their classification/regression tasks",
+    )
     return parser
 
 
@@ -140,6 +205,22 @@ def train_config(parser):
     parser.add_argument("--log_per_updates", type=int, default=500)
     parser.add_argument("--save_per_updates", type=int, default=10000)
     parser.add_argument("--save_per_updates_on", action="store_true")
+    parser.add_argument(
+        "--async_save_on",
+        action="store_true",
+        help="write checkpoints on a background thread from a host memory snapshot",
+    )
+    parser.add_argument(
+        "--keep_last_ckpts",
+        type=int,
+        default=0,
+        help=">0 to keep only that many most recent checkpoints",
+    )
+    parser.add_argument(
+        "--split_ckpt_on",
+        action="store_true",
+        help="write the optimizer/scheduler/sampler state of model_x.pt to model_x.optim.pt",
+    )
     parser.add_argument("--epochs", type=int, default=5)
     parser.add_argument("--batch_size", type=int, default=8)
     parser.add_argument("--batch_size_eval", type=int, default=8)
@@ -177,19 +258,46 @@ def train_config(parser):
         help="random seed for data shuffling, embedding init, etc.",
     )
     parser.add_argument("--grad_accumulation_step", type=int, default=1)
+    parser.add_argument(
+        "--touch_unused_params_on",
+        action="store_true",
+        help="give the heads of the other tasks a zero gradient so DDP runs with find_unused_parameters=False",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing_on",
+        action="store_true",
+        help="recompute encoder activations in the backward pass to save memory",
+    )
+    parser.add_argument(
+        "--encoder_cache_mb",
+        type=int,
+        default=0,
+        help="cache the encoder states of evaluated samples in this much host memory, "
+        "evaluation on a frozen encoder (--update_bert_opt 1) runs the heads only",
+    )
+    parser.add_argument(
+        "--encoder_cache_dir",
+        type=str,
+        default=None,
+        help="also keep the cached encoder states on disk, shared between runs",
+    )
 
     # fp 16
     parser.add_argument(
         "--fp16",
         action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        help="fp16 mixed precision through torch autocast with dynamic loss scaling (GPU only)",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="bfloat16 mixed precision through torch autocast, on GPU or CPU",
     )
     parser.add_argument(
         "--fp16_opt_level",
         type=str,
         default="O1",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-        "See details at https://nvidia.github.io/apex/amp.html",
+        help="ignored, kept for scripts written for the former apex backend",
     )
 
     # adv training
@@ -206,6 +314,19 @@ def train_config(parser):
     parser.add_argument(
         "--encode_mode", action="store_true", help="only encode test data"
     )
+    parser.add_argument(
+        "--encode_store_on",
+        action="store_true",
+        help="with --encode_mode, stream the unpadded encodings to a memory-mapped "
+        "{dataset}_encoding.mmap store instead of one padded tensor",
+    )
+    parser.add_argument(
+        "--encode_dtype",
+        type=str,
+        default="float32",
+        choices=["float16", "float32"],
+        help="dtype of the encoding store",
+    )
     parser.add_argument("--debug", action="store_true", help="print debug info")
 
     # transformer cache
@@ -239,7 +360,7 @@ encoder_type = args.encoder_type
 
 def dump(path, data):
     with open(path, "w") as f:
-        json.dump(data, f)
+        json.dump(data, f, default=to_json)
 
 
 def evaluation(
@@ -346,6 +467,33 @@ def evaluation(
                     submit(official_score_file, results, label_dict)
 
 
+def reweight_task_sampling(model, task_scheduler, datasets, data_list, tasks, device):
+    """Sample the training tasks in proportion to their dev losses in the next epoch"""
+    task_losses = {}
+    for idx, dataset in enumerate(datasets):
+        prefix = dataset.split("_")[0]
+        if data_list[idx] is None or prefix not in tasks:
+            continue
+        loss = eval_loss(model, data_list[idx], device)
+        if loss is not None:
+            # tasks with several dev sets (mnli) average them
+            task_losses.setdefault(tasks[prefix], []).append(loss)
+    task_ids = sorted(task_losses)
+    losses = torch.tensor([np.mean(task_losses[task_id]) for task_id in task_ids])
+    if torch.distributed.is_initialized():
+        # every rank has to draw the same schedule
+        losses = losses.to(device)
+        torch.distributed.broadcast(losses, 0)
+    task_losses = dict(zip(task_ids, losses.tolist()))
+    task_scheduler.reweight(task_losses)
+    print_message(
+        logger,
+        "Task sampling probabilities: {}".format(
+            " ".join("%.4f" % prob for prob in task_scheduler.probs)
+        ),
+    )
+
+
 def initialize_distributed(logger, args):
     """Initialize torch.distributed."""
     args.rank = int(os.getenv("RANK", "0"))
@@ -397,6 +545,29 @@ def main():
     else:
         device = torch.device("cpu")
 
+    if args.touch_unused_params_on:
+        # the adversarial loss runs several forwards per backward
+        assert not args.adv_train, "touch_unused_params_on does not support adv_train"
+        # checkpointed layers are hidden from the graph walk that finds unused params
+        assert (
+            not args.gradient_checkpointing_on
+        ), "touch_unused_params_on does not support gradient_checkpointing_on"
+    if args.packing_on:
+        assert not args.adv_train, "packing_on does not support adv_train"
+        assert not args.multi_gpu_on, "packing_on does not support multi_gpu_on"
+        assert (
+            args.encoder_type not in PACKING_UNSUPPORTED_ENCODERS
+        ), "packing_on does not support encoder type {}".format(args.encoder_type)
+    if args.task_sampling_reweight_on:
+        assert (
+            args.task_sampling != "mix"
+        ), "task_sampling_reweight_on needs a --task_sampling strategy other than mix"
+    if args.fused_batch_num > 1:
+        assert not args.adv_train, "fused_batch_num does not support adv_train"
+        assert not args.multi_gpu_on, "fused_batch_num does not support multi_gpu_on"
+        assert not args.packing_on, "fused_batch_num does not support packing_on"
+        assert args.mkd_opt == 0, "fused_batch_num does not support mkd_opt"
+
     opt = vars(args)
     # update data dir
     opt["data_dir"] = data_dir
@@ -418,8 +589,13 @@ def main():
         task_def = task_defs.get_task_def(prefix)
         task_def_list.append(task_def)
         train_path = os.path.join(data_dir, "{}_train.json".format(dataset))
+        if args.mmap_data_on:
+            train_path = get_mmap_path(train_path)
+            dataset_cls = MMapSingleTaskDataset
+        else:
+            dataset_cls = SingleTaskDataset
         print_message(logger, "Loading {} as task {}".format(train_path, task_id))
-        train_data_set = SingleTaskDataset(
+        train_data_set = dataset_cls(
             train_path,
             True,
             maxlen=args.max_seq_len,
@@ -428,12 +604,20 @@ def main():
             printable=printable,
         )
         train_datasets.append(train_data_set)
+        if args.fused_batch_num > 1:
+            # fused tasks share the pooled output of the encoder
+            assert task_def.task_type in [TaskType.Classification, TaskType.Regression]
+            assert not (task_def.enable_san and args.answer_opt == 1), (
+                "fused_batch_num does not support the SAN decoder of %s" % prefix
+            )
     train_collater = Collater(
         dropout_w=args.dropout_w,
         encoder_type=encoder_type,
         soft_label=args.mkd_opt > 0,
         max_seq_len=args.max_seq_len,
         do_padding=args.do_padding,
+        packing_on=args.packing_on,
+        fused_on=args.fused_batch_num > 1,
     )
     multi_task_train_dataset = MultiTaskDataset(train_datasets)
     if args.local_rank != -1:
@@ -444,6 +628,11 @@ def main():
             args.ratio,
             rank=args.local_rank,
             world_size=args.world_size,
+            max_tokens=args.max_tokens,
+            task_sampling=args.task_sampling,
+            temperature=args.task_sampling_temperature,
+            do_padding=args.do_padding,
+            max_seq_len=args.max_seq_len,
         )
     else:
         multi_task_batch_sampler = MultiTaskBatchSampler(
@@ -454,12 +643,32 @@ def main():
             bin_on=args.bin_on,
             bin_size=args.bin_size,
             bin_grow_ratio=args.bin_grow_ratio,
+            max_tokens=args.max_tokens,
+            task_sampling=args.task_sampling,
+            temperature=args.task_sampling_temperature,
+            do_padding=args.do_padding,
+            max_seq_len=args.max_seq_len,
         )
+    task_scheduler = multi_task_batch_sampler.scheduler
+    if args.fused_batch_num > 1:
+        multi_task_batch_sampler = FusedTaskBatchSampler(
+            multi_task_batch_sampler, args.fused_batch_num
+        )
+    worker_kwargs = {}
+    if args.num_workers > 0:
+        # workers outlive an epoch, so their random streams do not restart
+        worker_kwargs = {
+            "num_workers": args.num_workers,
+            "prefetch_factor": args.prefetch_factor,
+            "persistent_workers": True,
+            "worker_init_fn": worker_init_fn,
+        }
     multi_task_train_data = DataLoader(
         multi_task_train_dataset,
         batch_sampler=multi_task_batch_sampler,
         collate_fn=train_collater.collate_fn,
         pin_memory=args.cuda,
+        **worker_kwargs,
     )
 
     opt["task_def_list"] = task_def_list
@@ -471,7 +680,9 @@ def main():
         encoder_type=encoder_type,
         max_seq_len=args.max_seq_len,
         do_padding=args.do_padding,
+        packing_on=args.packing_on,
     )
+    eval_dataset_cls = LazySingleTaskDataset if args.lazy_eval_on else SingleTaskDataset
     for dataset in args.test_datasets:
         prefix = dataset.split("_")[0]
         task_def = task_defs.get_task_def(prefix)
@@ -482,7 +693,7 @@ def main():
         dev_path = os.path.join(data_dir, "{}_dev.json".format(dataset))
         dev_data = None
         if os.path.exists(dev_path):
-            dev_data_set = SingleTaskDataset(
+            dev_data_set = eval_dataset_cls(
                 dev_path,
                 False,
                 maxlen=args.max_seq_len,
@@ -516,7 +727,7 @@ def main():
         test_path = os.path.join(data_dir, "{}_test.json".format(dataset))
         test_data = None
         if os.path.exists(test_path):
-            test_data_set = SingleTaskDataset(
+            test_data_set = eval_dataset_cls(
                 test_path,
                 False,
                 maxlen=args.max_seq_len,
@@ -623,7 +834,8 @@ def main():
     )
     if args.resume and args.model_ckpt:
         print_message(logger, "loading model from {}".format(args.model_ckpt))
-        model.load(args.model_ckpt)
+        # the sampler continues where the checkpoint left the epoch
+        model.load(args.model_ckpt, sampler=multi_task_batch_sampler)
 
     #### model meta str
     headline = "############# Model Arch of MT-DNN #############"
@@ -648,6 +860,16 @@ def main():
         for idx, dataset in enumerate(args.test_datasets):
             prefix = dataset.split("_")[0]
             test_data = test_data_list[idx]
+            if args.encode_store_on:
+                with torch.no_grad():
+                    dump_encoding(
+                        model,
+                        test_data,
+                        get_encoding_store_path(output_dir, dataset),
+                        use_cuda=args.cuda,
+                        dtype=args.encode_dtype,
+                    )
+                continue
             with torch.no_grad():
                 encoding = extract_encoding(model, test_data, use_cuda=args.cuda)
             torch.save(
@@ -655,19 +877,24 @@ def main():
             )
         return
 
-    for epoch in range(0, args.epochs):
+    for epoch in range(task_scheduler.epoch, args.epochs):
         print_message(logger, "At epoch {}".format(epoch), level=1)
         start = datetime.now()
+        multi_task_batch_sampler.set_epoch(epoch)
+        # batches of the epoch consumed before a resume are skipped
+        first = multi_task_batch_sampler.position
 
-        for i, (batch_meta, batch_data) in enumerate(multi_task_train_data):
-            batch_meta, batch_data = Collater.patch_data(device, batch_meta, batch_data)
+        for i, (batch_meta, batch_data) in enumerate(
+            DevicePrefetcher(multi_task_train_data, device), first
+        ):
             task_id = batch_meta["task_id"]
             model.update(batch_meta, batch_data)
+            multi_task_batch_sampler.set_position(i + 1)
 
             if (model.updates) % (args.log_per_updates) == 0 or model.updates == 1:
                 ramaining_time = str(
                     (datetime.now() - start)
-                    / (i + 1)
+                    / (i - first + 1)
                     * (len(multi_task_train_data) - i - 1)
                 ).split(".")[0]
                 if args.adv_train and args.debug:
@@ -680,7 +907,7 @@ def main():
                     debug_info = " "
                 print_message(
                     logger,
-                    "Task [{0:2}] updates[{1:6}] train loss[{2:.5f}]{3}remaining[{4}]".format(
+                    "Task [{0!s:>2}] updates[{1:6}] train loss[{2:.5f}]{3}remaining[{4}]".format(
                         task_id,
                         model.updates,
                         model.train_loss.avg,
@@ -736,7 +963,7 @@ def main():
                     logger=logger,
                 )
                 print_message(logger, "Saving mt-dnn model to {}".format(model_file))
-                model.save(model_file)
+                model.save(model_file, sampler=multi_task_batch_sampler)
 
         evaluation(
             model,
@@ -767,9 +994,14 @@ def main():
             logger=logger,
         )
         print_message(logger, "[new test scores at {} saved.]".format(epoch))
+        if args.task_sampling_reweight_on:
+            reweight_task_sampling(
+                model, task_scheduler, args.test_datasets, dev_data_list, tasks, device
+            )
         if args.local_rank in [-1, 0]:
             model_file = os.path.join(output_dir, "model_{}.pt".format(epoch))
-            model.save(model_file)
+            model.save(model_file, sampler=multi_task_batch_sampler)
+    model.wait_for_checkpoint()
     if args.tensorboard:
         tensorboard.close()
 